@@ -17,9 +17,13 @@ from channels.sessions import CookieMiddleware, SessionMiddleware
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChainChat.settings')
 
 def get_asgi_app():
+    from main.events import get_event_log_backend
     from main.ws_urls import URL_PATTERNS
     from main.ws_middleware import QueryAuthMiddleware
 
+    # an event log that can't work with the channel layer fails here and not on the first reconnect
+    get_event_log_backend()
+
     return ProtocolTypeRouter(
         {
             'http': get_asgi_application(),
@@ -128,6 +128,65 @@ REST_FRAMEWORK = {
 
 TOKEN_EXPIRE_TIME = None
 
+# authenticated tokens are kept per process, entries are dropped when the token, its options or the user change.
+# changes reach the other workers through TOKEN_CACHE_ALIAS, which must name a cache all workers share
+# (Redis, Memcached, database), with the local memory cache they are only seen after TOKEN_CACHE_TTL seconds
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_ALIAS = "default"
+
+# Chat.updated_at moves at most once per window (seconds) for each chat
+CHAT_ACTIVITY_WINDOW = 5
+CHAT_ACTIVITY_CACHE_SIZE = 10000
+
+# delta sync returns at most this many sequence numbers of a chat, chats further behind are refetched
+SYNC_CHANGE_LIMIT = 500
+
+# longest accepted sync cursor in characters, about 11 per chat of the user
+SYNC_CURSOR_MAX_SIZE = 128 * 1024
+
+# message search index, LikeSearchBackend works on any database
+MESSAGE_SEARCH_BACKEND = 'main.search.SqliteSearchBackend'
+
+# online status store, sockets that send nothing for PRESENCE_TIMEOUT seconds are closed,
+# status changes reach Profile every PRESENCE_FLUSH_INTERVAL seconds
+PRESENCE_BACKEND = 'main.presence.MemoryPresenceBackend'
+PRESENCE_TIMEOUT = 60
+PRESENCE_FLUSH_INTERVAL = 10
+
+# socket events kept per user, a reconnecting socket replays the ones after its last_event_id.
+# MemoryEventLogBackend only works in a single process and refuses any channel layer but InMemoryChannelLayer,
+# several workers share main.events.DatabaseEventLogBackend, which keeps events for EVENT_LOG_RETENTION seconds
+EVENT_LOG_BACKEND = 'main.events.MemoryEventLogBackend'
+EVENT_LOG_SIZE = 500
+EVENT_LOG_RETENTION = 3600
+
+# chunked media uploads, part files stay in UPLOAD_TEMP_DIR until finalize moves them into media storage
+UPLOAD_TEMP_DIR = BASE_DIR / 'uploads'
+UPLOAD_MAX_SIZE = 512 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+
+# photo and video files are stored once per content, see main.storage
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    "media": {"BACKEND": "main.storage.ContentAddressedStorage"},
+}
+
+# media is served by MediaView after the membership check. MEDIA_SENDFILE hands the file to the web server:
+# "x-accel" (nginx internal location at MEDIA_ACCEL_PREFIX, aliased to MEDIA_ROOT), "x-sendfile" (Apache,
+# lighttpd) or None to stream it from Django
+MEDIA_SENDFILE = None
+MEDIA_ACCEL_PREFIX = "/protected-media/"
+MEDIA_BLOCK_SIZE = 256 * 1024
+
+# photo variants (longest edge in pixels) rendered by THUMBNAIL_WORKERS processes, 0 renders inline
+THUMBNAIL_SIZES = {"thumb": 160, "small": 480, "medium": 1080}
+THUMBNAIL_FORMATS = ("webp", "jpeg")
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_WORKERS = 2
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.1/topics/i18n/
@@ -0,0 +1,24 @@
+from loadtests.users import GroupBurstUser, ReaderUser, SocketUser, WriterUser
+
+# --mix name -> {user class: weight}, classes left out are not spawned
+MIXES = {
+    # everyday traffic, most users read and a fifth sit on an open socket
+    "mixed": {ReaderUser: 5, WriterUser: 2, SocketUser: 2, GroupBurstUser: 1},
+    # scrolling history and marking it read, the query cost ceiling of the API
+    "reader-heavy": {ReaderUser: 8, WriterUser: 1, SocketUser: 1},
+    # sending text and photos, write path, uploads and thumbnail rendering
+    "writer-heavy": {ReaderUser: 2, WriterUser: 6, SocketUser: 2},
+    # bursts into big groups while most members listen, the fan-out ceiling of the channel layer
+    "group-burst": {GroupBurstUser: 3, SocketUser: 7},
+    # idle open sockets only, how many connections one instance holds
+    "sockets": {SocketUser: 1},
+}
+
+
+def apply_mix(environment, name):
+    mix = MIXES[name]
+    for user_class in mix:
+        user_class.weight = mix[user_class]
+
+    environment.user_classes[:] = [user_class for user_class in environment.user_classes if user_class in mix]
+    environment.user_classes_by_name = {user_class.__name__: user_class for user_class in environment.user_classes}
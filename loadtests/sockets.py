@@ -0,0 +1,136 @@
+import random
+import time
+import uuid
+from urllib.parse import urlencode
+
+import gevent
+import websocket
+
+from main.protocols import PROTOCOLS
+
+
+class ChatSocket:
+    # one ws/chat/ connection of a simulated user. Locust sees it as "WS" requests:
+    # connect time, send_message -> ack time, and server broadcast -> delivery time of every event.
+    # a dropped socket reconnects with ?last_event_id= like the apps, "reconnect" is the time it was gone
+    def __init__(self, user, path, protocol="json", heartbeat=20, max_backoff=30):
+        self.user = user
+        self.path = path
+        self.protocol = PROTOCOLS[protocol]
+        self.heartbeat = heartbeat
+        self.max_backoff = max_backoff
+        self.token = None
+        self.connection = None
+        self.closed = False
+        self.greenlets = []
+        # client_id -> perf_counter of the send, until its ack arrives
+        self.pending = {}
+        self.last_event_id = None
+
+    def fire(self, name, response_time, length=0, exception=None):
+        self.user.environment.events.request.fire(request_type="WS", name=name, response_time=response_time,
+                                                  response_length=length, exception=exception, context={})
+
+    def url(self, token):
+        query = {"token": token}
+        # a reconnect picks up the events it missed instead of refetching everything
+        if self.last_event_id is not None:
+            query["last_event_id"] = self.last_event_id
+        return self.user.host.replace("http", "ws", 1).rstrip("/") + self.path + "?" + urlencode(query)
+
+    def connect(self, token):
+        self.token = token
+        start = time.perf_counter()
+        subprotocols = [self.protocol.name] if self.protocol.binary else None
+        try:
+            connection = websocket.create_connection(self.url(token), subprotocols=subprotocols)
+        except Exception as e:
+            self.connection = None
+            self.fire(f"connect {self.path}", (time.perf_counter() - start) * 1000, exception=e)
+            return False
+
+        self.fire(f"connect {self.path}", (time.perf_counter() - start) * 1000)
+        self.connection = connection
+        self.greenlets = [gevent.spawn(self.receive_loop, connection), gevent.spawn(self.heartbeat_loop, connection)]
+        return True
+
+    def reconnect(self):
+        # exponential backoff with jitter, a restarted server is not hit by every socket at once
+        lost = time.perf_counter()
+        for _ in range(len(self.pending)):
+            self.fire("send_message", 0, exception=Exception("connection lost before the ack"))
+        self.pending.clear()
+
+        attempt = 0
+        while not self.closed:
+            gevent.sleep(random.uniform(0, min(self.max_backoff, 2 ** attempt)))
+            if self.closed:
+                return
+            if self.connect(self.token):
+                return self.fire("reconnect", (time.perf_counter() - lost) * 1000)
+            attempt += 1
+
+    def send(self, data):
+        if self.protocol.binary:
+            self.connection.send_binary(self.protocol.encode(data))
+        else:
+            self.connection.send(self.protocol.encode(data))
+
+    def send_message(self, text):
+        client_id = uuid.uuid4().hex
+        self.pending[client_id] = time.perf_counter()
+        try:
+            self.send({"action": "send_message", "client_id": client_id, "text": text})
+        except Exception as e:
+            self.pending.pop(client_id, None)
+            self.fire("send_message", 0, exception=e)
+
+    def heartbeat_loop(self, connection):
+        # sockets that stay silent are closed by the presence timeout
+        while self.connection is connection:
+            gevent.sleep(self.heartbeat)
+            try:
+                self.send({"action": "heartbeat"})
+            except Exception:
+                return
+
+    def receive_loop(self, connection):
+        while self.connection is connection:
+            try:
+                frame = connection.recv()
+            except Exception as e:
+                if self.connection is connection and not self.closed:
+                    self.fire("receive", 0, exception=e)
+                    self.connection = None
+                    connection.close()
+                    self.reconnect()
+                return
+
+            data = self.protocol.decode(None, frame) if isinstance(frame, bytes) else self.protocol.decode(frame)
+            self.handle(data, len(frame))
+
+    def handle(self, data, length):
+        action = data.get("action")
+        if data.get("event_id"):
+            self.last_event_id = data["event_id"]
+
+        if action == "resync_required":
+            # the server no longer has every missed event, the app reloads its chat list
+            self.fire("resync_required", 0, length)
+            self.user.browse_chats()
+        elif action in ("ack", "error"):
+            sent = self.pending.pop(data.get("client_id"), None)
+            if sent is not None:
+                exception = None if action == "ack" else Exception(str(data.get("details")))
+                self.fire("send_message", (time.perf_counter() - sent) * 1000, length, exception)
+        elif data.get("time"):
+            # server and load generator share a clock on a local run, the lag is fan-out plus delivery
+            self.fire(f"event {action}", max(time.time() - data["time"], 0) * 1000, length)
+
+    def close(self):
+        self.closed = True
+        connection, self.connection = self.connection, None
+        if connection:
+            connection.close()
+        gevent.killall(self.greenlets)
+        self.greenlets = []
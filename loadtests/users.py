@@ -0,0 +1,180 @@
+import itertools
+import os
+import random
+from io import BytesIO
+
+import gevent
+from locust import HttpUser, between
+from locust.exception import StopUser
+from PIL import Image
+
+from loadtests.sockets import ChatSocket
+
+WORDS = ("hello", "world", "meeting", "tomorrow", "photo", "video", "lunch", "project", "deadline", "coffee",
+         "weekend", "travel", "ticket", "budget", "release", "server", "python", "django", "socket", "invoice")
+
+# seeded accounts are handed out in order, every simulated user logs in as a different one.
+# --processes workers interleave, separate machines share accounts once they run out
+accounts = itertools.count()
+
+
+def camera_photo(width=1280, height=960):
+    noise = Image.effect_noise((width, height), 48)
+    red = Image.linear_gradient("L").resize((width, height))
+    buffer = BytesIO()
+    Image.merge("RGB", (red, noise, red.rotate(90))).save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+PHOTO = camera_photo()
+
+
+class ChatUser(HttpUser):
+    # logs in as a seeded user and keeps its chat list, the personas below only differ in their task mix
+    abstract = True
+    wait_time = between(1, 5)
+
+    def on_start(self):
+        options = self.environment.parsed_options
+        stride = options.processes if options.processes and options.processes > 0 else 1
+        index = next(accounts) * stride + getattr(self.environment.runner, "worker_index", 0)
+        self.username = f"{options.user_prefix}_{index % options.seeded_users}"
+        self.token = None
+        self.chats = []
+        # newest message seen per chat, what markRead reports
+        self.newest = {}
+
+        with self.client.post("/api/auth/login", json={"username": self.username, "password": options.user_password},
+                              name="/api/auth/login", catch_response=True) as response:
+            if response.status_code != 200:
+                response.failure(f"{self.username} could not log in")
+                raise StopUser()
+            self.token = response.json()["token"]
+
+        self.client.headers["Authorization"] = f"Bearer {self.token}"
+        self.browse_chats()
+
+    def pick_chat(self, groups=None):
+        chats = [chat for chat in self.chats if groups is None or chat["is_group"] == groups]
+        return random.choice(chats)["id"] if chats else None
+
+    def browse_chats(self):
+        response = self.client.get("/api/chat/getList", params={"limit": 20}, name="/api/chat/getList")
+        if response.ok:
+            self.chats = response.json()["results"] or self.chats
+
+    def read_messages(self):
+        # newest page, then older pages while the user keeps scrolling
+        chat_id = self.pick_chat()
+        if not chat_id:
+            return
+
+        params = {"before": "", "no_total": 1, "limit": 20}
+        for page in range(random.randint(1, 4)):
+            response = self.client.get(f"/api/chat/{chat_id}/getMessages", params=params,
+                                       name="/api/chat/[id]/getMessages")
+            if not response.ok:
+                return
+
+            data = response.json()
+            if page == 0 and data["results"]:
+                self.newest[chat_id] = data["results"][0]
+            if not data["has_more"]:
+                return
+            params["before"] = data["before"]
+
+    def mark_read(self):
+        if not self.newest:
+            return
+
+        chat_id, message = self.newest.popitem()
+        self.client.post(f"/api/chat/{chat_id}/markRead", json={"type": message["type"], "message_id": message["id"]},
+                         name="/api/chat/[id]/markRead")
+
+    def send_text(self):
+        chat_id = self.pick_chat()
+        if chat_id:
+            self.client.post(f"/api/chat/{chat_id}/createMessage",
+                             json={"type": "message", "text": " ".join(random.choices(WORDS, k=random.randint(2, 12)))},
+                             name="/api/chat/[id]/createMessage")
+
+    def send_photo(self):
+        # chunked upload like the mobile clients. A few random bytes after the JPEG end marker give every
+        # upload its own digest, so the server stores and renders it instead of reusing the first one
+        chat_id = self.pick_chat()
+        if not chat_id:
+            return
+
+        content = PHOTO + os.urandom(16)
+        response = self.client.post("/api/upload/init", json={"type": "photo", "chat_id": chat_id,
+                                                              "file_name": "photo.jpg", "size": len(content)},
+                                    name="/api/upload/init")
+        if response.status_code != 201:
+            return
+
+        session = response.json()
+        for offset in range(0, len(content), session["chunk_size"]):
+            chunk = content[offset:offset + session["chunk_size"]]
+            response = self.client.post(f"/api/upload/{session['id']}/appendChunk?offset={offset}", data=chunk,
+                                        headers={"Content-Type": "application/octet-stream"},
+                                        name="/api/upload/[id]/appendChunk")
+            if not response.ok:
+                return
+
+        self.client.post(f"/api/upload/{session['id']}/finalize", name="/api/upload/[id]/finalize")
+
+    def open_socket(self, path):
+        socket = ChatSocket(self, path, self.environment.parsed_options.ws_protocol)
+        socket.connect(self.token)
+        return socket
+
+
+class ReaderUser(ChatUser):
+    tasks = {ChatUser.browse_chats: 4, ChatUser.read_messages: 8, ChatUser.mark_read: 4, ChatUser.send_text: 1}
+
+
+class WriterUser(ChatUser):
+    tasks = {ChatUser.browse_chats: 1, ChatUser.read_messages: 2, ChatUser.mark_read: 2, ChatUser.send_text: 6,
+             ChatUser.send_photo: 1}
+
+
+class SocketUser(ChatUser):
+    # keeps the inbox socket of ws/chat/ open and only occasionally touches the API, like an idle app
+    tasks = {ChatUser.browse_chats: 1, ChatUser.read_messages: 2, ChatUser.mark_read: 1}
+    wait_time = between(10, 30)
+    socket = None
+
+    def on_start(self):
+        super().on_start()
+        self.socket = self.open_socket("/ws/chat/")
+
+    def on_stop(self):
+        if self.socket:
+            self.socket.close()
+
+
+class GroupBurstUser(ChatUser):
+    # joins the socket of one of its groups and sends bursts of messages into it, every member
+    # holding a socket receives each of them
+    wait_time = between(5, 15)
+    socket = None
+
+    def on_start(self):
+        super().on_start()
+        chat_id = self.pick_chat(groups=True)
+        if chat_id:
+            self.socket = self.open_socket(f"/ws/chat/{chat_id}/")
+
+    def burst(self):
+        if not self.socket or not self.socket.connection:
+            return
+
+        for _ in range(self.environment.parsed_options.burst_size):
+            self.socket.send_message(" ".join(random.choices(WORDS, k=random.randint(2, 8))))
+            gevent.sleep(random.uniform(0.05, 0.3))
+
+    tasks = {burst: 1}
+
+    def on_stop(self):
+        if self.socket:
+            self.socket.close()
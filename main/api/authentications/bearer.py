@@ -1,19 +1,10 @@
-from datetime import timedelta
-
-from django.utils import timezone
 from rest_framework import authentication
-from rest_framework.exceptions import AuthenticationFailed
 
-from ChainChat import settings
+from main.api.authentications.cache import authenticate_token
 
 
 class BearerTokenAuthentication(authentication.TokenAuthentication):
     keyword = "Bearer"
 
-    def authenticate_credentials(self, token):
-        user, token = super().authenticate_credentials(token)
-        if token.options.expiration_date and token.options.expiration_date < timezone.now():
-            token.delete()
-            raise AuthenticationFailed("Token has expired")
-
-        return user, token
\ No newline at end of file
+    def authenticate_credentials(self, key):
+        return authenticate_token(key)
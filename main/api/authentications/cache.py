@@ -0,0 +1,133 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from ChainChat import settings
+
+USER_FIELDS = [field.attname for field in User._meta.concrete_fields]
+
+
+class TokenCache:
+    # token key -> (user fields, expiration date), bounded by size and by age.
+    # invalidations are published as versions in the shared cache, every worker drops entries whose versions moved
+    def __init__(self, max_size, ttl, alias="default"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.alias = alias
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def version_keys(self, key, user_id):
+        return [f"token-cache:key:{key}", f"token-cache:user:{user_id}"]
+
+    def versions(self, key, user_id):
+        keys = self.version_keys(key, user_id)
+        found = caches[self.alias].get_many(keys)
+        return tuple(found.get(version_key) for version_key in keys)
+
+    def publish(self, version_key):
+        # versions outlive every entry that was cached before them
+        caches[self.alias].set(version_key, uuid.uuid4().hex, self.ttl)
+
+    def get(self, key):
+        # a fresh user instance for every hit, requests never share one
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+        _, values, expiration_date, versions = entry
+        if self.versions(key, values[USER_FIELDS.index("id")]) != versions:
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+                self.misses += 1
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+        return User.from_db(DEFAULT_DB_ALIAS, USER_FIELDS, values), expiration_date
+
+    def set(self, key, user, expiration_date):
+        values = [getattr(user, field) for field in USER_FIELDS]
+        versions = self.versions(key, user.id)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, values, expiration_date, versions)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        self.publish(self.version_keys(key, None)[0])
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate_user(self, user_id):
+        self.publish(self.version_keys(None, user_id)[1])
+        user_index = USER_FIELDS.index("id")
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry[1][user_index] == user_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+token_cache = TokenCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL, settings.TOKEN_CACHE_ALIAS)
+
+
+def authenticate_token(key):
+    # shared by the HTTP authentication and the socket middleware, no queries when the key is cached
+    cached = token_cache.get(key)
+    if cached:
+        user, expiration_date = cached
+    else:
+        try:
+            token = Token.objects.select_related("user", "options").get(key=key)
+        except Token.DoesNotExist:
+            raise AuthenticationFailed("Invalid token.")
+
+        try:
+            expiration_date = token.options.expiration_date
+        except ObjectDoesNotExist:
+            expiration_date = None
+
+        user = token.user
+        token_cache.set(key, user, expiration_date)
+
+    if expiration_date and expiration_date < timezone.now():
+        Token.objects.filter(key=key).delete()
+        raise AuthenticationFailed("Token has expired")
+
+    if not user.is_active:
+        raise AuthenticationFailed("User inactive or deleted.")
+
+    return user, Token(key=key, user=user)
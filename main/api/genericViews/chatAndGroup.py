@@ -31,7 +31,11 @@ class ChatViewBase(AuthRequiredView):
     def get_query_list(self, request, delete_mat=True):
         title = request.GET.get("title", "")
         not_deleted = Q(members__is_deleted=False) if delete_mat else Q()
-        chats = self.model_class.find_chat(title).filter(not_deleted, members__member=request.user).distinct()
+        # one membership row per chat, so the inbox index gives the order without a DISTINCT
+        chats = self.model_class.filter(not_deleted, members__member=request.user).order_by("-members__inbox_order")
+        if title:
+            chats = chats.find_chat(title, request.user)
+        chats = chats.with_user_data(request.user)
         paginated_obj = self.pagination_class.paginate_queryset(chats, request)
         return paginated_obj
 
@@ -0,0 +1,16 @@
+from django.http import Http404
+
+from main.api.genericViews.auth import AuthRequiredView
+from main.api.serializers.uploads import UploadSessionSerializer
+from main.models import UploadSession
+
+
+class UploadBaseView(AuthRequiredView):
+    serializer_class = UploadSessionSerializer
+
+    def get_session(self, request, pk):
+        # sessions are only visible to the user who opened them
+        try:
+            return UploadSession.objects.select_related("message_controller", "blob").get(id=pk, owner=request.user)
+        except UploadSession.DoesNotExist:
+            raise Http404
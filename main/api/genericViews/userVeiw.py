@@ -1,9 +1,12 @@
 from django.contrib.auth.models import User
+from django.db.models import Exists, OuterRef
 from django.http import Http404
 
 from main.api.genericViews.auth import AuthRequiredView
 from main.api.paginations.custom import CustomPagination
 from main.api.serializers.users import UserMoreInfoSerializer
+from main.models import BlockedUser
+from main.search import get_search_backend
 
 
 class UserBaseView(AuthRequiredView):
@@ -11,19 +14,30 @@ class UserBaseView(AuthRequiredView):
     serializer_class = UserMoreInfoSerializer
     model_class = User
 
-    def get_query_list(self, request):
-        username = request.GET.get("q", "")
-
-        if username or len(username) >= 3:
-            obj = self.model_class.objects.filter(username__contains=username)
+    def get_search_queryset(self, username, user):
+        if username:
+            obj = get_search_backend().filter_users(self.model_class.objects.all(), username)
         else:
             obj = self.model_class.objects.exclude(is_active=True)
 
+        return self.with_block_status(obj if obj.ordered else obj.order_by("id"), user)
+
+    def get_query_list(self, request):
+        username = request.GET.get("q", "")
+        obj = self.get_search_queryset(username, request.user)
         paginated_user = self.paginator_class.paginate_queryset(obj, request)
         serializer = self.serializer_class(paginated_user, many=True, context={"user": request.user})
 
         return serializer.data
 
+    def with_block_status(self, queryset, user):
+        # profile and block flags of a whole page in the same query
+        blocked = BlockedUser.objects.filter(is_deleted=False)
+        return queryset.select_related("profile").annotate(
+            is_blocked=Exists(blocked.filter(user=OuterRef("profile"), blocked_by_id=user.id)),
+            is_blocked_you=Exists(blocked.filter(blocked_by=OuterRef("profile"), user_id=user.id)),
+        )
+
     def get_query(self, pk):
         try:
             obj = self.model_class.objects.get(id=pk)
@@ -1,4 +1,9 @@
+import base64
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 
 
@@ -12,4 +17,71 @@ class CustomPagination(pagination.LimitOffsetPagination):
             'limit': self.limit,
             'results': data
         }
-        return Response(raw_data)
\ No newline at end of file
+        return Response(raw_data)
+
+
+class MessageCursorPagination(CustomPagination):
+    # keyset pagination on (created_at, id), newest first
+    before_query_param = "before"
+    after_query_param = "after"
+    no_total_query_param = "no_total"
+    invalid_cursor_message = "Invalid cursor"
+
+    def is_requested(self, request):
+        return self.before_query_param in request.query_params or self.after_query_param in request.query_params
+
+    def encode_cursor(self, obj):
+        raw = f"{obj.created_at.isoformat()}|{obj.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+            created_at, pk = parse_datetime(created_at), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if not created_at:
+            raise NotFound(self.invalid_cursor_message)
+
+        return created_at, pk
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        before = request.query_params.get(self.before_query_param, "")
+        after = request.query_params.get(self.after_query_param, "")
+        no_total = request.query_params.get(self.no_total_query_param, "") in ("1", "true", "True")
+
+        self.count = None if no_total else self.get_count(queryset)
+
+        if after:
+            created_at, pk = self.decode_cursor(after)
+            queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)) \
+                .order_by("created_at", "id")
+        else:
+            if before:
+                created_at, pk = self.decode_cursor(before)
+                queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+            queryset = queryset.order_by("-created_at", "-id")
+
+        results = list(queryset[:self.limit + 1])
+        self.has_more = len(results) > self.limit
+        results = results[:self.limit]
+
+        if after:
+            results.reverse()
+
+        self.before = self.encode_cursor(results[-1]) if results else None
+        self.after = self.encode_cursor(results[0]) if results else None
+        return results
+
+    def get_paginated_response(self, data):
+        raw_data = {
+            'total': self.count,
+            'limit': self.limit,
+            'has_more': self.has_more,
+            'before': self.before,
+            'after': self.after,
+            'results': data
+        }
+        return Response(raw_data)
@@ -4,7 +4,10 @@ from django.contrib.auth.models import User
 from rest_framework import serializers
 
 from main.api.serializers.users import UserSerializer
-from main.models import MessageController, Message, Photo, Chat, Video, Group, ChatMember, BlockedUser, SeenUser
+from main.media import media_url
+from main.presence import get_presence_backend
+from main.services import create_message
+from main.models import MessageController, Message, Photo, Chat, Video, Group, ChatMember, BlockedUser
 
 
 class GroupSerializer(serializers.ModelSerializer):
@@ -34,27 +37,24 @@ class ChatSerializer(serializers.ModelSerializer):
         fields = ("id", "user", "start_with", "is_group", "is_joined","title", "is_online",
                   "members", "unread_messages", "last_message")
 
+    def get_chat_members(self, instance):
+        if hasattr(instance, "member_list"):
+            return instance.member_list
+        return list(ChatMember.objects.filter(chat=instance).select_related("member").order_by("id"))
+
     def get_is_group(self, instance):
         return bool(instance.group)
 
     def get_title(self, instance):
         is_group = bool(instance.group)
-        user_obj = self.context.get("user", None)
 
         if is_group:
             title = {1: instance.group.name}
         else:
-            users = ChatMember.objects.filter(chat=instance)
-            if users:
-                first_user = users.first().member
-                last_user = users.last().member
-                title = {
-                    first_user.id: first_user.first_name + " " + first_user.last_name,
-                    last_user.id: last_user.first_name + " " + last_user.last_name,
-                }
-            else:
-                first_user = users.first().member
-                title = {first_user.id: first_user.first_name + " " + first_user.last_name}
+            users = self.get_chat_members(instance)
+            title = {}
+            for member in users[:1] + users[-1:]:
+                title[member.member.id] = member.member.first_name + " " + member.member.last_name
 
         return title
 
@@ -63,36 +63,60 @@ class ChatSerializer(serializers.ModelSerializer):
         user_obj = self.context.get("user", None)
 
         if not is_group:
-            second_user = ChatMember.objects.filter(chat=instance).exclude(member=user_obj).first()
-            if second_user:
-                return second_user.member.profile.is_online
+            for member in self.get_chat_members(instance):
+                if member.member_id != getattr(user_obj, "id", None):
+                    return get_presence_backend().is_online(member.member_id)
 
         return False
 
     def get_is_joined(self, instance):
+        if hasattr(instance, "is_joined"):
+            return instance.is_joined
+
         user_obj = self.context.get("user", None)
         return instance.members.filter(member=user_obj).exists()
 
     def get_members(self, instance):
+        if hasattr(instance, "members_count"):
+            return instance.members_count
+
         return instance.members.filter(is_deleted=False).count()
 
     def get_unread_messages(self, instance):
+        if hasattr(instance, "unread_count"):
+            return instance.unread_count
+
         user_obj = self.context.get("user", None)
         return instance.unread_messages_count(user_obj.id) if user_obj else None
 
+    def get_inbox(self, instance):
+        if hasattr(instance, "inbox_list"):
+            return instance.inbox_list[0] if instance.inbox_list else None
+
+        user_obj = self.context.get("user", None)
+        return instance.members.filter(member=user_obj).select_related("last_message_author").first()
+
+    def get_readers(self, instance, inbox):
+        if hasattr(instance, "reader_list"):
+            readers = instance.reader_list
+        else:
+            readers = ChatMember.objects.filter(chat=instance, last_read_id__gte=inbox.last_message_id) \
+                .select_related("member").order_by("id")
+
+        return [reader.member for reader in readers if reader.member_id != inbox.last_message_author_id]
+
     def get_last_message(self, instance):
         user_obj = self.context.get('user', None)
-        all_messages = instance.get_messages(user_obj)
-        message_obj = all_messages.first() if all_messages.count() > 0 else None
+        inbox = self.get_inbox(instance)
         data = None
 
-        if message_obj:
+        if inbox and inbox.last_message_id:
             data = {
-                "author": UserSerializer(message_obj.author).data,
-                "preview": f"{message_obj}",
-                "created_at": message_obj.created_at,
-                "sent_by_me": message_obj.author == user_obj,
-                "seen_users": SeenUserSerializer(message_obj.seen_users.filter(is_deleted=False), many=True).data,
+                "author": UserSerializer(inbox.last_message_author).data,
+                "preview": inbox.last_message_preview,
+                "created_at": inbox.last_message_at,
+                "sent_by_me": inbox.last_message_author_id == getattr(user_obj, "id", None),
+                "seen_users": UserSerializer(self.get_readers(instance, inbox), many=True).data,
             }
 
         return data
@@ -199,6 +223,9 @@ class BaseMessageSerializer(serializers.Serializer):
 
         return attrs
 
+    def create(self, validated_data):
+        return create_message(self.Meta.model, **validated_data)
+
 
 class MessageSerializer(BaseMessageSerializer, serializers.ModelSerializer):
     def get_type(self, instance):
@@ -211,40 +238,49 @@ class MessageSerializer(BaseMessageSerializer, serializers.ModelSerializer):
 
 
 class PhotoSerializer(BaseMessageSerializer, serializers.ModelSerializer):
+    variants = serializers.SerializerMethodField(read_only=True)
+
     def get_type(self, instance):
         return "photo"
 
+    def get_variants(self, instance):
+        # {size: {format: {url, width, height}}}, empty until the thumbnail workers are done
+        return {
+            name: {
+                image_format: {"url": media_url("photo", instance.id, name, image_format),
+                               "width": variant["width"], "height": variant["height"]}
+                for image_format, variant in formats.items()
+            }
+            for name, formats in instance.variants.items()
+        }
+
+    def to_representation(self, instance):
+        # files are only reachable through the media endpoint, which checks chat membership
+        data = super().to_representation(instance)
+        data["image"] = media_url("photo", instance.id)
+        return data
+
     class Meta:
         model = Photo
         fields = "__all__"
-        read_only_fields = ("id", "created_at", "updated_at", "edited_at")
+        read_only_fields = ("id", "created_at", "updated_at", "edited_at", "width", "height", "placeholder")
 
 
 class VideoSerializer(BaseMessageSerializer, serializers.ModelSerializer):
     def get_type(self, instance):
         return "video"
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data["video"] = media_url("video", instance.id)
+        return data
+
     class Meta:
         model = Video
         fields = "__all__"
         read_only_fields = ("id", "created_at", "updated_at", "edited_at")
 
 
-class SeenUserSerializer(BaseMessageSerializer, serializers.ModelSerializer):
-    user = UserSerializer(read_only=True)
-
-    class Meta:
-        model = SeenUser
-        fields = ("user", )
-
-    def to_representation(self, instance):
-        data = super().to_representation(instance)
-        raw_data = {}
-        for k, v in data.items():
-            raw_data.update(v)
-        return raw_data
-
-
 class AllMessageSerializer(BaseMessageSerializer, serializers.ModelSerializer):
     message = MessageSerializer(read_only=True)
     photo = PhotoSerializer(read_only=True)
@@ -254,10 +290,17 @@ class AllMessageSerializer(BaseMessageSerializer, serializers.ModelSerializer):
         model = MessageController
         fields = ("message", "photo", "video", "reply", "seen_by")
 
+    def get_chat_readers(self, chat_id):
+        # watermarks of a chat are loaded once per page
+        readers = self.context.setdefault("chat_readers", {})
+        if chat_id not in readers:
+            readers[chat_id] = list(ChatMember.objects.filter(chat_id=chat_id).select_related("member").order_by("id"))
+        return readers[chat_id]
+
     def get_seen_by(self, instance):
-        seen_users = instance.seen_users.filter()
-        data = SeenUserSerializer(seen_users, many=True).data
-        return data
+        seen_users = [reader.member for reader in self.get_chat_readers(instance.chat_id)
+                      if reader.last_read_id >= instance.id and reader.member_id != instance.author_id]
+        return UserSerializer(seen_users, many=True).data
 
 
     def to_representation(self, instance):
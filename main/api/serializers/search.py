@@ -0,0 +1,28 @@
+from rest_framework import serializers
+
+from main.api.serializers.users import UserSerializer
+from main.models import MessageController
+
+
+class SearchHitSerializer(serializers.ModelSerializer):
+    id = serializers.SerializerMethodField(read_only=True)
+    type = serializers.SerializerMethodField(read_only=True)
+    author = UserSerializer(read_only=True)
+    snippet = serializers.SerializerMethodField(read_only=True)
+
+    class Meta:
+        model = MessageController
+        fields = ("id", "type", "author", "created_at", "snippet")
+
+    def get_id(self, instance):
+        return instance.message_id or instance.photo_id or instance.video_id
+
+    def get_type(self, instance):
+        if instance.message_id:
+            return "message"
+        elif instance.photo_id:
+            return "photo"
+        return "video"
+
+    def get_snippet(self, instance):
+        return self.context.get("snippets", {}).get(instance.id, "")
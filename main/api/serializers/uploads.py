@@ -0,0 +1,55 @@
+from django.conf import settings
+from rest_framework import serializers
+
+from main.models import ChatMember, MediaBlob, MessageController, UploadSession
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    type = serializers.ChoiceField(source="kind", choices=UploadSession.KIND_CHOICES)
+    chat_id = serializers.IntegerField()
+    # id of the text message replied to, like send_message on the socket
+    reply_id = serializers.IntegerField(required=False, allow_null=True, write_only=True)
+    # content the user already sent is attached without uploading it again
+    sha256 = serializers.RegexField(r"^[0-9a-f]{64}$", write_only=True, required=False)
+    chunk_size = serializers.SerializerMethodField(read_only=True)
+    completed = serializers.SerializerMethodField(read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ("id", "type", "chat_id", "file_name", "size", "caption", "reply_id", "sha256", "offset",
+                  "chunk_size", "completed")
+        read_only_fields = ("id", "offset")
+
+    def get_chunk_size(self, instance):
+        return settings.UPLOAD_CHUNK_SIZE
+
+    def get_completed(self, instance):
+        return bool(instance.message_controller_id)
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(f"Size has to be between 1 and {settings.UPLOAD_MAX_SIZE} bytes.")
+        return value
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        user = self.context.get("user")
+
+        # membership and blocks are checked again when the message is created
+        if not ChatMember.filtered_objects.filter(chat_id=attrs["chat_id"], member=user).exists():
+            raise serializers.ValidationError({"details": ["Invalid chat provided."]})
+
+        if attrs.get("reply_id"):
+            attrs["reply_id"] = MessageController.filtered_objects.filter(
+                message_id=attrs["reply_id"], chat_id=attrs["chat_id"]).values_list("id", flat=True).first()
+            if not attrs["reply_id"]:
+                raise serializers.ValidationError({"details": ["Can't find message with given id to reply."]})
+
+        return attrs
+
+    def create(self, validated_data):
+        digest = validated_data.pop("sha256", None)
+        blob = MediaBlob.objects.sent_by(self.context["user"], digest, validated_data["size"]) if digest else None
+
+        return self.Meta.model.objects.create(owner=self.context["user"], blob=blob,
+                                              offset=validated_data["size"] if blob else 0, **validated_data)
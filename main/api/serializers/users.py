@@ -3,6 +3,7 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from main.models import Profile
+from main.presence import get_presence_backend
 
 
 class BaseUserSerializer(serializers.ModelSerializer):
@@ -11,10 +12,11 @@ class BaseUserSerializer(serializers.ModelSerializer):
     phone_number = serializers.SerializerMethodField()
 
     def get_is_online(self, obj):
-        return obj.profile.is_online
+        return get_presence_backend().is_online(obj.id)
 
     def get_last_online(self, obj):
-        return obj.profile.last_online
+        # the store knows about disconnects that are not flushed yet
+        return get_presence_backend().last_online(obj.id) or obj.profile.last_online
 
     def get_phone_number(self, obj):
         return obj.profile.phone_number
@@ -36,10 +38,16 @@ class UserMoreInfoSerializer(BaseUserSerializer):
                   "last_online", "is_blocked", "is_blocked_you")
 
     def get_is_blocked(self, instance):
+        if hasattr(instance, "is_blocked"):
+            return instance.is_blocked
+
         user = self.context.get('user', None)
         return instance.profile.is_blocked(user.id)
 
     def get_is_blocked_you(self, instance):
+        if hasattr(instance, "is_blocked_you"):
+            return instance.is_blocked_you
+
         user = self.context.get('user', None)
         return instance.profile.blocked_users.filter(user_id=user.id, is_deleted=False).exists()
 
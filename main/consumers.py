@@ -1,27 +1,82 @@
-import json
 import time
-from datetime import datetime
+from urllib.parse import parse_qs
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
-from main.api.serializers.allMessages import ChatSerializer
-from main.models import Chat, ChatMember
+from django.db import IntegrityError
+from rest_framework.exceptions import ValidationError
 
+from main.api.serializers.allMessages import ChatSerializer, MessageSerializer
+from main.models import Chat, ChatMember, Message, MessageController
+from main.services import create_message
+from main.events import get_event_log_backend
+from main.protocols import DEFAULT_PROTOCOL, negotiate
+from main.presence import get_presence_backend, start_presence_flusher
+from main.realtime import chat_group, user_group
+from main.sync import message_payload
 
-def convert_datetime_to_strings(data):
-    if isinstance(data, list):
-        return [convert_datetime_to_strings(item) for item in data]
-    elif isinstance(data, dict):
-        return {key: convert_datetime_to_strings(value) for key, value in data.items()}
-    elif isinstance(data, datetime):
-        return data.isoformat()
-    return data
+
+def build_chat_payloads(chat_ids, user_obj):
+    # {chat id: (shared chat data, {member id: viewer fields})}, a fixed number of queries for any amount of chats
+    chats = Chat.objects.filter(id__in=chat_ids).with_user_data(user_obj)
+    data = ChatSerializer(chats, many=True, context={"user": user_obj}).data
+    recipients = ChatMember.objects.recipient_fields(chat_ids)
+
+    for chat in data:
+        # the only datetime in the payload, events have to stay serializable by any channel layer
+        if chat["last_message"]:
+            chat["last_message"]["created_at"] = chat["last_message"]["created_at"].isoformat()
+
+    return {chat["id"]: (chat, recipients.get(chat["id"], {})) for chat in data}
+
+serialize_chats = database_sync_to_async(build_chat_payloads)
+
+def personalize_chat(chat_data, fields):
+    chat_data = {**chat_data, "is_joined": fields["is_joined"], "unread_messages": fields["unread_messages"]}
+    if not chat_data["is_group"]:
+        chat_data["is_online"] = fields["is_online"]
+    if chat_data["last_message"]:
+        chat_data["last_message"] = {**chat_data["last_message"], "sent_by_me": fields["sent_by_me"]}
+    return chat_data
 
 @database_sync_to_async
-def serialize_chat(chat_obj, user_obj):
-    data = ChatSerializer(chat_obj, context={"user": user_obj}).data
-    return convert_datetime_to_strings(data)
+def persist_message(user_obj, chat_obj, data):
+    # (message payload, created), a repeated client id returns the message the first send created
+    client_id = data.get("client_id")
+    if not isinstance(client_id, str) or not 0 < len(client_id) <= 64:
+        raise ValidationError({"details": ["client_id is required."]})
+
+    sent = MessageController.objects.select_related("message").filter(author=user_obj, client_id=client_id)
+    controller = sent.first()
+    if controller:
+        return message_payload(controller), False
+
+    raw_data = {"text": data.get("text"), "author_id": user_obj.id, "chat_id": chat_obj.id}
+    if data.get("reply_id"):
+        # replies point at a message id of the same chat, like the createMessage endpoint
+        raw_data["reply_id"] = MessageController.filtered_objects.filter(
+            message_id=data["reply_id"], chat_id=chat_obj.id).values_list("id", flat=True).first()
+        if not raw_data["reply_id"]:
+            raise ValidationError({"details": ["Can't find message with given id to reply."]})
+
+    serializer = MessageSerializer(data=raw_data, context={"user": user_obj})
+    serializer.is_valid(raise_exception=True)
+
+    try:
+        message = create_message(Message, client_id=client_id, **serializer.validated_data)
+        return message_payload(message.message_controller), True
+    except IntegrityError:
+        # a concurrent send with the same client id won the race, any other constraint is an error of this one
+        controller = sent.first()
+        if not controller:
+            raise ValidationError({"details": ["Message could not be saved."]})
+        return message_payload(controller), False
+
+def requested_event_id(scope):
+    # ?last_event_id= of a reconnecting socket, None on a fresh connection
+    value = parse_qs(scope.get("query_string", b"").decode()).get("last_event_id", [""])[0]
+    return int(value) if value.isdigit() else None
 
 @database_sync_to_async
 def get_chat(chat_id):
@@ -34,109 +89,236 @@ def get_chat(chat_id):
 
 @database_sync_to_async
 def get_user_chats(user_obj):
-    return ChatMember.filtered_objects.filter(member=user_obj).values_list("chat_id", flat=True).distinct()
+    return list(ChatMember.filtered_objects.filter(member=user_obj).values_list("chat_id", flat=True))
 
 @database_sync_to_async
-def change_online_status(user_obj, is_online):
-    user_obj.profile.is_online = is_online
-    return user_obj.profile.save()
-
-@database_sync_to_async
-def get_user_profile(user_obj):
-    return user_obj.profile.is_online
+def is_chat_member(chat_obj, user_obj):
+    return ChatMember.filtered_objects.filter(chat=chat_obj, member=user_obj).exists()
 
 
 class ChatMessageBaseConsumer(AsyncWebsocketConsumer):
     groups = []
-    user_group_list = {}
     chat_obj = None
     user_obj = None
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_groups = set()
+        self.protocol = DEFAULT_PROTOCOL
+        self.replayed = set()
+
+    async def accept_protocol(self):
+        # msgpack clients get binary frames, everyone else JSON text frames
+        protocol = negotiate(self.scope.get("subprotocols"))
+        if protocol:
+            self.protocol = protocol
+        await self.accept(subprotocol=protocol.name if protocol else None)
+
+    async def send_data(self, data, relayed=()):
+        if self.protocol.binary:
+            await self.send(bytes_data=self.protocol.encode(data, relayed))
+        else:
+            await self.send(text_data=self.protocol.encode(data, relayed))
+
+    async def send_event(self, event):
+        # a message relayed from a client reaches the others the way it was sent
+        await self.send_data(self.event_data(event), ("message",) if event.get("relayed") else ())
+
+    def follows(self, chat_id):
+        return True
+
+    async def resume(self):
+        # called once the socket is subscribed, live events that overlap the replay are skipped
+        last_event_id = requested_event_id(self.scope)
+        if last_event_id is not None:
+            await self.replay_events(last_event_id)
+
+    async def subscribe(self, chat_ids):
+        for chat_id in chat_ids:
+            group = chat_group(chat_id)
+            if group not in self.chat_groups:
+                self.chat_groups.add(group)
+                await self.channel_layer.group_add(group, self.channel_name)
+
+    async def unsubscribe(self, chat_ids):
+        for chat_id in chat_ids:
+            group = chat_group(chat_id)
+            if group in self.chat_groups:
+                self.chat_groups.discard(group)
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def unsubscribe_all(self):
+        for group in self.chat_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.chat_groups.clear()
+        await self.channel_layer.group_discard(user_group(self.user_obj.id), self.channel_name)
+
+    async def go_online(self):
+        start_presence_flusher(self.channel_layer)
+        if get_presence_backend().connect(self.user_obj.id, self.channel_name):
+            await self.notify_user_friends(True)
+
+    async def go_offline(self):
+        # friends only hear about the first socket opening and the last one closing
+        if get_presence_backend().disconnect(self.user_obj.id, self.channel_name):
+            await self.notify_user_friends(False)
+
+    async def websocket_receive(self, message):
+        get_presence_backend().heartbeat(self.channel_name)
+        await super().websocket_receive(message)
+
+    async def presence_expired(self, event):
+        await self.close()
+
+    async def broadcast(self, chat_id, event, replay=True):
+        # replayable events are logged for every recipient under an id the sockets send along
+        event = {**event, "type": "message.send", "chat_id": chat_id, "time": time.time()}
+        if replay:
+            user_ids = [int(user_id) for user_id in event["recipients"] if int(user_id) != event.get("exclude_user")]
+            event["event_id"] = await database_sync_to_async(get_event_log_backend().append)(user_ids, event)
+        await self.channel_layer.group_send(chat_group(chat_id), event)
+
+    async def replay_events(self, last_event_id):
+        # events logged after last_event_id, or a resync signal when the log no longer has all of them
+        events = await database_sync_to_async(get_event_log_backend().since)(self.user_obj.id, last_event_id)
+        if events is None:
+            return await self.send_data({"action": "resync_required", "time": time.time()})
+
+        for event_id, event in events:
+            if self.follows(event["chat_id"]):
+                self.replayed.add(event_id)
+                await self.send_event({**event, "event_id": event_id})
+
     async def notify_user_friends(self, user_status):
-        user_name = f"user_{self.user_obj.id}"
-        chats = await get_user_chats(self.user_obj)
-        async for chat in chats:
-            chat_obj = await get_chat(chat)
-            chat_name = f"chat_{chat}"
-
-            if chat_name in self.user_group_list:
-                if user_name not in self.user_group_list[chat_name]:
-                    self.user_group_list[chat_name].append(user_name)
-
-                sent = []
-                for user in self.user_group_list[chat_name]:
-                    if user not in sent:
-                        if user != user_name:
-                            data = {
-                                "type": "message.send",
-                                "updated_chat": await serialize_chat(chat_obj, self.user_obj),
-                                "user_status": user_status,
-                                "message": None,
-                                "action": "online_status",
-                            }
-                            sent.append(user)
-                            print(user)
-                            await self.channel_layer.group_send(user, data)
-            else:
-                self.user_group_list[chat_name] = [user_name]
+        # one event per chat group, the user's own sockets skip it in message_send.
+        # status is not replayed, a reconnecting client gets the current one with its chats
+        chats = await serialize_chats(await get_user_chats(self.user_obj), self.user_obj)
+        for chat_id, (chat_data, recipients) in chats.items():
+            await self.broadcast(chat_id, {
+                "updated_chat": chat_data,
+                "recipients": recipients,
+                "user_status": user_status,
+                "message": None,
+                "action": "online_status",
+                "exclude_user": self.user_obj.id,
+            }, replay=False)
+
+    def event_data(self, event):
+        updated_chat = event["updated_chat"]
+        fields = event.get("recipients", {}).get(str(self.user_obj.id))
+        if updated_chat and fields:
+            updated_chat = personalize_chat(updated_chat, fields)
 
-    async def message_send(self, event):
         data = {
-            "updated_chat": event["updated_chat"],
+            "updated_chat": updated_chat,
             "user_status": event["user_status"],
             "message": event["message"],
             "action": event["action"],
-            "time": time.time(),
+            "time": event["time"],
         }
-        await self.send(text_data=json.dumps(data))
+        if "event_id" in event:
+            data["event_id"] = event["event_id"]
+        return data
+
+    async def message_send(self, event):
+        if event.get("exclude_user") == self.user_obj.id or event.get("exclude_channel") == self.channel_name:
+            return
+        # already sent by replay_events while this socket was connecting
+        if event.get("event_id") in self.replayed:
+            return
+
+        await self.send_event(event)
+
+    async def chat_subscription(self, event):
+        if not self.follows(event["chat_id"]):
+            return
+
+        if event["subscribed"]:
+            await self.subscribe([event["chat_id"]])
+        else:
+            await self.unsubscribe([event["chat_id"]])
 
 
 class ChatMessagesConsumer(ChatMessageBaseConsumer):
+    def follows(self, chat_id):
+        return chat_id == self.chat_obj.id
+
     async def connect(self):
         chat_id = self.scope['url_route']['kwargs']['id']
         self.chat_obj = await get_chat(chat_id)
         self.user_obj = self.scope['user']
 
-        if self.chat_obj and self.user_obj:
-            chat_name = f"chat_{chat_id}"
-            user_name = f"user_{self.user_obj.id}"
-
-            if chat_name in self.user_group_list:
-                if user_name not in self.user_group_list[chat_name]:
-                    self.user_group_list[chat_name].append(user_name)
-            else:
-                self.user_group_list[chat_name] = [user_name]
-                await change_online_status(self.user_obj, True)
-
-            await self.channel_layer.group_add(user_name, self.channel_name)
-
-            await self.accept()
+        if self.chat_obj and self.user_obj and await is_chat_member(self.chat_obj, self.user_obj):
+            await self.channel_layer.group_add(user_group(self.user_obj.id), self.channel_name)
+            await self.subscribe([self.chat_obj.id])
+            await self.accept_protocol()
+            await self.go_online()
+            await self.resume()
+        else:
+            await self.close()
 
     async def receive(self, text_data=None, bytes_data=None):
         try:
-            text_data = json.loads(text_data)
+            text_data = self.protocol.decode(text_data, bytes_data)
         except Exception as e:
             return e
 
-        chat_data = await serialize_chat(self.chat_obj, self.user_obj)
+        # a member who left still has the socket open but no longer reaches the group
+        if not self.chat_groups or text_data.get("action") == "heartbeat":
+            return
 
-        data = {
-            "type": "message.send",
+        if text_data.get("action") == "send_message":
+            return await self.send_message(text_data)
+
+        chat_data, recipients = (await serialize_chats([self.chat_obj.id], self.user_obj))[self.chat_obj.id]
+
+        await self.broadcast(self.chat_obj.id, {
             "updated_chat": chat_data,
-            "user_status": await get_user_profile(self.user_obj),
+            "recipients": recipients,
+            "user_status": get_presence_backend().is_online(self.user_obj.id),
             "message": text_data.get("message", None),
             "action": text_data.get("action", "no_action"),
-        }
+            "relayed": True,
+        })
 
-        chat_name = f"chat_{self.chat_obj.id}"
-        if chat_name in self.user_group_list:
-            for user in self.user_group_list[chat_name]:
-                await self.channel_layer.group_send(user, data)
+    async def send_message(self, text_data):
+        # the sender gets an ack on this socket, every other socket of the chat the new message
+        try:
+            message, created = await persist_message(self.user_obj, self.chat_obj, text_data)
+        except ValidationError as e:
+            details = e.detail.get("details", e.detail) if isinstance(e.detail, dict) else e.detail
+            return await self.send_data({
+                "action": "error",
+                "client_id": text_data.get("client_id"),
+                "details": details,
+                "time": time.time(),
+            })
+
+        await self.send_data({
+            "action": "ack",
+            "client_id": message["client_id"],
+            "message": message,
+            "created": created,
+            "time": time.time(),
+        })
+
+        if not created:
+            return
+
+        chat_data, recipients = (await serialize_chats([self.chat_obj.id], self.user_obj))[self.chat_obj.id]
+        await self.broadcast(self.chat_obj.id, {
+            "updated_chat": chat_data,
+            "recipients": recipients,
+            "user_status": True,
+            "message": message,
+            "action": "new_message",
+            "exclude_channel": self.channel_name,
+        })
 
     async def disconnect(self, code):
         if self.user_obj:
-            await change_online_status(self.user_obj, False)
-            await self.channel_layer.group_discard(f"user_{self.user_obj.id}", self.channel_name)
+            await self.go_offline()
+            await self.unsubscribe_all()
 
 
 class ChatConsumer(ChatMessageBaseConsumer):
@@ -144,14 +326,13 @@ class ChatConsumer(ChatMessageBaseConsumer):
         self.user_obj = self.scope['user']
 
         if self.user_obj:
-            await self.notify_user_friends(True)
-            user_name = f"user_{self.user_obj.id}"
-            await change_online_status(self.user_obj, True)
-            await self.channel_layer.group_add(user_name, self.channel_name)
-            await self.accept()
+            await self.channel_layer.group_add(user_group(self.user_obj.id), self.channel_name)
+            await self.subscribe(await get_user_chats(self.user_obj))
+            await self.accept_protocol()
+            await self.go_online()
+            await self.resume()
 
     async def disconnect(self, code):
         if self.user_obj:
-            await self.notify_user_friends(False)
-            await change_online_status(self.user_obj, False)
-            await self.channel_layer.group_discard(f"user_{self.user_obj.id}", self.channel_name)
+            await self.go_offline()
+            await self.unsubscribe_all()
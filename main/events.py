@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import deque
+from datetime import timedelta
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+class BaseEventLogBackend:
+    def append(self, user_ids, event):
+        # stores event for every user and returns its id, ids only grow
+        raise NotImplementedError
+
+    def since(self, user_id, last_event_id):
+        # [(event id, event)] after last_event_id, None when some of them are no longer kept
+        raise NotImplementedError
+
+    def clear(self):
+        pass
+
+
+class MemoryEventLogBackend(BaseEventLogBackend):
+    # process local and bounded per user, like the memory presence store. Only correct when every socket
+    # lives in one process, which is what the in-memory channel layer guarantees
+    single_process_layer = "channels.layers.InMemoryChannelLayer"
+
+    def __init__(self, size=None):
+        layer = settings.CHANNEL_LAYERS.get("default", {}).get("BACKEND")
+        if layer != self.single_process_layer:
+            raise ImproperlyConfigured(f"{type(self).__name__} keeps the events of one process and can't run with "
+                                       f"{layer}, set EVENT_LOG_BACKEND to main.events.DatabaseEventLogBackend.")
+
+        self.size = size or settings.EVENT_LOG_SIZE
+        self.lock = threading.Lock()
+        # ids continue from the clock, ids handed out by an earlier process are always older
+        self.first_id = self.last_id = time.time_ns() // 1000
+        self.logs = {}
+        self.dropped = {}
+
+    def append(self, user_ids, event):
+        with self.lock:
+            self.last_id += 1
+            for user_id in user_ids:
+                log = self.logs.setdefault(user_id, deque())
+                if len(log) >= self.size:
+                    self.dropped[user_id] = log.popleft()[0]
+                log.append((self.last_id, event))
+            return self.last_id
+
+    def since(self, user_id, last_event_id):
+        with self.lock:
+            # events up to the horizon may have existed for the user but are gone
+            horizon = max(self.first_id, self.dropped.get(user_id, 0))
+            if last_event_id < horizon or last_event_id > self.last_id:
+                return None
+            return [(event_id, event) for event_id, event in self.logs.get(user_id, ()) if event_id > last_event_id]
+
+    def clear(self):
+        with self.lock:
+            self.logs.clear()
+            self.dropped.clear()
+
+
+class DatabaseEventLogBackend(BaseEventLogBackend):
+    # one row per event in a table every worker shares, rows older than EVENT_LOG_RETENTION seconds are swept
+    sweep_interval = 60
+
+    def __init__(self, size=None):
+        self.size = size or settings.EVENT_LOG_SIZE
+        self.next_sweep = 0
+
+    def sweep(self):
+        from main.models import SocketEvent
+
+        if time.monotonic() < self.next_sweep:
+            return
+        self.next_sweep = time.monotonic() + self.sweep_interval
+        SocketEvent.objects.filter(
+            created_at__lt=timezone.now() - timedelta(seconds=settings.EVENT_LOG_RETENTION)).delete()
+
+    def append(self, user_ids, event):
+        from main.models import SocketEvent
+
+        self.sweep()
+        return SocketEvent.objects.create(chat_id=event["chat_id"], user_ids=user_ids, event=event).id
+
+    def since(self, user_id, last_event_id):
+        from main.models import ChatMember, SocketEvent
+
+        # a first kept id past last_event_id + 1 means events in between may have been swept
+        ids = SocketEvent.objects.aggregate(first=Min("id"), last=Max("id"))
+        if ids["last"] is None or last_event_id > ids["last"] or last_event_id + 1 < ids["first"]:
+            return None
+
+        chat_ids = ChatMember.objects.filter(member_id=user_id).values("chat_id")
+        rows = SocketEvent.objects.filter(chat_id__in=chat_ids, id__gt=last_event_id).order_by("id") \
+            .values_list("id", "user_ids", "event")
+
+        events = []
+        for event_id, user_ids, event in rows.iterator():
+            if user_id in user_ids:
+                # more than a socket would have kept, the client refetches instead
+                if len(events) >= self.size:
+                    return None
+                events.append((event_id, event))
+        return events
+
+    def clear(self):
+        from main.models import SocketEvent
+
+        SocketEvent.objects.all().delete()
+
+
+@lru_cache(maxsize=None)
+def get_event_log_backend():
+    return import_string(settings.EVENT_LOG_BACKEND)()
@@ -0,0 +1,227 @@
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, connection
+
+from main.models import Profile, Group, Chat, ChatMember, Message, MessageController
+from main.search import get_search_backend
+
+WORDS = ("hello", "world", "meeting", "tomorrow", "photo", "video", "lunch", "project", "deadline", "coffee",
+         "weekend", "travel", "ticket", "budget", "release", "server", "python", "django", "socket", "invoice")
+
+RARE_WORDS = ("quokka", "axolotl", "narwhal", "pangolin")
+
+BENCH_PASSWORD = "bench-pass"
+
+
+class Rollback(Exception):
+    pass
+
+
+def seed_users(count, prefix="bench", batch_size=5000, index=True):
+    # one hash for every seeded user, hashing is the slow part of creating users
+    password = make_password(BENCH_PASSWORD)
+    backend = get_search_backend()
+    users = []
+
+    for start in range(0, count, batch_size):
+        batch = User.objects.bulk_create([
+            User(username=f"{prefix}_{i}", first_name=f"{prefix}{i}", last_name=random.choice(WORDS),
+                 email=f"{prefix}_{i}@example.com", password=password)
+            for i in range(start, min(count, start + batch_size))
+        ])
+        profiles = Profile.objects.bulk_create([
+            Profile(user=user, phone_number=f"9{user.id:09d}"[-10:]) for user in batch
+        ])
+
+        if index:
+            backend.index_users([(profile.user, profile.phone_number) for profile in profiles])
+        users += batch
+
+    return users
+
+
+def seed_chats(users, count, members_per_chat=2, group_ratio=0.3, batch_size=5000, owner=None):
+    # returns {chat_id: [member ids]}, owner is a member of every chat when given
+    groups_count = int(count * group_ratio)
+    groups = Group.objects.bulk_create([
+        Group(name=f"{random.choice(WORDS)} group {i}", invite_link=f"bench-{i}-{random.random()}")
+        for i in range(groups_count)
+    ], batch_size=batch_size)
+
+    chats = Chat.objects.bulk_create([Chat(group=group) for group in groups] +
+                                     [Chat() for _ in range(count - groups_count)], batch_size=batch_size)
+
+    chat_members = {}
+    rows = []
+    for chat in chats:
+        size = members_per_chat if chat.group_id else 2
+        members = random.sample(users, min(size, len(users)))
+        if owner:
+            members = [owner] + [user for user in members if user != owner][:size - 1]
+        chat_members[chat.id] = [user.id for user in members]
+        rows += [ChatMember(chat=chat, member=user) for user in members]
+
+    ChatMember.objects.bulk_create(rows, batch_size=batch_size)
+    return chat_members
+
+
+def seed_messages(chat_members, count, batch_size=5000, index=True):
+    # spreads count text messages over the given chats, skipping the signal based write path
+    chat_ids = list(chat_members)
+    backend = get_search_backend()
+
+    for start in range(0, count, batch_size):
+        messages = []
+        for _ in range(min(batch_size, count - start)):
+            chat_id = random.choice(chat_ids)
+            text = " ".join(random.choices(WORDS, k=random.randint(3, 12)))
+            if random.random() < 0.001:
+                text += " " + random.choice(RARE_WORDS)
+            messages.append(Message(chat_id=chat_id, author_id=random.choice(chat_members[chat_id]), text=text))
+
+        messages = Message.objects.bulk_create(messages)
+        controllers = MessageController.objects.bulk_create([
+            MessageController(message=message, chat_id=message.chat_id, author_id=message.author_id)
+            for message in messages
+        ])
+
+        if index:
+            rows = [(controller, controller.message.text) for controller in controllers]
+            backend.index_messages(rows, replace=False)
+
+    for chat_id in chat_ids:
+        ChatMember.objects.rebuild_inbox(chat_id)
+
+
+@contextmanager
+def temporary_database():
+    # a migrated throwaway database file, for benchmarks that use several connections
+    old_name = connection.settings_dict["NAME"]
+    with tempfile.TemporaryDirectory() as directory:
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "bench.sqlite3")
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def count_queries(func):
+    count = 0
+
+    def counter(execute, sql, params, many, context):
+        nonlocal count
+        count += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(counter):
+        func()
+    return count
+
+
+def summarize(timings):
+    # timings in ms
+    timings = sorted(timings)
+    return {
+        "runs": len(timings),
+        "mean_ms": round(statistics.mean(timings), 3),
+        "p50_ms": round(timings[len(timings) // 2], 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+    }
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return summarize(timings)
+
+
+def compare(results, baseline, metrics, tolerance):
+    # [(name, metric, baseline value, value)] of every metric that grew past what it is allowed to,
+    # metrics maps a metric to its allowed relative growth, None for the --tolerance given
+    regressions = []
+    for name, result in results.items():
+        for metric, allowed in metrics.items():
+            old, new = baseline.get(name, {}).get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + (tolerance if allowed is None else allowed)):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+class BenchmarkCommand(BaseCommand):
+    # seeded data lives in a transaction that is rolled back unless --keep is given,
+    # or in a temporary database when the benchmark needs more than one connection
+    isolated_database = False
+    # metrics checked against --baseline, see compare()
+    regression_metrics = {}
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--keep", action="store_true", help="Keep the seeded data.")
+        parser.add_argument("--json", dest="json_path", help="Write the results to this file.")
+        parser.add_argument("--baseline", help="Fail when results regress against this --json report.")
+        parser.add_argument("--tolerance", type=float, default=0.5,
+                            help="Allowed relative growth of timing and memory metrics against the baseline.")
+
+    def run(self, **options):
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        results = {}
+
+        if self.isolated_database:
+            with temporary_database():
+                results = self.run(**options)
+        else:
+            try:
+                with transaction.atomic():
+                    get_search_backend().setup()
+                    results = self.run(**options)
+                    if not options["keep"]:
+                        raise Rollback
+            except Rollback:
+                pass
+
+        for name, result in results.items():
+            values = "  ".join(f"{key}={value}" for key, value in result.items())
+            self.stdout.write(f"{name:<40} {values}")
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as file:
+                json.dump(results, file, indent=2, sort_keys=True)
+
+        if options["baseline"]:
+            self.check_baseline(results, options["baseline"], options["tolerance"])
+
+    def check_baseline(self, results, path, tolerance):
+        with open(path) as file:
+            baseline = json.load(file)
+
+        for name in sorted(set(baseline) ^ set(results)):
+            self.stdout.write(f"{name:<40} {'new' if name in results else 'missing'}")
+
+        regressions = compare(results, baseline, self.regression_metrics, tolerance)
+        for name, metric, old, new in regressions:
+            change = f"+{(new - old) / old:.0%}" if old else "new"
+            self.stdout.write(self.style.ERROR(f"{name:<40} {metric} {old} -> {new} ({change})"))
+
+        if regressions:
+            raise CommandError(f"{len(regressions)} regressions against {path}.")
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {path}."))
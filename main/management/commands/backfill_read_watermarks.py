@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery, Max, Exists
+from django.db.models.functions import Greatest
+
+from main.models import ChatMember, SeenUser
+
+
+class Command(BaseCommand):
+    help = "Fill ChatMember.last_read_id from existing SeenUser rows."
+
+    def handle(self, *args, **options):
+        seen = SeenUser.objects.filter(user=OuterRef("member"), message__chat=OuterRef("chat"))
+        last_seen = seen.order_by().values("user").annotate(last=Max("message_id")).values("last")[:1]
+
+        count = ChatMember.objects.filter(Exists(seen)) \
+            .update(last_read_id=Greatest("last_read_id", Subquery(last_seen)))
+
+        self.stdout.write(self.style.SUCCESS(f"Updated read watermarks of {count} chat members."))
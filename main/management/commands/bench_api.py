@@ -0,0 +1,215 @@
+import itertools
+import os
+import tempfile
+import time
+import tracemalloc
+
+from django.core.files.base import ContentFile
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from main.api.paginations.custom import MessageCursorPagination
+from main.management.commands._bench import (BENCH_PASSWORD, BenchmarkCommand, count_queries, seed_chats,
+                                             seed_messages, seed_users, summarize)
+from main.models import BlockedUser, Chat, ChatMember, Message, UploadSession, Video
+from main.sync import collect_changes
+from main.uploads import append_chunk
+from main.urls import urlpatterns
+
+UPLOAD_SIZE = 64 * 1024
+
+
+def drain(response):
+    # file responses are read to the end, the way a server would send them
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    response.close()
+    return response
+
+
+class Command(BenchmarkCommand):
+    help = "Query count, p50/p95 latency and allocated memory of every REST endpoint over a seeded dataset."
+    isolated_database = True
+    # query counts are exact, any extra query is a regression
+    regression_metrics = {"queries": 0, "p50_ms": None, "p95_ms": None, "alloc_kb": None}
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--users", type=int, default=5000)
+        parser.add_argument("--chats", type=int, default=5000)
+        parser.add_argument("--messages", type=int, default=1000000)
+        parser.add_argument("--inbox-chats", type=int, default=200, help="Chats of the benchmarked user.")
+        parser.add_argument("--group-size", type=int, default=20)
+        parser.add_argument("--only", help="Comma separated endpoint names to run.")
+
+    def seed(self, options):
+        # one commit for the whole dataset, the temporary database would sync every statement otherwise
+        with transaction.atomic():
+            users = seed_users(options["users"])
+            viewer = users[0]
+            chat_members = seed_chats(users, options["chats"], members_per_chat=options["group_size"])
+            inbox = seed_chats(users, options["inbox_chats"], members_per_chat=options["group_size"], owner=viewer)
+            seed_messages({**chat_members, **inbox}, options["messages"])
+
+        chats = Chat.objects.filter(id__in=inbox).select_related("group").order_by("id")
+        private = next(chat for chat in chats if not chat.group_id)
+        # join and leave run on a group of their own, the others always see the viewer as a member
+        group, club = [chat for chat in chats if chat.group_id][:2]
+        peer_id = next(member for member in inbox[private.id] if member != viewer.id)
+        return viewer, users, private, group, club, next(user for user in users if user.id == peer_id)
+
+    def endpoints(self, viewer, users, private, group, club, peer):
+        # {name: (route name, setup, request)}, setup runs before every request and is not measured
+        client = APIClient(SERVER_NAME="localhost")
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {Token.objects.create(user=viewer).key}")
+        anonymous = APIClient(SERVER_NAME="localhost")
+        counter = itertools.count()
+        state = {}
+
+        video = Video.objects.create_message(private.id, viewer, video=ContentFile(os.urandom(UPLOAD_SIZE),
+                                                                                   name="clip.mp4"))
+        cursor = collect_changes(viewer, {})["cursor"]
+        stranger = users[-1]
+
+        def new_session(offset=0):
+            session = UploadSession.objects.create(owner=viewer, chat=private, kind="video", file_name="clip.mp4",
+                                                   size=UPLOAD_SIZE)
+            if offset:
+                append_chunk(session, 0, ContentFile(os.urandom(offset)), offset)
+            state["session"] = session
+
+        def peer_message():
+            state["message"] = Message.objects.create_message(private.id, peer, text=f"read me {next(counter)}")
+
+        def own_message():
+            state["message"] = Message.objects.create_message(private.id, viewer, text=f"delete me {next(counter)}")
+
+        def set_membership(is_deleted):
+            return lambda: ChatMember.objects.filter(chat=club, member=viewer).update(is_deleted=is_deleted)
+
+        def set_block(is_deleted):
+            return lambda: BlockedUser.objects.update_or_create(blocked_by=viewer.profile, user=stranger.profile,
+                                                                defaults={"is_deleted": is_deleted})
+
+        def upload_init():
+            return client.post(reverse("upload-init"), {"type": "video", "chat_id": private.id,
+                                                        "file_name": "clip.mp4", "size": UPLOAD_SIZE}, format="json")
+
+        def create_account():
+            n = next(counter)
+            return anonymous.post(reverse("create-account"), {
+                "username": f"new_{n}", "first_name": "new", "email": f"new_{n}@example.com",
+                "phone_number": f"8{n:09d}", "password": BENCH_PASSWORD,
+            }, format="json")
+
+        return {
+            "auth-info": ("auth-info", None, lambda: client.get(reverse("auth-info"))),
+            "login": ("login", None, lambda: anonymous.post(reverse("login"), {
+                "username": viewer.username, "password": BENCH_PASSWORD}, format="json")),
+            "create-account": ("create-account", None, create_account),
+            "create-group": ("create-group", None, lambda: client.post(reverse("create-group"), {
+                "name": "bench group", "invite_link": f"new-{next(counter)}"}, format="json")),
+            "create-chat": ("create-chat", None, lambda: client.post(reverse("create-chat"),
+                                                                     {"start_with": peer.id}, format="json")),
+            "get-all-chats": ("get-all-chats", None, lambda: client.get(reverse("get-all-chats"))),
+            "sync full": ("sync", None, lambda: client.get(reverse("sync"))),
+            "sync delta": ("sync", None, lambda: client.post(reverse("sync"), {"cursor": cursor}, format="json")),
+            "get-chats-details": ("get-chats-details", None,
+                                  lambda: client.get(reverse("get-chats-details", args=[private.id]))),
+            "join-chat": ("join-chat", set_membership(True), lambda: client.post(
+                reverse("join-chat"), {"group_url": club.group.invite_link}, format="json")),
+            "leave-chat": ("leave-chat", set_membership(False),
+                           lambda: client.post(reverse("leave-chat", args=[club.id]))),
+            "get-messages": ("get-messages", None, lambda: client.get(reverse("get-messages", args=[group.id]))),
+            "get-messages cursor": ("get-messages", None, lambda: client.get(
+                reverse("get-messages", args=[group.id]), {"before": state["before"]})),
+            "get-messages content": ("get-messages", None, lambda: client.get(
+                reverse("get-messages", args=[group.id]), {"content": "coffee"})),
+            "get-members": ("get-members", None, lambda: client.get(reverse("get-members", args=[group.id]))),
+            "create-message": ("create-message", None, lambda: client.post(
+                reverse("create-message", args=[private.id]), {"type": "message", "text": "hello"}, format="json")),
+            "mark-read-message": ("mark-read-message", peer_message, lambda: client.post(
+                reverse("mark-read-message", args=[private.id]),
+                {"type": "message", "message_id": state["message"].id}, format="json")),
+            "delete-message": ("delete-message", own_message, lambda: client.post(
+                reverse("delete-message", args=[private.id]),
+                {"type": "message", "message_id": state["message"].id, "for_everyone": True}, format="json")),
+            "search-messages": ("search-messages", None, lambda: client.get(reverse("search-messages"),
+                                                                            {"q": "coffee"})),
+            "media": ("media", None, lambda: drain(client.get(reverse("media", args=["video", video.id])))),
+            "media range": ("media", None, lambda: drain(client.get(reverse("media", args=["video", video.id]),
+                                                                    headers={"Range": "bytes=0-1023"}))),
+            "upload-init": ("upload-init", None, upload_init),
+            "upload-details": ("upload-details", new_session, lambda: client.get(
+                reverse("upload-details", args=[state["session"].id]))),
+            "upload-chunk": ("upload-chunk", new_session, lambda: client.post(
+                f"{reverse('upload-chunk', args=[state['session'].id])}?offset=0", os.urandom(UPLOAD_SIZE),
+                content_type="application/octet-stream")),
+            "upload-finalize": ("upload-finalize", lambda: new_session(UPLOAD_SIZE), lambda: client.post(
+                reverse("upload-finalize", args=[state["session"].id]))),
+            "get-users-list": ("get-users-list", None, lambda: client.get(reverse("get-users-list"),
+                                                                          {"q": "bench"})),
+            "get-user-details": ("get-user-details", None,
+                                 lambda: client.get(reverse("get-user-details", args=[peer.id]))),
+            "block-user": ("block-user", set_block(True),
+                           lambda: client.post(reverse("block-user", args=[stranger.id]))),
+            "unblock-user": ("unblock-user", set_block(False),
+                             lambda: client.post(reverse("unblock-user", args=[stranger.id]))),
+        }, state
+
+    def measure_endpoint(self, name, setup, request, repeat):
+        def call():
+            response = request()
+            if response.status_code >= 400:
+                raise CommandError(f"{name} answered {response.status_code}: {response.content[:200]!r}")
+            return response
+
+        # queries and allocations from a traced run, tracing would distort the timed ones
+        if setup:
+            setup()
+        tracemalloc.start()
+        queries = count_queries(call)
+        alloc = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        timings = []
+        for _ in range(repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - start) * 1000)
+
+        return {"queries": queries, **summarize(timings), "alloc_kb": round(alloc / 1024, 1)}
+
+    def run(self, **options):
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+                MEDIA_ROOT=directory, UPLOAD_TEMP_DIR=os.path.join(directory, "uploads"), THUMBNAIL_WORKERS=0):
+            started = time.perf_counter()
+            seeded = self.seed(options)
+            # reports of different datasets are not comparable, the sizes travel with the results
+            results = {"dataset": {key: options[key] for key in ("users", "chats", "messages", "inbox_chats",
+                                                                  "group_size")}}
+            results["dataset"]["seed_sec"] = round(time.perf_counter() - started, 1)
+
+            endpoints, state = self.endpoints(*seeded)
+            group = seeded[3]
+            # second page of the group history
+            messages = group.chat_messagecontrollers.order_by("-created_at", "-id")[:21]
+            state["before"] = MessageCursorPagination().encode_cursor(list(messages)[-1])
+
+            # a new route fails the benchmark until it is measured here
+            missing = {pattern.name for pattern in urlpatterns} - {route for route, _, _ in endpoints.values()}
+            if missing:
+                raise CommandError(f"Routes without a benchmark: {', '.join(sorted(missing))}")
+
+            names = options["only"].split(",") if options["only"] else endpoints
+            for name in names:
+                _, setup, request = endpoints[name]
+                results[name] = self.measure_endpoint(name, setup, request, options["repeat"])
+            return results
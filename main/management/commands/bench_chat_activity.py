@@ -0,0 +1,75 @@
+import threading
+import time
+
+from django.db import connection, connections, OperationalError
+from django.test.utils import override_settings
+
+from main.management.commands._bench import BenchmarkCommand, seed_users, seed_chats
+from main.managers.managers import recent_chat_touches
+from main.models import Message
+
+
+class Command(BenchmarkCommand):
+    help = "Burst messages into one group from several threads and compare chat activity windows."
+    isolated_database = True
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--messages", type=int, default=200, help="Messages per thread.")
+        parser.add_argument("--members", type=int, default=50)
+        parser.add_argument("--windows", default="0,5", help="Comma separated CHAT_ACTIVITY_WINDOW values.")
+
+    def burst(self, chat_id, authors, count, stats):
+        chat_writes = errors = 0
+
+        def counter(execute, sql, params, many, context):
+            nonlocal chat_writes
+            if sql.startswith('UPDATE "main_chat" '):
+                chat_writes += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(counter):
+            for i in range(count):
+                try:
+                    Message.objects.create_message(chat_id, authors[i % len(authors)], text=f"burst {i}")
+                except OperationalError:
+                    errors += 1
+
+        connection.close()
+        with stats["lock"]:
+            stats["chat_writes"] += chat_writes
+            stats["errors"] += errors
+
+    def run(self, **options):
+        users = seed_users(options["members"], prefix="burst", index=False)
+        chat_id = next(iter(seed_chats(users, 1, members_per_chat=options["members"], group_ratio=1)))
+        connections.close_all()
+
+        results = {}
+        for window in options["windows"].split(","):
+            recent_chat_touches.clear()
+            stats = {"lock": threading.Lock(), "chat_writes": 0, "errors": 0}
+
+            with override_settings(CHAT_ACTIVITY_WINDOW=int(window)):
+                threads = [threading.Thread(target=self.burst,
+                                            args=(chat_id, users[i::options["threads"]], options["messages"], stats))
+                           for i in range(options["threads"])]
+
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+
+            total = options["threads"] * options["messages"]
+            results[f"window={window}s"] = {
+                "messages": total,
+                "seconds": round(elapsed, 3),
+                "messages_per_sec": round(total / elapsed, 1),
+                "chat_row_writes": stats["chat_writes"],
+                "locked_errors": stats["errors"],
+            }
+
+        return results
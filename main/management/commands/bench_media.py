@@ -0,0 +1,66 @@
+import os
+import tempfile
+import time
+
+from django.core.files.base import ContentFile
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from main.management.commands._bench import BenchmarkCommand, seed_chats, seed_users
+from main.models import Video
+
+
+class Command(BenchmarkCommand):
+    help = "Measure media delivery throughput and CPU cost, whole files, byte ranges and sendfile."
+    isolated_database = True
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--size-mb", type=int, default=64)
+        parser.add_argument("--range-kb", type=int, default=1024)
+
+    def download(self, client, url, repeat, **headers):
+        # drains the response the way a WSGI or ASGI server would, without a socket in the way
+        received = 0
+        wall, cpu = time.perf_counter(), time.process_time()
+        for _ in range(repeat):
+            response = client.get(url, headers=headers)
+            for block in (response.streaming_content if response.streaming else [response.content]):
+                received += len(block)
+            response.close()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+        gigabytes = received / 1024 ** 3
+        return {
+            "requests": repeat,
+            "mb_sent_by_python": round(received / 1024 ** 2, 1),
+            "requests_per_sec": round(repeat / wall, 1),
+            "mb_per_sec": round(received / 1024 ** 2 / wall, 1) if received else 0,
+            "cpu_sec_per_gb": round(cpu / gigabytes, 3) if received else 0,
+            "cpu_ms_per_request": round(cpu / repeat * 1000, 3),
+        }
+
+    def run(self, **options):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(MEDIA_ROOT=directory, MEDIA_SENDFILE=None):
+            owner, friend = seed_users(2, prefix="media", index=False)
+            chat_id = next(iter(seed_chats([owner, friend], 1, group_ratio=0, owner=owner)))
+            video = Video.objects.create_message(chat_id, owner, video=ContentFile(
+                os.urandom(options["size_mb"] * 1024 * 1024), name="clip.mp4"))
+
+            client = APIClient(SERVER_NAME="localhost")
+            client.force_authenticate(friend)
+            url = reverse("media", args=["video", video.id])
+            range_end = options["range_kb"] * 1024 - 1
+
+            results = {
+                f"whole file {options['size_mb']}MB": self.download(client, url, max(1, options["repeat"] // 4)),
+                f"range {options['range_kb']}KB": self.download(client, url, options["repeat"],
+                                                                Range=f"bytes=0-{range_end}"),
+                "revalidation 304": self.download(client, url, options["repeat"],
+                                                  If_None_Match=f'"{video.video.storage.digest(video.video.name)}"'),
+            }
+            with override_settings(MEDIA_SENDFILE="x-accel"):
+                results["x-accel-redirect"] = self.download(client, url, options["repeat"])
+            return results
@@ -0,0 +1,40 @@
+from django.db.models import Count
+
+from main.management.commands._bench import BenchmarkCommand, seed_users, seed_chats, seed_messages, measure
+from main.models import Chat, ChatMember, MessageController
+from main.search import LikeSearchBackend, SqliteSearchBackend
+
+
+class Command(BenchmarkCommand):
+    help = "Compare the FTS5 message search index with the LIKE search on a seeded dataset."
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--messages", type=int, default=1000000)
+        parser.add_argument("--chats", type=int, default=50)
+        parser.add_argument("--users", type=int, default=200)
+
+    def run(self, **options):
+        users = seed_users(options["users"], prefix="search_bench")
+        chat_members = seed_chats(users, options["chats"], members_per_chat=20)
+        seed_messages(chat_members, options["messages"])
+
+        chat = Chat.objects.filter(id__in=chat_members).annotate(size=Count("chat_messagecontrollers")) \
+            .order_by("-size").first()
+        user = ChatMember.objects.filter(chat=chat).first().member
+        messages = chat.get_messages(user)
+
+        backends = {"like": LikeSearchBackend(), "fts": SqliteSearchBackend()}
+        results = {}
+
+        for query in ("meeting tomorrow", "deadl", "invoice python", "axolotl"):
+            for name, backend in backends.items():
+                found = backend.filter_messages(messages, query)
+                results[f"{name} first page '{query}'"] = measure(lambda: list(found[:20]), options["repeat"])
+                results[f"{name} count '{query}'"] = measure(found.count, options["repeat"])
+
+            for name, backend in backends.items():
+                found = backend.filter_messages(MessageController.filtered_objects.all(), query, list(chat_members))
+                results[f"{name} all chats '{query}'"] = measure(lambda: list(found[:20]), options["repeat"])
+
+        return results
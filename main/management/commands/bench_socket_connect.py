@@ -0,0 +1,59 @@
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+from main.api.serializers.allMessages import ChatSerializer
+from main.management.commands._bench import BenchmarkCommand, seed_users, seed_chats, seed_messages, \
+    count_queries, measure
+from main.models import Chat, ChatMember
+from main.ws_urls import URL_PATTERNS
+
+
+class Command(BenchmarkCommand):
+    help = "Measure the chat list socket connect and disconnect cost for a user with many chats."
+    isolated_database = True
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--chats", type=int, default=500)
+        parser.add_argument("--users", type=int, default=300)
+        parser.add_argument("--members", type=int, default=20, help="Members per group chat.")
+        parser.add_argument("--messages", type=int, default=20000)
+
+    def connect_cycle(self, user):
+        @async_to_sync
+        async def cycle():
+            communicator = WebsocketCommunicator(URLRouter(URL_PATTERNS), "/ws/chat/")
+            communicator.scope["user"] = user
+            await communicator.connect()
+            await communicator.disconnect()
+
+        cycle()
+
+    def serialize_each(self, user, chat_ids):
+        # the previous notification path, one full ChatSerializer pass per chat
+        for chat in Chat.objects.filter(id__in=chat_ids):
+            ChatSerializer(chat, context={"user": user}).data
+
+    def run(self, **options):
+        users = seed_users(options["users"], prefix="socket_bench", index=False)
+        user, others = users[0], users[1:]
+
+        chat_members = seed_chats(others, options["chats"], members_per_chat=options["members"], owner=user)
+        seed_messages(chat_members, options["messages"], index=False)
+
+        chat_ids = list(ChatMember.filtered_objects.filter(member=user).values_list("chat_id", flat=True))
+        results = {}
+
+        results["connect + disconnect"] = {
+            "chats": len(chat_ids),
+            "queries": count_queries(lambda: self.connect_cycle(user)),
+            **measure(lambda: self.connect_cycle(user), options["repeat"]),
+        }
+        results["serialize each chat (previous path)"] = {
+            "chats": len(chat_ids),
+            "queries": count_queries(lambda: self.serialize_each(user, chat_ids)),
+            **measure(lambda: self.serialize_each(user, chat_ids), max(1, options["repeat"] // 5)),
+        }
+
+        return results
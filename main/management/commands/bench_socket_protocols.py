@@ -0,0 +1,88 @@
+import json
+import time
+from datetime import datetime
+
+from main.api.serializers.allMessages import ChatSerializer
+from main.consumers import build_chat_payloads, personalize_chat
+from main.management.commands._bench import BenchmarkCommand, seed_users, seed_chats, seed_messages, measure
+from main.models import Chat, ChatMember
+from main.protocols import PROTOCOLS
+
+
+def convert_datetime_to_strings(data):
+    # the tree walk the socket path used before every json.dumps
+    if isinstance(data, list):
+        return [convert_datetime_to_strings(item) for item in data]
+    elif isinstance(data, dict):
+        return {key: convert_datetime_to_strings(value) for key, value in data.items()}
+    elif isinstance(data, datetime):
+        return data.isoformat()
+    return data
+
+
+class Command(BenchmarkCommand):
+    help = "Compare frame size and encode time of the socket protocols for typical chat update events."
+    isolated_database = True
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--members", type=int, default=20, help="Members of the group chat.")
+        parser.add_argument("--frames", type=int, default=1000, help="Frames encoded per run.")
+
+    def frames(self, user, chat):
+        # a new message in a group with readers, and an online status change in a private chat
+        chats = build_chat_payloads([chat.id for chat in chat], user)
+        events = {}
+        for chat_id, (chat_data, recipients) in chats.items():
+            name = "group update" if chat_data["is_group"] else "private status"
+            fields = next(iter(recipients.values()))
+            events[name] = {
+                "updated_chat": personalize_chat(chat_data, fields),
+                "user_status": True,
+                "message": "see you at the meeting tomorrow" if chat_data["is_group"] else None,
+                "action": "new_message" if chat_data["is_group"] else "online_status",
+                "time": time.time(),
+            }
+        return events
+
+    def run(self, **options):
+        users = seed_users(options["members"], prefix="protocol_bench", index=False)
+        user = users[0]
+        group_members = seed_chats(users, 1, members_per_chat=options["members"], group_ratio=1, owner=user)
+        private_members = seed_chats(users, 1, group_ratio=0, owner=user)
+        seed_messages({**group_members, **private_members}, 200, index=False)
+
+        group_id, private_id = next(iter(group_members)), next(iter(private_members))
+        ChatMember.objects.filter(chat_id=group_id).update(last_read_id=10 ** 9)
+
+        chats = list(Chat.objects.filter(id__in=[group_id, private_id]))
+        events = self.frames(user, chats)
+        raw = {chat.id: ChatSerializer(chat, context={"user": user}).data for chat in chats}
+
+        results = {}
+        frames = options["frames"]
+        for name, event in events.items():
+            chat_id = group_id if name == "group update" else private_id
+            legacy_event = {**event, "updated_chat": raw[chat_id]}
+
+            def legacy():
+                for _ in range(frames):
+                    json.dumps(convert_datetime_to_strings(legacy_event))
+
+            results[f"{name} legacy json"] = {
+                "bytes": len(json.dumps(convert_datetime_to_strings(legacy_event)).encode()),
+                **measure(legacy, options["repeat"]),
+            }
+
+            for protocol in PROTOCOLS.values():
+                def encode():
+                    for _ in range(frames):
+                        protocol.encode(event)
+
+                frame = protocol.encode(event)
+                results[f"{name} {protocol.name}"] = {
+                    "bytes": len(frame if protocol.binary else frame.encode()),
+                    **measure(encode, options["repeat"]),
+                }
+
+        return results
@@ -0,0 +1,69 @@
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from main.management.commands._bench import BenchmarkCommand, seed_users, seed_chats, summarize
+from main.ws_urls import URL_PATTERNS
+
+
+class Command(BenchmarkCommand):
+    help = "Compare sending messages through the createMessage endpoint and through the chat socket."
+    isolated_database = True
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--messages", type=int, default=300)
+        parser.add_argument("--members", type=int, default=20)
+
+    def send(self, user, chat_id, count, mode):
+        client = APIClient(SERVER_NAME="localhost")
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {Token.objects.get_or_create(user=user)[0].key}")
+        url = reverse("create-message", args=[chat_id])
+
+        def post(i):
+            response = client.post(url, {"type": "message", "text": f"{mode} {i}"}, format="json")
+            assert response.status_code == 200, response.content
+
+        @async_to_sync
+        async def run():
+            communicator = WebsocketCommunicator(URLRouter(URL_PATTERNS), f"/ws/chat/{chat_id}/")
+            communicator.scope["user"] = user
+            await communicator.connect()
+
+            timings = []
+            start = time.perf_counter()
+            for i in range(count):
+                sent = time.perf_counter()
+                if mode == "socket":
+                    await communicator.send_json_to({"action": "send_message", "client_id": f"c{i}", "text": f"ws {i}"})
+                else:
+                    await sync_to_async(post)(i)
+                    if mode == "rest + relay":
+                        # what clients do today to reach the other members after the POST
+                        await communicator.send_json_to({"action": "new_message", "message": i})
+                if mode != "rest":
+                    await communicator.receive_json_from(timeout=30)
+                timings.append((time.perf_counter() - sent) * 1000)
+
+            elapsed = time.perf_counter() - start
+            await communicator.disconnect()
+            return timings, elapsed
+
+        return run()
+
+    def run(self, **options):
+        users = seed_users(options["members"], prefix="send_bench", index=False)
+        chat_id = next(iter(seed_chats(users, 1, members_per_chat=options["members"], group_ratio=1, owner=users[0])))
+        count = options["messages"]
+
+        results = {}
+        for mode in ("rest", "rest + relay", "socket"):
+            timings, elapsed = self.send(users[0], chat_id, count, mode)
+            results[mode] = {**summarize(timings), "messages_per_sec": round(count / elapsed, 1)}
+
+        return results
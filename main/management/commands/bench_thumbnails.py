@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from PIL import Image
+
+from main.management.commands._bench import BenchmarkCommand
+from main.thumbnails import render_variants
+
+
+def camera_image(path, width, height):
+    # gradients with sensor like noise, compresses like a photo rather than a flat test card
+    noise = Image.effect_noise((width, height), 48)
+    red = Image.linear_gradient("L").resize((width, height))
+    blue = red.rotate(90).resize((width, height))
+    Image.merge("RGB", (red, noise, blue)).save(path, "JPEG", quality=90)
+
+
+class Command(BenchmarkCommand):
+    help = "Measure photo variant rendering throughput, in images per second and per core."
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--images", type=int, default=24)
+        parser.add_argument("--width", type=int, default=3024)
+        parser.add_argument("--height", type=int, default=4032)
+        parser.add_argument("--workers", default=None,
+                            help="Comma separated pool sizes, defaults to 1 and every core.")
+
+    def throughput(self, sources, workers):
+        args = (settings.THUMBNAIL_SIZES, settings.THUMBNAIL_FORMATS, settings.THUMBNAIL_QUALITY)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            # warms the workers up, process start and imports are not part of the steady state
+            list(pool.map(render_variants, sources[:workers], *[[arg] * workers for arg in args]))
+
+            start = time.perf_counter()
+            results = list(pool.map(render_variants, sources, *[[arg] * len(sources) for arg in args]))
+            seconds = time.perf_counter() - start
+
+        encoded = sum(len(content) for result in results
+                      for formats in result["variants"].values() for content, _, _ in formats.values())
+        return {
+            "images": len(sources),
+            "seconds": round(seconds, 3),
+            "images_per_sec": round(len(sources) / seconds, 2),
+            "images_per_sec_per_core": round(len(sources) / seconds / workers, 2),
+            "variant_kb_per_image": round(encoded / len(sources) / 1024, 1),
+        }
+
+    def run(self, **options):
+        cores = os.cpu_count() or 1
+        pool_sizes = [int(size) for size in options["workers"].split(",")] if options["workers"] \
+            else sorted({1, cores})
+
+        with tempfile.TemporaryDirectory() as directory:
+            # a handful of distinct originals, reused so generating them does not dominate the run
+            originals = []
+            for i in range(min(4, options["images"])):
+                path = os.path.join(directory, f"original_{i}.jpg")
+                camera_image(path, options["width"], options["height"])
+                originals.append(path)
+            sources = [originals[i % len(originals)] for i in range(options["images"])]
+
+            results = {}
+            for workers in pool_sizes:
+                results[f"render {options['width']}x{options['height']} workers={workers}"] = \
+                    self.throughput(sources, workers)
+            return results
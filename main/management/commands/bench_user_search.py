@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User
+
+from main.api.genericViews.userVeiw import UserBaseView
+from main.api.serializers.users import UserMoreInfoSerializer
+from main.management.commands._bench import BenchmarkCommand, seed_users, measure, count_queries
+from main.models import BlockedUser, Profile
+
+
+class Command(BenchmarkCommand):
+    help = "Compare the indexed user directory search with the username LIKE search on seeded users."
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--users", type=int, default=1000000)
+        parser.add_argument("--limit", type=int, default=20)
+
+    def run(self, **options):
+        users = seed_users(options["users"], prefix="dir")
+        viewer = users[0]
+        blocked = Profile.objects.filter(user__in=users[1:100]).values_list("id", flat=True)
+        BlockedUser.objects.bulk_create([BlockedUser(user_id=profile_id, blocked_by_id=viewer.profile.id)
+                                         for profile_id in blocked])
+
+        view = UserBaseView()
+        limit = options["limit"]
+        results = {}
+
+        def like_page(query):
+            users = User.objects.filter(username__contains=query).order_by("id")[:limit]
+            return UserMoreInfoSerializer(users, many=True, context={"user": viewer}).data
+
+        def indexed_page(query):
+            users = view.get_search_queryset(query, viewer)[:limit]
+            return UserMoreInfoSerializer(users, many=True, context={"user": viewer}).data
+
+        for query in ("dir_4242", "hello", "912", "di", "zq"):
+            for name, func in (("like", like_page), ("indexed", indexed_page)):
+                result = measure(lambda: func(query), options["repeat"])
+                result["queries"] = count_queries(lambda: func(query))
+                results[f"{name} page '{query}'"] = result
+
+        return results
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from main.models import UploadSession
+from main.uploads import remove_upload
+
+
+class Command(BaseCommand):
+    help = "Delete upload sessions untouched for UPLOAD_SESSION_TTL seconds, and their part files."
+
+    def handle(self, *args, **options):
+        deadline = timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+        sessions = UploadSession.objects.filter(updated_at__lt=deadline)
+
+        count = 0
+        for session in sessions.iterator():
+            remove_upload(session)
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Removed {count} stale upload sessions."))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from main.models import Chat, ChatMember
+
+
+class Command(BaseCommand):
+    help = "Rebuild the inbox columns of every chat member from existing messages."
+
+    def handle(self, *args, **options):
+        count = 0
+        for chat_id in Chat.objects.values_list("id", flat=True).iterator():
+            ChatMember.objects.rebuild_inbox(chat_id)
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt inbox of {count} chats."))
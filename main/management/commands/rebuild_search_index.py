@@ -0,0 +1,54 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import Chat, ChatMember, MessageController
+from main.search import get_search_backend, get_message_text
+
+
+class Command(BaseCommand):
+    help = "Rebuild the message, chat title and user search indexes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        batch_size = options["batch_size"]
+        messages = MessageController.filtered_objects.select_related("message", "photo", "video").order_by("id")
+
+        count = 0
+        with transaction.atomic():
+            backend.setup()
+            backend.clear()
+
+            batch = []
+            for message in messages.iterator(chunk_size=batch_size):
+                batch.append((message, get_message_text(message)))
+                if len(batch) >= batch_size:
+                    backend.index_messages(batch, replace=False)
+                    count += len(batch)
+                    batch = []
+
+            backend.index_messages(batch, replace=False)
+            count += len(batch)
+
+            chat_ids = list(Chat.objects.values_list("id", flat=True))
+            for start in range(0, len(chat_ids), batch_size):
+                ChatMember.objects.refresh_titles(chat_ids[start:start + batch_size])
+
+            users = 0
+            batch = []
+            for user in User.objects.select_related("profile").order_by("id").iterator(chunk_size=batch_size):
+                profile = getattr(user, "profile", None)
+                batch.append((user, profile.phone_number if profile else None))
+                if len(batch) >= batch_size:
+                    backend.index_users(batch)
+                    users += len(batch)
+                    batch = []
+
+            backend.index_users(batch)
+            users += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {count} messages, {len(chat_ids)} chat titles and {users} users."))
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.models import Photo
+from main.thumbnails import get_render_pool, photo_source, render_variants, store_variants
+
+
+class Command(BaseCommand):
+    help = "Render the size variants and placeholders of photos that have none."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Render every photo again.")
+        parser.add_argument("--batch-size", type=int, default=64)
+
+    def render(self, photos):
+        # {photo id: result or exception}, a batch keeps every worker busy
+        args = (settings.THUMBNAIL_SIZES, settings.THUMBNAIL_FORMATS, settings.THUMBNAIL_QUALITY)
+        if not settings.THUMBNAIL_WORKERS:
+            futures = None
+        else:
+            futures = {photo.id: get_render_pool().submit(render_variants, photo_source(photo), *args)
+                       for photo in photos}
+
+        results = {}
+        for photo in photos:
+            try:
+                results[photo.id] = futures[photo.id].result() if futures else \
+                    render_variants(photo_source(photo), *args)
+            except (OSError, ValueError) as e:
+                results[photo.id] = e
+        return results
+
+    def handle(self, *args, **options):
+        photos = Photo.objects.only("id", "image").order_by("id")
+        if not options["all"]:
+            photos = photos.filter(variants={})
+
+        photos = list(photos)
+        count = failed = 0
+        for start in range(0, len(photos), options["batch_size"]):
+            for photo_id, result in self.render(photos[start:start + options["batch_size"]]).items():
+                if isinstance(result, Exception):
+                    failed += 1
+                    self.stderr.write(f"Photo {photo_id}: {result}")
+                else:
+                    store_variants(photo_id, result)
+                    count += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Rendered variants of {count} photos, {failed} failed."))
@@ -0,0 +1,38 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.management.commands._bench import BENCH_PASSWORD, seed_chats, seed_messages, seed_users
+from main.models import ChatMember
+from main.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Seed users, chats, groups and messages for the Locust scenarios of locustfile.py."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--chats", type=int, default=3000)
+        parser.add_argument("--group-size", type=int, default=20)
+        parser.add_argument("--burst-groups", type=int, default=5, help="Big groups for the group-burst mix.")
+        parser.add_argument("--burst-group-size", type=int, default=200)
+        parser.add_argument("--messages", type=int, default=200000)
+        parser.add_argument("--prefix", default="load", help="Username prefix, pass it to locust as --user-prefix.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+
+        with transaction.atomic():
+            get_search_backend().setup()
+            users = seed_users(options["users"], prefix=options["prefix"])
+            chat_members = seed_chats(users, options["chats"], members_per_chat=options["group_size"])
+            chat_members.update(seed_chats(users, options["burst_groups"], group_ratio=1,
+                                           members_per_chat=options["burst_group_size"]))
+            seed_messages(chat_members, options["messages"])
+            # chat titles are what getList and chat search show
+            ChatMember.objects.refresh_titles(list(chat_members))
+
+        self.stdout.write(f"{len(users)} users {options['prefix']}_0 .. {options['prefix']}_{len(users) - 1}, "
+                          f"password {BENCH_PASSWORD}, {len(chat_members)} chats, {options['messages']} messages")
@@ -1,8 +1,21 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
-from django.db.models import Q
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Q, OuterRef, Subquery, Count, Exists, Prefetch
+from django.db.models.functions import Coalesce
 from django.http import Http404
+from django.utils import timezone
+
+from main.presence import get_presence_backend
+from main.search import get_search_backend
+
+
+def count_subquery(queryset, group_by="chat"):
+    queryset = queryset.order_by().values(group_by).annotate(count=Count("pk")).values("count")
+    return Coalesce(Subquery(queryset[:1]), 0)
 
 
 class FilteredManager(models.Manager):
@@ -10,7 +23,78 @@ class FilteredManager(models.Manager):
         return super().get_queryset().filter(is_deleted=False)
 
 
-class ChatManager(models.Manager):
+# chat id -> last updated_at written by this process
+recent_chat_touches = {}
+
+
+class ChatQuerySet(models.QuerySet):
+    def touch(self, chat_id):
+        # coalesced updated_at bump, chat ordering stays correct to within CHAT_ACTIVITY_WINDOW seconds
+        now = timezone.now()
+        window = timedelta(seconds=settings.CHAT_ACTIVITY_WINDOW)
+        last_touch = recent_chat_touches.get(chat_id)
+        if last_touch and now - last_touch < window:
+            return 0
+
+        if len(recent_chat_touches) >= settings.CHAT_ACTIVITY_CACHE_SIZE:
+            recent_chat_touches.clear()
+        recent_chat_touches[chat_id] = now
+
+        return self.filter(id=chat_id, updated_at__lt=now - window).update(updated_at=now)
+
+    def next_seq(self, chat_id, touch=False):
+        # increment and read in one statement, concurrent writers never get the same number and the row lock
+        # keeps the numbers of a chat in commit order, so every change writes the chat row.
+        # message writes pass touch, updated_at rides along on the same row write within the activity window
+        sql = f"UPDATE {connection.ops.quote_name(self.model._meta.db_table)} SET last_seq = last_seq + 1"
+        params = []
+        if touch:
+            now = timezone.now()
+            window = timedelta(seconds=settings.CHAT_ACTIVITY_WINDOW)
+            sql += ", updated_at = CASE WHEN updated_at < %s THEN %s ELSE updated_at END"
+            params += [connection.ops.adapt_datetimefield_value(now - window),
+                       connection.ops.adapt_datetimefield_value(now)]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql + " WHERE id = %s RETURNING last_seq", params + [chat_id])
+            row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def with_user_data(self, user):
+        # load everything ChatSerializer needs for a page of chats in a fixed number of queries
+        from main.models import ChatMember, MessageController
+
+        members = ChatMember.objects.filter(chat=OuterRef("pk"))
+        own_member = members.filter(member=user)
+        unread = MessageController.objects.filter(chat=OuterRef("pk"), is_deleted=False, id__gt=OuterRef("last_read_id")) \
+            .exclude(author=user)
+
+        private_members = ChatMember.objects.filter(chat__group__isnull=True) \
+            .select_related("member").order_by("id")
+        inbox = ChatMember.objects.filter(member=user).select_related("last_message_author")
+        own_last_message = ChatMember.objects.filter(chat=OuterRef("chat"), member=user).values("last_message_id")
+        readers = ChatMember.objects.filter(last_read_id__gte=Subquery(own_last_message[:1])) \
+            .select_related("member").order_by("id")
+
+        return self.select_related("group").annotate(
+            members_count=count_subquery(members.filter(is_deleted=False)),
+            is_joined=Exists(own_member),
+            last_read_id=Coalesce(Subquery(own_member.values("last_read_id")[:1]), 0),
+        ).annotate(
+            unread_count=count_subquery(unread),
+        ).prefetch_related(
+            Prefetch("members", queryset=private_members, to_attr="member_list"),
+            Prefetch("members", queryset=inbox, to_attr="inbox_list"),
+            Prefetch("members", queryset=readers, to_attr="reader_list"),
+        )
+
+
+    def find_chat(self, title, user):
+        # group name or peer name, resolved from the precomputed titles of the user's memberships
+        return get_search_backend().filter_chats(self, title, user)
+
+
+class ChatManager(models.Manager.from_queryset(ChatQuerySet)):
     def create_private_chat(self, user, start_with):
         if user and start_with and user != start_with:
             user1 = User.objects.filter(id=user)
@@ -40,18 +124,125 @@ class ChatManager(models.Manager):
 
         return None
 
-    def find_chat(self, title):
-        query = (Q(group__isnull=False) & Q(group__name__contains=title)) | \
-                (Q(group__isnull=True) & (Q(members__member__username__contains=title) |
-                                          Q(members__member__first_name__contains=title) |
-                                          Q(members__member__last_name__contains=title)
-                                          ))
+class FilteredChatManager(ChatManager):
+    def get_queryset(self):
+        return super().get_queryset().filter(is_deleted=False)
+
 
-        obj_list = self.filter(query).distinct()
-        return obj_list
+class ChatMemberManager(models.Manager):
+    def inbox_fields(self, message):
+        if not message:
+            return {"last_message": None, "last_message_preview": "",
+                    "last_message_author": None, "last_message_at": None}
 
+        return {
+            "last_message": message,
+            "last_message_preview": f"{message}"[:255],
+            "last_message_author_id": message.author_id,
+            "last_message_at": message.created_at,
+        }
 
-class FilteredChatManager(ChatManager):
+    def update_inbox(self, message):
+        # keep inbox rows of the chat in sync with a created, edited or deleted message
+        members = self.filter(chat_id=message.chat_id)
+        stale = members.filter(last_message=message)
+
+        if message.is_deleted:
+            receivers = members.none()
+        elif message.delete_for_me:
+            receivers = members.exclude(member_id=message.author_id)
+            stale = stale.filter(member_id=message.author_id)
+        else:
+            receivers = members
+            stale = stale.none()
+
+        receivers.filter(Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.created_at)) \
+            .update(inbox_order=message.created_at, **self.inbox_fields(message))
+
+        if stale.exists():
+            self.rebuild_inbox(message.chat_id, stale)
+
+    def rebuild_inbox(self, chat_id, members=None):
+        from main.models import MessageController
+
+        members = self.filter(chat_id=chat_id) if members is None else members
+        message = MessageController.filtered_objects.filter(chat_id=chat_id).first()
+
+        if not message:
+            return members.update(**self.inbox_fields(None))
+
+        if message.delete_for_me:
+            # hidden for its author only, so the author falls back to an older message
+            for member in members.filter(member_id=message.author_id).select_related("chat", "member"):
+                last = member.chat.get_messages(member.member).first()
+                inbox_order = last.created_at if last else member.inbox_order
+                self.filter(pk=member.pk).update(inbox_order=inbox_order, **self.inbox_fields(last))
+
+            members = members.exclude(member_id=message.author_id)
+
+        return members.update(inbox_order=message.created_at, **self.inbox_fields(message))
+
+
+    def member_title(self, member, chat_members):
+        if member.chat.group:
+            return member.chat.group.name[:255]
+
+        peers = [peer.member for peer in chat_members if peer.member_id != member.member_id]
+        return " ".join(f"{peer.username} {peer.first_name} {peer.last_name}" for peer in peers)[:255]
+
+    def refresh_titles(self, chat_ids):
+        members = list(self.filter(chat_id__in=chat_ids).select_related("chat__group", "member"))
+
+        chat_members = {}
+        for member in members:
+            chat_members.setdefault(member.chat_id, []).append(member)
+
+        for member in members:
+            member.search_title = self.member_title(member, chat_members[member.chat_id])
+
+        self.bulk_update(members, ["search_title"], batch_size=1000)
+        get_search_backend().index_chat_titles([(member, member.search_title) for member in members])
+
+    def add_title(self, member):
+        # a group title does not depend on the members, a new member only writes its own row.
+        # the two members of a private chat name each other
+        name = self.filter(pk=member.pk).values_list("chat__group__name", flat=True).first()
+        if name is None:
+            return self.refresh_titles([member.chat_id])
+
+        member.search_title = name[:255]
+        self.filter(pk=member.pk).update(search_title=member.search_title)
+        get_search_backend().index_chat_titles([(member, member.search_title)])
+
+
+    def recipient_fields(self, chat_ids):
+        # the viewer dependent part of ChatSerializer for every active member of the chats, in one query
+        from main.models import MessageController
+
+        unread = MessageController.objects.filter(chat=OuterRef("chat_id"), is_deleted=False,
+                                                  id__gt=OuterRef("last_read_id")).exclude(author=OuterRef("member_id"))
+        partner = self.model.objects.filter(chat=OuterRef("chat_id"), chat__group__isnull=True) \
+            .exclude(member=OuterRef("member_id")).order_by("id")
+
+        rows = list(self.model.objects.filter(chat_id__in=chat_ids, is_deleted=False).annotate(
+            unread_count=count_subquery(unread),
+            partner_id=Subquery(partner.values("member_id")[:1]),
+        ).values_list("chat_id", "member_id", "unread_count", "partner_id", "last_message_author_id"))
+        online = get_presence_backend().online_users({row[3] for row in rows if row[3]})
+
+        fields = {}
+        for chat_id, member_id, unread_count, partner_id, author_id in rows:
+            fields.setdefault(chat_id, {})[str(member_id)] = {
+                "is_joined": True,
+                "unread_messages": unread_count,
+                "is_online": partner_id in online,
+                "sent_by_me": author_id == member_id,
+            }
+
+        return fields
+
+
+class FilteredChatMemberManager(ChatMemberManager):
     def get_queryset(self):
         return super().get_queryset().filter(is_deleted=False)
 
@@ -71,7 +262,9 @@ class FilteredGroupManager(GroupManager):
 
 class MessageManager(models.Manager):
     def create_message(self, chat_id, author, **kwargs):
-        return self.create(chat_id=chat_id, author=author, **kwargs)
+        from main.services import create_message
+
+        return create_message(self.model, chat_id, author=author, **kwargs)
 
     def edit_message(self, message_id, chat_id, author, **kwargs):
         self.filter(id=message_id).update(author=author, chat_id=chat_id, **kwargs)
@@ -98,15 +291,81 @@ class FilteredMessageManager(MessageManager):
 
 
 class MessageControlManager(MessageManager):
+    def visible_for(self, user):
+        hide_for_me = Q(delete_for_me=False) | ~Q(author=user)
+        return self.filter(chat__members__member=user, chat__members__is_deleted=False,
+                           chat__is_deleted=False, is_deleted=False).filter(hide_for_me)
+
+    def search(self, user, text, date_filter=None):
+        # every chat of the user in one index query
+        date_filter = date_filter or {}
+        return get_search_backend().filter_messages(self.visible_for(user), text,
+                                                    from_date=date_filter.get("from_date", None),
+                                                    to_date=date_filter.get("to_date", None))
+
     def mark_seen(self, chat_id, author_id, user_id, message_id):
-        unread_messages = self.filter(chat_id=chat_id, id__lte=message_id) \
-            .exclude(author_id=author_id).exclude(seen_users__user_id=user_id)
+        from main.models import Chat, ChatMember
 
-        for message in unread_messages:
-            message.seen_users.update_or_create(user_id=user_id)
+        # read watermark only moves forward, every move gets a chat sequence number for delta sync
+        with transaction.atomic():
+            moved = ChatMember.objects.filter(chat_id=chat_id, member_id=user_id, last_read_id__lt=message_id) \
+                .update(last_read_id=message_id)
+            if moved:
+                ChatMember.objects.filter(chat_id=chat_id, member_id=user_id) \
+                    .update(read_seq=Chat.objects.next_seq(chat_id))
 
         return None
 
 class FilteredMessageControlManager(MessageManager):
     def get_queryset(self):
         return super().get_queryset().filter(is_deleted=False)
+
+
+class MediaBlobManager(models.Manager):
+    # reference counts of content addressed files, a file goes when its last photo or video goes
+    def acquire(self, names):
+        from main.storage import media_storage
+
+        storage = media_storage()
+        for name in names:
+            # files stored before content addressing are not counted and never deleted
+            if not storage.is_blob(name):
+                continue
+            if self.filter(name=name).update(references=models.F("references") + 1):
+                continue
+            try:
+                with transaction.atomic():
+                    self.create(name=name, digest=storage.digest(name), size=storage.size(name), references=1)
+            except IntegrityError:
+                self.filter(name=name).update(references=models.F("references") + 1)
+
+    def sent_by(self, user, digest, size):
+        # digest and size are easy to learn, a file is reused without its bytes only for whoever sent it before
+        from main.models import MessageController
+
+        sent = MessageController.objects.filter(author=user).filter(
+            Q(photo__image=OuterRef("name")) | Q(video__video=OuterRef("name")))
+        return self.filter(digest=digest, size=size, references__gt=0).filter(Exists(sent)).first()
+
+    def release(self, names):
+        from main.storage import media_storage
+
+        storage = media_storage()
+        names = [name for name in names if storage.is_blob(name)]
+        for name in names:
+            self.filter(name=name, references__gt=0).update(references=models.F("references") - 1)
+
+        unused = list(self.filter(name__in=names, references=0).values_list("name", flat=True))
+        if not unused:
+            return
+
+        self.filter(name__in=unused, references=0).delete()
+
+        def delete_files():
+            # content saved again since the row went has a new row, its file stays
+            taken = set(self.filter(name__in=unused).values_list("name", flat=True))
+            for name in unused:
+                if name not in taken:
+                    storage.delete(name)
+
+        transaction.on_commit(delete_files)
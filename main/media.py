@@ -0,0 +1,112 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def media_url(kind, pk, variant=None, image_format=None):
+    # "format" is taken by the content negotiation of DRF
+    url = reverse("media", args=[kind, pk])
+    return f"{url}?variant={variant}&image_format={image_format}" if variant else url
+
+
+class RangeFile:
+    # length bytes of file from start, keeps fileno so WSGI servers can still sendfile() the slice
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+        self.name = file.name
+
+    def read(self, size=-1):
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+def byte_range(request, size, etag, last_modified):
+    # (start, end) of a single satisfiable range, None for the whole file, False when unsatisfiable
+    match = RANGE_RE.match(request.META.get("HTTP_RANGE", "").strip())
+    if not match or not any(match.groups()):
+        return None
+
+    # a range for another version of the file is ignored, the client gets the current one whole
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if if_range and etag not in parse_etags(if_range) and parse_http_date_safe(if_range) != last_modified:
+        return None
+
+    first, last = match.groups()
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def serve_media(request, storage, name):
+    path = storage.path(name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return HttpResponse(status=404)
+
+    # content addressed names carry the sha256, it is the natural strong validator
+    etag = f'"{storage.digest(name)}"' if storage.is_blob(name) else f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = int(stat.st_mtime)
+
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if conditional is not None:
+        conditional.headers["ETag"] = etag
+        return conditional
+
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    requested = None if settings.MEDIA_SENDFILE else byte_range(request, stat.st_size, etag, last_modified)
+
+    if requested is False:
+        response = HttpResponse(status=416)
+        response.headers["Content-Range"] = f"bytes */{stat.st_size}"
+    elif settings.MEDIA_SENDFILE:
+        # the web server sends the bytes and answers Range headers itself, no byte passes through Python
+        response = HttpResponse(content_type=content_type)
+        if settings.MEDIA_SENDFILE == "x-accel":
+            response.headers["X-Accel-Redirect"] = settings.MEDIA_ACCEL_PREFIX + name
+        else:
+            response.headers["X-Sendfile"] = path
+    elif requested:
+        start, end = requested
+        response = FileResponse(RangeFile(open(path, "rb"), start, end - start + 1), status=206,
+                                content_type=content_type)
+        response.block_size = settings.MEDIA_BLOCK_SIZE
+        response.headers["Content-Length"] = str(end - start + 1)
+        response.headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    else:
+        response = FileResponse(open(path, "rb"), content_type=content_type)
+        response.block_size = settings.MEDIA_BLOCK_SIZE
+
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["ETag"] = etag
+    response.headers["Last-Modified"] = http_date(last_modified)
+    # blobs never change under their name, clients and private caches keep them for good
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable" if storage.is_blob(name) \
+        else "private, no-cache"
+    return response
@@ -2,18 +2,26 @@ from datetime import timedelta
 
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
-from django.db.models import Q
-from django.db.models.signals import post_save
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models import Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.http import Http404
 from django.utils import timezone
 from rest_framework.authtoken.models import Token
 
 from ChainChat import settings
+from main.api.authentications.cache import token_cache
 from main.managers.managers import GroupManager, ChatManager, FilteredChatManager, \
-    FilteredGroupManager, MessageControlManager, FilteredMessageControlManager
+    FilteredGroupManager, MessageControlManager, FilteredMessageControlManager, ChatMemberManager, \
+    FilteredChatMemberManager, MediaBlobManager
 from main.managers.modelGenerics.baseModels import BaseModel, BaseMessage
+from main.realtime import update_subscription
+from main.search import get_search_backend
+from main.storage import media_storage
+from main.thumbnails import queue_variants
 
 
 class ExpiringToken(models.Model):
@@ -69,11 +77,16 @@ class Profile(models.Model):
 
 
 class BlockedUser(BaseModel):
-    blocked_by = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='blocked_users')
-    user = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='blocked_by_users')
+    # both directions are served by the composite indexes, single column ones would only add writes
+    blocked_by = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='blocked_users', db_index=False)
+    user = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='blocked_by_users', db_index=False)
 
     class Meta:
         unique_together = (('user', 'blocked_by'),)
+        indexes = [
+            # block lists and "blocked you" checks start from the blocker
+            models.Index(fields=["blocked_by", "user"], name="blocked_user_by_idx"),
+        ]
 
 
 class Group(BaseModel):
@@ -103,13 +116,16 @@ class GroupAdmin(BaseModel):
 
 class Chat(BaseModel):
     group = models.OneToOneField(Group, on_delete=models.CASCADE, null=True, blank=True, related_name='chat')
+    # bumped for every message create, edit, delete and read watermark change in the chat
+    last_seq = models.PositiveBigIntegerField(default=0)
 
     objects = ChatManager()
     filtered_objects = FilteredChatManager()
 
     def unread_messages_count(self, user_id):
-        return self.chat_messagecontrollers.filter(is_deleted=False) \
-            .exclude(seen_users__user_id=user_id).exclude(author_id=user_id).count()
+        last_read = self.members.filter(member_id=user_id).values("last_read_id")[:1]
+        return self.chat_messagecontrollers.filter(is_deleted=False, id__gt=Coalesce(Subquery(last_read), 0)) \
+            .exclude(author_id=user_id).count()
 
     def join_chat(self, user):
         if self.group:
@@ -143,27 +159,27 @@ class Chat(BaseModel):
 
         return self.members.filter(u_filter, is_deleted=False).distinct()
 
-    def get_messages(self, user, msg_filter="", date_filter=None):
-        if msg_filter:
-            m_filter = Q(message__text__contains=msg_filter) | \
-                       Q(video__caption__contains=msg_filter) | \
-                       Q(photo__caption__contains=msg_filter)
-        else:
-            m_filter = Q()
+    def get_messages(self, user, msg_filter="", date_filter=None, rank=False):
+        date_filter = date_filter or {}
+        from_date = date_filter.get("from_date", None)
+        to_date = date_filter.get("to_date", None)
 
-        d_filter = Q()
+        hide_for_me = Q(delete_for_me=False) | ~Q(author=user)
 
-        if date_filter:
-            from_date = date_filter.get("from_date", None)
-            to_date = date_filter.get("to_date", None)
-            d_filter &= Q(created_at__gte=from_date) if from_date else Q()
-            d_filter &= Q(created_at__lte=to_date) if to_date else Q()
+        # (chat, member) is unique, so the membership join never duplicates rows
+        messages = self.chat_messagecontrollers \
+            .filter(chat__members__member=user, is_deleted=False).filter(hide_for_me)
 
-        hide_for_me = Q(delete_for_me=False) | ~Q(author=user)
+        if msg_filter:
+            # content and date range are both resolved by the search index
+            backend = get_search_backend()
+            messages = backend.filter_messages(messages, msg_filter, [self.id], from_date, to_date)
+            return backend.order_by_rank(messages, msg_filter) if rank else messages
 
-        return self.chat_messagecontrollers \
-                .filter(chat__members__member=user, is_deleted=False) \
-                .filter(m_filter).filter(d_filter).filter(hide_for_me).distinct()
+        d_filter = Q()
+        d_filter &= Q(created_at__gte=from_date) if from_date else Q()
+        d_filter &= Q(created_at__lte=to_date) if to_date else Q()
+        return messages.filter(d_filter)
 
     def delete_chat(self, user):
         try:
@@ -176,6 +192,9 @@ class Chat(BaseModel):
 
     class Meta:
         ordering = ("-updated_at", )
+        indexes = [
+            models.Index(fields=["-updated_at"], condition=Q(is_deleted=False), name="chat_updated_idx"),
+        ]
 
     def __str__(self):
         return f"{self.id}"
@@ -185,8 +204,31 @@ class ChatMember(BaseModel):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='members')
     member = models.ForeignKey(User, on_delete=models.CASCADE, related_name='user_chats')
 
+    # inbox: last message visible to this member, kept in sync by the message write path
+    last_message = models.ForeignKey("MessageController", null=True, blank=True, on_delete=models.SET_NULL,
+                                     related_name='inbox_members')
+    last_message_preview = models.CharField(max_length=255, blank=True, default="")
+    last_message_author = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL,
+                                            related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    inbox_order = models.DateTimeField(default=timezone.now)
+    # id of the last MessageController the member has read
+    last_read_id = models.PositiveBigIntegerField(default=0)
+    # chat sequence number of the last last_read_id change
+    read_seq = models.PositiveBigIntegerField(default=0)
+    # group name or peer name, what the member finds this chat by
+    search_title = models.CharField(max_length=255, blank=True, default="")
+
+    objects = ChatMemberManager()
+    filtered_objects = FilteredChatMemberManager()
+
     class Meta:
         unique_together = (('chat', 'member'),)
+        indexes = [
+            # inbox pages of active memberships, already in display order
+            models.Index(fields=["member", "-inbox_order"], condition=Q(is_deleted=False),
+                         name="chat_member_inbox_idx"),
+        ]
 
     def __str__(self):
         return f"{self.id}"
@@ -200,21 +242,68 @@ class Message(BaseMessage):
 
 
 class Photo(BaseMessage):
-    image = models.ImageField(upload_to='media/images/')
+    image = models.ImageField(upload_to='media/images/', storage=media_storage)
     caption = models.TextField(blank=True, null=True)
+    # filled by the thumbnail workers after upload, variants is {size: {format: {name, width, height}}}
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    placeholder = models.TextField(blank=True, default="")
+    variants = models.JSONField(default=dict, blank=True)
+
+    media_field = "image"
+
+    def media_names(self):
+        return [self.image.name] + [variant["name"] for formats in self.variants.values()
+                                    for variant in formats.values()]
 
     def __str__(self):
         return self.image.name
 
 
 class Video(BaseMessage):
-    video = models.FileField(upload_to='media/videos/')
+    video = models.FileField(upload_to='media/videos/', storage=media_storage)
     caption = models.TextField(blank=True, null=True)
 
+    media_field = "video"
+
+    def media_names(self):
+        return [self.video.name]
+
     def __str__(self):
         return self.video.name
 
 
+class MediaBlob(models.Model):
+    # one content addressed file, shared by every photo, video and photo variant with the same bytes
+    name = models.CharField(max_length=255, unique=True)
+    digest = models.CharField(max_length=64, db_index=True)
+    size = models.PositiveBigIntegerField(default=0)
+    references = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = MediaBlobManager()
+
+    def __str__(self):
+        return self.name
+
+
+class SocketEvent(models.Model):
+    # replay log of DatabaseEventLogBackend, shared by every worker. The id is the event id sent to sockets
+    chat = models.ForeignKey("Chat", on_delete=models.CASCADE, related_name='+', db_index=False)
+    user_ids = models.JSONField(default=list)
+    event = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # events of the user's chats after a reconnecting socket's last_event_id
+            models.Index(fields=["chat", "id"], name="socket_event_chat_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.id}"
+
+
 class MessageController(BaseMessage):
     video = models.OneToOneField(
         Video,
@@ -240,9 +329,29 @@ class MessageController(BaseMessage):
         blank=True,
     )
 
+    # id chosen by the sending client, a retried socket send finds the message it already created
+    client_id = models.CharField(max_length=64, null=True, blank=True)
+    # chat sequence number of the last change to this message
+    seq = models.PositiveBigIntegerField(default=0)
+
     objects = MessageControlManager()
     filtered_objects = FilteredMessageControlManager()
 
+    class Meta(BaseMessage.Meta):
+        indexes = [
+            # message history and inbox rebuilds only ever read live messages, newest first
+            models.Index(fields=["chat", "-created_at", "-id"], condition=Q(is_deleted=False),
+                         name="message_chat_created_idx"),
+            # unread counts are ranges of ids above the read watermark, author is checked from the index
+            models.Index(fields=["chat", "id", "author"], condition=Q(is_deleted=False),
+                         name="message_chat_unread_idx"),
+            models.Index(fields=["chat", "seq"], name="message_chat_seq_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["author", "client_id"], condition=Q(client_id__isnull=False),
+                                    name="message_author_client_id_unique"),
+        ]
+
     def __str__(self):
         value = ""
         if self.video:
@@ -258,21 +367,64 @@ class MessageController(BaseMessage):
 
 
 class SeenUser(BaseModel):
-    message = models.ForeignKey(MessageController, on_delete=models.CASCADE, related_name='seen_users')
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='seen_message')
+    # both directions are served by the composite indexes, single column ones would only add writes
+    message = models.ForeignKey(MessageController, on_delete=models.CASCADE, related_name='seen_users',
+                                db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='seen_message', db_index=False)
 
     class Meta:
         unique_together = ("message", "user", )
+        indexes = [
+            # what a user has seen, the unique pair serves lookups by message
+            models.Index(fields=["user", "message"], name="seen_user_message_idx"),
+        ]
 
     def __str__(self):
         return self.user.username
 
 
+class UploadSession(BaseModel):
+    KIND_CHOICES = (("photo", "photo"), ("video", "video"))
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='upload_sessions')
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    file_name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    # bytes already on disk, the offset the next chunk has to start at
+    offset = models.PositiveBigIntegerField(default=0)
+    caption = models.TextField(blank=True, null=True)
+    reply = models.ForeignKey(MessageController, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    # stored content the client announced by digest, the session needs no chunks
+    blob = models.ForeignKey(MediaBlob, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    # set by finalize, a retried finalize returns the same message
+    message_controller = models.OneToOneField(MessageController, null=True, blank=True, on_delete=models.SET_NULL,
+                                              related_name='upload_session')
+
+    def __str__(self):
+        return f"{self.id}"
+
+
 # define Expire token date obj
 @receiver(post_save, sender=Token)
 def create_token(sender, instance, **kwargs):
     ExpiringToken.objects.update_or_create(token=instance)
 
+# cached authentications follow the token, its expiration and the user
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+@receiver(post_save, sender=ExpiringToken)
+@receiver(post_delete, sender=ExpiringToken)
+def invalidate_token_options(sender, instance, **kwargs):
+    token_cache.invalidate(instance.token_id)
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, **kwargs):
+    token_cache.invalidate_user(instance.id)
+
 
 # Auto create profile
 @receiver(post_save, sender=User)
@@ -287,7 +439,38 @@ def create_chat(sender, instance, **kwargs):
 # auto chat update_at handle
 @receiver(post_save, sender=ChatMember)
 def update_time(sender, instance, **kwargs):
-    instance.chat.save()
+    Chat.objects.touch(instance.chat_id)
+
+# fill inbox and searchable titles of new members
+@receiver(post_save, sender=ChatMember)
+def create_inbox(sender, instance, created, **kwargs):
+    if created:
+        ChatMember.objects.rebuild_inbox(instance.chat_id, ChatMember.objects.filter(pk=instance.pk))
+        ChatMember.objects.add_title(instance)
+
+# joining or leaving moves the member's open sockets in or out of the chat group
+@receiver(post_save, sender=ChatMember)
+def sync_subscription(sender, instance, **kwargs):
+    transaction.on_commit(lambda: update_subscription(instance.member_id, instance.chat_id, not instance.is_deleted))
+
+
+@receiver(post_delete, sender=ChatMember)
+def delete_chat_title(sender, instance, **kwargs):
+    get_search_backend().remove_chat_title(instance.id)
+
+# keep searchable titles in sync with group and user names
+@receiver(post_save, sender=Group)
+def update_group_title(sender, instance, created, **kwargs):
+    if not created:
+        ChatMember.objects.refresh_titles(Chat.objects.filter(group=instance).values_list("id", flat=True))
+
+@receiver(post_save, sender=User)
+def update_user_titles(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields and not {"username", "first_name", "last_name"} & set(update_fields)):
+        return
+
+    chat_ids = ChatMember.objects.filter(member=instance, chat__group__isnull=True).values_list("chat_id", flat=True)
+    ChatMember.objects.refresh_titles(list(chat_ids))
 
 # Handle Messages by Signal
 def update_controller(obj, instance):
@@ -297,8 +480,12 @@ def update_controller(obj, instance):
     obj.delete_for_me = instance.delete_for_me
     obj.edited_at = instance.edited_at
     obj.reply = instance.reply
-    instance.chat.save()
-    obj.save()
+    # the chat row stays locked until the change commits, a sync never sees the seq without the change
+    with transaction.atomic():
+        obj.seq = Chat.objects.next_seq(instance.chat_id, touch=True)
+        obj.save()
+        ChatMember.objects.update_inbox(obj)
+        get_search_backend().index_message(obj, getattr(instance, "text", None) or getattr(instance, "caption", None))
 
 @receiver(post_save, sender=Message)
 def create_message(sender, instance, **kwargs):
@@ -310,7 +497,56 @@ def create_photo(sender, instance, **kwargs):
     obj, created = MessageController.objects.update_or_create(photo_id=instance.id)
     update_controller(obj, instance)
 
+# stored media is reference counted by the rows that point at it, photos get new variants with a new image
+@receiver(pre_save, sender=Photo)
+@receiver(pre_save, sender=Video)
+def remember_media(sender, instance, **kwargs):
+    instance.previous_media = None if instance._state.adding else \
+        sender.objects.filter(pk=instance.pk).values_list(sender.media_field, flat=True).first()
+
+@receiver(post_save, sender=Photo)
+@receiver(post_save, sender=Video)
+def count_media(sender, instance, created, **kwargs):
+    name = getattr(instance, sender.media_field).name
+    if not created and instance.previous_media == name:
+        return
+
+    MediaBlob.objects.acquire([name])
+    if instance.previous_media:
+        MediaBlob.objects.release([instance.previous_media])
+    if sender is Photo:
+        transaction.on_commit(lambda: queue_variants(instance))
+
+@receiver(post_delete, sender=Photo)
+@receiver(post_delete, sender=Video)
+def release_media(sender, instance, **kwargs):
+    MediaBlob.objects.release(instance.media_names())
+
 @receiver(post_save, sender=Video)
 def create_video(sender, instance, **kwargs):
     obj, created = MessageController.objects.update_or_create(video_id=instance.id)
     update_controller(obj, instance)
+
+# keep the user directory index in sync
+@receiver(post_save, sender=User)
+def index_user(sender, instance, update_fields=None, **kwargs):
+    if update_fields and not {"username", "first_name", "last_name"} & set(update_fields):
+        return
+
+    phone_number = Profile.objects.filter(user=instance).values_list("phone_number", flat=True).first()
+    get_search_backend().index_users([(instance, phone_number)])
+
+@receiver(post_save, sender=Profile)
+def index_profile(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields and "phone_number" not in update_fields):
+        return
+
+    get_search_backend().index_users([(instance.user, instance.phone_number)])
+
+@receiver(post_delete, sender=User)
+def delete_user_index(sender, instance, **kwargs):
+    get_search_backend().remove_user(instance.id)
+
+@receiver(post_delete, sender=MessageController)
+def delete_message_index(sender, instance, **kwargs):
+    get_search_backend().remove_message(instance.id)
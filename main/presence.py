@@ -0,0 +1,150 @@
+import asyncio
+import threading
+import weakref
+from datetime import timedelta
+from functools import lru_cache
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Case, When, Value
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+class BasePresenceBackend:
+    def connect(self, user_id, channel_name):
+        # returns True when this is the first open socket of the user
+        raise NotImplementedError
+
+    def disconnect(self, user_id, channel_name):
+        # returns True when the last open socket of the user went away
+        raise NotImplementedError
+
+    def heartbeat(self, channel_name):
+        raise NotImplementedError
+
+    def expired(self, timeout):
+        # channel names whose last heartbeat is older than timeout seconds
+        raise NotImplementedError
+
+    def online_users(self, user_ids):
+        raise NotImplementedError
+
+    def is_online(self, user_id):
+        return user_id in self.online_users([user_id])
+
+    def last_online(self, user_id):
+        return None
+
+    def pending(self):
+        # {user id: (is_online, changed at)} not written to the database yet, cleared on read
+        raise NotImplementedError
+
+    def clear(self):
+        pass
+
+    def flush(self):
+        from main.models import Profile
+
+        changes = self.pending()
+        online = [user_id for user_id, (is_online, _) in changes.items() if is_online]
+        offline = {user_id: changed_at for user_id, (is_online, changed_at) in changes.items() if not is_online}
+
+        if online:
+            Profile.objects.filter(user_id__in=online).update(is_online=True)
+        if offline:
+            last_online = Case(*[When(user_id=user_id, then=Value(changed_at)) for user_id, changed_at in offline.items()])
+            Profile.objects.filter(user_id__in=offline).update(is_online=False, last_online=last_online)
+
+        return len(changes)
+
+
+class MemoryPresenceBackend(BasePresenceBackend):
+    # process local, every socket of a user has to be served by the same process
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.last_seen = {}
+        self.changes = {}
+
+    def connect(self, user_id, channel_name):
+        with self.lock:
+            channels = self.connections.setdefault(user_id, set())
+            first = not channels
+            channels.add(channel_name)
+            self.last_seen[channel_name] = timezone.now()
+
+            if first:
+                self.changes[user_id] = (True, timezone.now())
+            return first
+
+    def disconnect(self, user_id, channel_name):
+        with self.lock:
+            self.last_seen.pop(channel_name, None)
+            channels = self.connections.get(user_id, set())
+            if channel_name not in channels:
+                return False
+
+            channels.discard(channel_name)
+            if channels:
+                return False
+
+            del self.connections[user_id]
+            self.changes[user_id] = (False, timezone.now())
+            return True
+
+    def heartbeat(self, channel_name):
+        with self.lock:
+            if channel_name in self.last_seen:
+                self.last_seen[channel_name] = timezone.now()
+
+    def expired(self, timeout):
+        deadline = timezone.now() - timedelta(seconds=timeout)
+        with self.lock:
+            return [channel for channel, seen in self.last_seen.items() if seen < deadline]
+
+    def online_users(self, user_ids):
+        with self.lock:
+            return {user_id for user_id in user_ids if user_id in self.connections}
+
+    def last_online(self, user_id):
+        with self.lock:
+            is_online, changed_at = self.changes.get(user_id, (True, None))
+        return None if is_online else changed_at
+
+    def pending(self):
+        with self.lock:
+            changes, self.changes = self.changes, {}
+        return changes
+
+    def clear(self):
+        with self.lock:
+            self.connections.clear()
+            self.last_seen.clear()
+            self.changes.clear()
+
+
+@lru_cache(maxsize=None)
+def get_presence_backend():
+    return import_string(settings.PRESENCE_BACKEND)()
+
+
+flush_tasks = weakref.WeakKeyDictionary()
+
+
+async def run_presence_flusher(channel_layer):
+    # closes sockets that stopped sending heartbeats and writes status changes in batches
+    backend = get_presence_backend()
+    while True:
+        await asyncio.sleep(settings.PRESENCE_FLUSH_INTERVAL)
+        for channel_name in backend.expired(settings.PRESENCE_TIMEOUT):
+            await channel_layer.send(channel_name, {"type": "presence.expired"})
+        await database_sync_to_async(backend.flush)()
+
+
+def start_presence_flusher(channel_layer):
+    # one flusher per event loop, started by the first socket that connects
+    loop = asyncio.get_running_loop()
+    task = flush_tasks.get(loop)
+    if task is None or task.done():
+        flush_tasks[loop] = loop.create_task(run_presence_flusher(channel_layer))
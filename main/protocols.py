@@ -0,0 +1,113 @@
+import json
+from datetime import datetime
+
+import msgpack
+
+# long field name -> key used on msgpack frames, clients expand them with the same table
+COMPACT_KEYS = {
+    "updated_chat": "c",
+    "user_status": "s",
+    "message": "m",
+    "action": "a",
+    "time": "t",
+    "id": "i",
+    "is_group": "g",
+    "is_joined": "j",
+    "title": "tl",
+    "is_online": "o",
+    "members": "n",
+    "unread_messages": "u",
+    "last_message": "l",
+    "author": "au",
+    "preview": "p",
+    "created_at": "ca",
+    "sent_by_me": "me",
+    "seen_users": "su",
+    "username": "un",
+    "first_name": "fn",
+    "last_name": "ln",
+    "text": "tx",
+    "type": "ty",
+    "chat_id": "ci",
+    "author_id": "ai",
+    "reply_id": "ri",
+    "client_id": "k",
+    "created": "cr",
+    "details": "d",
+}
+EXPANDED_KEYS = {value: key for key, value in COMPACT_KEYS.items()}
+
+# sent as seconds since the epoch on msgpack frames
+TIMESTAMP_KEYS = {"created_at", "last_online", "time"}
+
+
+class JsonProtocol:
+    name = "json"
+    binary = False
+
+    def default(self, value):
+        if isinstance(value, datetime):
+            return value.isoformat()
+        raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+    def encode(self, data, relayed=()):
+        return json.dumps(data, default=self.default, separators=(",", ":"))
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class MsgpackProtocol:
+    name = "msgpack"
+    binary = True
+
+    def timestamp(self, value):
+        if isinstance(value, str):
+            try:
+                value = datetime.fromisoformat(value)
+            except ValueError:
+                return value
+        return value.timestamp() if isinstance(value, datetime) else value
+
+    def compact(self, value, relayed=()):
+        # relayed fields hold what a client sent, only their own key is shortened
+        if isinstance(value, dict):
+            return {
+                COMPACT_KEYS.get(key, key): item if key in relayed else
+                self.timestamp(item) if key in TIMESTAMP_KEYS else self.compact(item)
+                for key, item in value.items()
+            }
+        elif isinstance(value, list):
+            return [self.compact(item) for item in value]
+        return value
+
+    def expand(self, value):
+        # client frames only shorten their top level keys, what they carry is relayed untouched
+        if isinstance(value, dict):
+            return {EXPANDED_KEYS.get(key, key): item for key, item in value.items()}
+        return value
+
+    def default(self, value):
+        if isinstance(value, datetime):
+            return value.timestamp()
+        raise TypeError(f"{type(value).__name__} is not msgpack serializable")
+
+    def encode(self, data, relayed=()):
+        return msgpack.packb(self.compact(data, relayed), default=self.default)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return json.loads(text_data)
+        return self.expand(msgpack.unpackb(bytes_data, strict_map_key=False))
+
+
+PROTOCOLS = {protocol.name: protocol for protocol in (MsgpackProtocol(), JsonProtocol())}
+DEFAULT_PROTOCOL = PROTOCOLS["json"]
+
+
+def negotiate(subprotocols):
+    # first supported subprotocol offered by the client, None when it offered none we know
+    for name in subprotocols or []:
+        if name in PROTOCOLS:
+            return PROTOCOLS[name]
+    return None
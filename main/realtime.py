@@ -0,0 +1,25 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+
+def chat_group(chat_id):
+    return f"chat_{chat_id}"
+
+
+def user_group(user_id):
+    return f"user_{user_id}"
+
+
+def send_to_group(group, event):
+    channel_layer = get_channel_layer()
+    if channel_layer is not None:
+        async_to_sync(channel_layer.group_send)(group, event)
+
+
+def update_subscription(user_id, chat_id, subscribed):
+    # live sockets of the user join or leave the chat group, on whichever node they are connected
+    send_to_group(user_group(user_id), {
+        "type": "chat.subscription",
+        "chat_id": chat_id,
+        "subscribed": subscribed,
+    })
@@ -0,0 +1,299 @@
+from datetime import timezone as dt_timezone
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+def get_message_text(controller):
+    if controller.message_id:
+        return controller.message.text
+    elif controller.photo_id:
+        return controller.photo.caption or ""
+    elif controller.video_id:
+        return controller.video.caption or ""
+    return ""
+
+
+class BaseSearchBackend:
+    def setup(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def index_messages(self, rows, replace=True):
+        # rows of (controller, text), replace=False skips the lookup for rows that are new
+        pass
+
+    def index_message(self, controller, text):
+        self.index_messages([(controller, text)])
+
+    def remove_message(self, message_id):
+        pass
+
+    def filter_messages(self, queryset, text, chat_ids=None, from_date=None, to_date=None):
+        raise NotImplementedError
+
+    def index_chat_titles(self, rows):
+        # rows of (chat member, title)
+        pass
+
+    def remove_chat_title(self, member_id):
+        pass
+
+    def filter_chats(self, queryset, text, user):
+        raise NotImplementedError
+
+    def index_users(self, rows):
+        # rows of (user, phone number)
+        pass
+
+    def remove_user(self, user_id):
+        pass
+
+    def filter_users(self, queryset, text):
+        raise NotImplementedError
+
+    def order_by_rank(self, queryset, text):
+        return queryset
+
+    def snippets(self, messages, text, width=40):
+        # {message id: text around the first match}, matches wrapped in <b></b>
+        result = {}
+        for message in messages:
+            content = get_message_text(message)
+            start = content.lower().find(text.lower())
+            if start < 0:
+                result[message.id] = content[:width]
+                continue
+
+            end = start + len(text)
+            before = max(0, start - width // 2)
+            after = min(len(content), end + width // 2)
+            result[message.id] = ("..." if before else "") + content[before:start] + \
+                "<b>" + content[start:end] + "</b>" + content[end:after] + ("..." if after < len(content) else "")
+
+        return result
+
+
+class LikeSearchBackend(BaseSearchBackend):
+    # no index, substring scan over every message type
+    def filter_messages(self, queryset, text, chat_ids=None, from_date=None, to_date=None):
+        m_filter = Q(message__text__contains=text) | \
+                   Q(video__caption__contains=text) | \
+                   Q(photo__caption__contains=text)
+
+        m_filter &= Q(chat_id__in=chat_ids) if chat_ids is not None else Q()
+        m_filter &= Q(created_at__gte=from_date) if from_date else Q()
+        m_filter &= Q(created_at__lte=to_date) if to_date else Q()
+        return queryset.filter(m_filter)
+
+    def filter_chats(self, queryset, text, user):
+        # the user's memberships are few, so a scan over their titles stays cheap
+        from main.models import ChatMember
+
+        members = ChatMember.objects.filter(member=user, search_title__contains=text)
+        return queryset.filter(id__in=members.values("chat_id"))
+
+    def filter_users(self, queryset, text):
+        u_filter = Q(username__contains=text) | \
+                   Q(first_name__contains=text) | \
+                   Q(last_name__contains=text) | \
+                   Q(profile__phone_number__contains=text)
+        return queryset.filter(u_filter)
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    # FTS5 trigram index, keeps the substring semantics of the LIKE search
+    table = "main_message_search"
+    title_table = "main_chat_title_search"
+    user_table = "main_user_search"
+    # word prefixes of one and two characters, what a user types before the trigrams can match
+    user_prefix_table = "main_user_prefix_search"
+    min_length = 3
+    fallback_class = LikeSearchBackend
+
+    def __init__(self):
+        self.fallback = self.fallback_class()
+
+    def setup(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+                f"USING fts5(content, chat, created_at UNINDEXED, tokenize='trigram')"
+            )
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.title_table} "
+                f"USING fts5(title, member, chat_id UNINDEXED, tokenize='trigram')"
+            )
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.user_table} "
+                f"USING fts5(username, first_name, last_name, phone_number, tokenize='trigram')"
+            )
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.user_prefix_table} "
+                f"USING fts5(username, first_name, last_name, phone_number, prefix='1 2')"
+            )
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table}")
+            cursor.execute(f"DELETE FROM {self.title_table}")
+            cursor.execute(f"DELETE FROM {self.user_table}")
+            cursor.execute(f"DELETE FROM {self.user_prefix_table}")
+
+    def format_date(self, value):
+        if not value:
+            return None
+
+        from main.models import MessageController
+        value = MessageController._meta.get_field("created_at").to_python(value)
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value.astimezone(dt_timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    def format_chat(self, chat_id):
+        return f"[{chat_id}]"
+
+    def format_query(self, text):
+        return '"' + text.replace('"', '""') + '"'
+
+    def index_messages(self, rows, replace=True):
+        rows = [(controller.id, text, self.format_chat(controller.chat_id), self.format_date(controller.created_at))
+                for controller, text in rows if text and not controller.is_deleted]
+        if not rows:
+            return
+
+        with connection.cursor() as cursor:
+            if replace:
+                cursor.executemany(f"DELETE FROM {self.table} WHERE rowid = %s", [(row[0],) for row in rows])
+            cursor.executemany(
+                f"INSERT INTO {self.table} (rowid, content, chat, created_at) VALUES (%s, %s, %s, %s)", rows
+            )
+
+    def index_message(self, controller, text):
+        if controller.is_deleted or not text:
+            return self.remove_message(controller.id)
+        return super().index_message(controller, text)
+
+    def remove_message(self, message_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [message_id])
+
+    def index_chat_titles(self, rows):
+        if not rows:
+            return
+
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {self.title_table} WHERE rowid = %s", [(member.id,) for member, _ in rows])
+            cursor.executemany(
+                f"INSERT INTO {self.title_table} (rowid, title, member, chat_id) VALUES (%s, %s, %s, %s)",
+                [(member.id, title, self.format_chat(member.member_id), member.chat_id)
+                 for member, title in rows if title],
+            )
+
+    def remove_chat_title(self, member_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.title_table} WHERE rowid = %s", [member_id])
+
+    def filter_chats(self, queryset, text, user):
+        if len(text) < self.min_length:
+            return self.fallback.filter_chats(queryset, text, user)
+
+        query = f"title:{self.format_query(text)} AND member:{self.format_query(self.format_chat(user.id))}"
+        sql = f"SELECT chat_id FROM {self.title_table} WHERE {self.title_table} MATCH %s"
+        return queryset.filter(id__in=RawSQL(sql, [query]))
+
+    def index_users(self, rows):
+        if not rows:
+            return
+
+        ids = [(user.id,) for user, _ in rows]
+        values = [(user.id, user.username, user.first_name, user.last_name, phone_number or "")
+                  for user, phone_number in rows]
+        with connection.cursor() as cursor:
+            for table in (self.user_table, self.user_prefix_table):
+                cursor.executemany(f"DELETE FROM {table} WHERE rowid = %s", ids)
+                cursor.executemany(
+                    f"INSERT INTO {table} (rowid, username, first_name, last_name, phone_number) "
+                    f"VALUES (%s, %s, %s, %s, %s)", values
+                )
+
+    def remove_user(self, user_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.user_table} WHERE rowid = %s", [user_id])
+            cursor.execute(f"DELETE FROM {self.user_prefix_table} WHERE rowid = %s", [user_id])
+
+    def filter_users(self, queryset, text):
+        # too short for trigrams, names and phone numbers starting with the text
+        table, query = (self.user_prefix_table, self.format_query(text) + "*") if len(text) < self.min_length \
+            else (self.user_table, self.format_query(text))
+
+        sql = f"SELECT rowid FROM {table} WHERE {table} MATCH %s"
+        return queryset.filter(id__in=RawSQL(sql, [query]))
+
+    def match_sql(self, text, chat_ids=None, from_date=None, to_date=None):
+        query = f"content:{self.format_query(text)}"
+        if chat_ids is not None:
+            chats = " OR ".join(self.format_query(self.format_chat(chat_id)) for chat_id in chat_ids)
+            query += f" AND chat:({chats})"
+
+        sql = f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s"
+        params = [query]
+
+        if from_date:
+            sql += " AND created_at >= %s"
+            params.append(self.format_date(from_date))
+        if to_date:
+            sql += " AND created_at <= %s"
+            params.append(self.format_date(to_date))
+
+        return sql, params
+
+    def filter_messages(self, queryset, text, chat_ids=None, from_date=None, to_date=None):
+        if len(text) < self.min_length:
+            return self.fallback.filter_messages(queryset, text, chat_ids, from_date, to_date)
+
+        if chat_ids is not None and not chat_ids:
+            return queryset.none()
+
+        sql, params = self.match_sql(text, chat_ids, from_date, to_date)
+        return queryset.filter(id__in=RawSQL(sql, params))
+
+    def order_by_rank(self, queryset, text):
+        if len(text) < self.min_length:
+            return queryset
+
+        table = queryset.model._meta.db_table
+        rank = RawSQL(
+            f"SELECT rank FROM {self.table} WHERE {self.table} MATCH %s AND rowid = {table}.id",
+            [f"content:{self.format_query(text)}"],
+        )
+        return queryset.annotate(search_rank=rank).order_by("search_rank", "-created_at")
+
+    def snippets(self, messages, text, width=40):
+        if len(text) < self.min_length or not messages:
+            return super().snippets(messages, text, width)
+
+        ids = [message.id for message in messages]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid, snippet({self.table}, 0, '<b>', '</b>', '...', %s) FROM {self.table} "
+                f"WHERE {self.table} MATCH %s AND rowid IN ({', '.join(['%s'] * len(ids))})",
+                [min(width, 64), f"content:{self.format_query(text)}", *ids],
+            )
+            return dict(cursor.fetchall())
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    return import_string(settings.MESSAGE_SEARCH_BACKEND)()
+
+
+def setup_search_backend(sender, **kwargs):
+    get_search_backend().setup()
@@ -0,0 +1,38 @@
+from django.db import transaction
+
+from main.models import Chat, ChatMember, MediaBlob, Message, MessageController, Photo, Video
+from main.search import get_search_backend
+from main.thumbnails import queue_variants
+
+CONTROLLER_FIELDS = {Message: "message", Photo: "photo", Video: "video"}
+
+
+def create_message(model, chat_id, client_id=None, **fields):
+    # content row and controller in one transaction, without the post_save round trips
+    with transaction.atomic():
+        instance = model(chat_id=chat_id, **fields)
+        model.objects.bulk_create([instance])
+        seq = Chat.objects.next_seq(chat_id, touch=True)
+
+        controller = MessageController.objects.create(
+            chat_id=chat_id,
+            author_id=instance.author_id,
+            reply_id=instance.reply_id,
+            is_deleted=instance.is_deleted,
+            delete_for_me=instance.delete_for_me,
+            client_id=client_id,
+            seq=seq,
+            **{CONTROLLER_FIELDS[model]: instance},
+        )
+
+        ChatMember.objects.update_inbox(controller)
+
+        text = getattr(instance, "text", None) or getattr(instance, "caption", None)
+        get_search_backend().index_messages([(controller, text)], replace=False)
+
+        if model is not Message:
+            MediaBlob.objects.acquire([getattr(instance, model.media_field).name])
+        if model is Photo:
+            transaction.on_commit(lambda: queue_variants(instance))
+
+    return instance
@@ -0,0 +1,72 @@
+import hashlib
+import os
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage, storages
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    # every file is stored once under the sha256 of its bytes, saving known content writes nothing.
+    # upload_to of the fields is ignored, only the extension of the uploaded name is kept
+    directory = "blobs"
+
+    def blob_name(self, digest, name):
+        return f"{self.directory}/{digest[:2]}/{digest}{os.path.splitext(name)[1].lower()}"
+
+    def is_blob(self, name):
+        return name.startswith(f"{self.directory}/")
+
+    def digest(self, name):
+        return os.path.splitext(os.path.basename(name))[0]
+
+    def get_available_name(self, name, max_length=None):
+        # a taken name already holds the same bytes
+        return name
+
+    def _store(self, source, name):
+        full_path = self.path(name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # concurrent saves of the same content overwrite each other with identical bytes
+        file_move_safe(source, full_path, allow_overwrite=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+
+    def _save(self, name, content):
+        if hasattr(content, "temporary_file_path"):
+            # digest is only set by server side code that already knows the content, like reused blobs
+            digest = getattr(content, "digest", None) or file_digest(content.temporary_file_path())
+            name = self.blob_name(digest, name)
+            if not self.exists(name):
+                self._store(content.temporary_file_path(), name)
+            return name
+
+        # hashed while it is written, the content is read once and never held in memory
+        os.makedirs(self.path(self.directory), exist_ok=True)
+        hasher = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.path(self.directory), delete=False) as temporary:
+            for chunk in content.chunks():
+                hasher.update(chunk)
+                temporary.write(chunk)
+
+        name = self.blob_name(hasher.hexdigest(), name)
+        if self.exists(name):
+            os.remove(temporary.name)
+        else:
+            self._store(temporary.name, name)
+        return name
+
+
+def media_storage():
+    # photo and video files, configured as the "media" entry of STORAGES
+    return storages["media"]
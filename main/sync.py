@@ -0,0 +1,137 @@
+import base64
+import binascii
+
+import msgpack
+from django.conf import settings
+from django.db.models import Q
+
+from main.api.serializers.allMessages import ChatSerializer
+from main.media import media_url
+from main.models import Chat, ChatMember, MessageController
+
+# content relation of a controller -> (payload type, text field, file field)
+CONTENT_FIELDS = {
+    "message": ("message", "text", None),
+    "photo": ("photo", "caption", "image"),
+    "video": ("video", "caption", "video"),
+}
+
+# chats per OR query, keeps the statement far below the database expression limits
+SYNC_CHUNK_SIZE = 100
+
+
+def encode_cursor(positions):
+    # {chat id: seq} -> url safe string, flat [chat id, seq, ...] pairs keep it small
+    flat = [value for item in sorted(positions.items()) for value in item]
+    return base64.urlsafe_b64encode(msgpack.packb(flat)).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    # raises ValueError for anything encode_cursor could not have produced
+    if not cursor:
+        return {}
+
+    try:
+        flat = msgpack.unpackb(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError, msgpack.UnpackException):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(flat, list) or len(flat) % 2 or not all(isinstance(value, int) and value >= 0 for value in flat):
+        raise ValueError("Invalid cursor")
+    return dict(zip(flat[::2], flat[1::2]))
+
+
+def message_content(controller):
+    for name, (content_type, text_field, file_field) in CONTENT_FIELDS.items():
+        content = getattr(controller, name)
+        if content is not None:
+            return content, content_type, text_field, file_field
+    return None, None, None, None
+
+
+def message_payload(controller):
+    content, content_type, text_field, file_field = message_content(controller)
+    data = {
+        "id": content.id,
+        "type": content_type,
+        "text": getattr(content, text_field),
+        "chat_id": controller.chat_id,
+        "author_id": controller.author_id,
+        "reply_id": controller.reply_id,
+        "client_id": controller.client_id,
+        "seq": controller.seq,
+        "created_at": content.created_at.isoformat(),
+        "edited_at": controller.edited_at.isoformat() if controller.edited_at else None,
+    }
+    if file_field:
+        data["file"] = media_url(content_type, content.id)
+    return data
+
+
+def hidden_payload(controller):
+    # deleted messages only carry what the client needs to drop them
+    content, content_type, _, _ = message_content(controller)
+    return {"id": content.id, "type": content_type, "chat_id": controller.chat_id, "seq": controller.seq,
+            "is_deleted": True}
+
+
+def seq_filter(positions, current, field):
+    # changes after the client position and up to the snapshot the new cursor is built from
+    query = Q()
+    for chat_id, seq in positions.items():
+        query |= Q(chat_id=chat_id, **{f"{field}__gt": seq, f"{field}__lte": current[chat_id]})
+    return query
+
+
+def collect_changes(user, positions):
+    # everything that changed for the user after positions, in a number of queries independent of history size
+    current = dict(ChatMember.filtered_objects.filter(member=user, chat__is_deleted=False)
+                   .values_list("chat_id", "chat__last_seq"))
+
+    removed = sorted(chat_id for chat_id in positions if chat_id not in current)
+    added = [chat_id for chat_id in current if chat_id not in positions]
+    changed = {chat_id: seq for chat_id, seq in positions.items()
+               if chat_id in current and current[chat_id] > seq}
+
+    # chats that fell too far behind are refetched by the client through getMessages
+    truncated = sorted(chat_id for chat_id, seq in changed.items()
+                       if current[chat_id] - seq > settings.SYNC_CHANGE_LIMIT)
+    for chat_id in truncated:
+        del changed[chat_id]
+
+    messages, reads = [], []
+    chunks = list(changed.items())
+    for start in range(0, len(chunks), SYNC_CHUNK_SIZE):
+        chunk = dict(chunks[start:start + SYNC_CHUNK_SIZE])
+
+        controllers = MessageController.objects.filter(seq_filter(chunk, current, "seq")) \
+            .select_related("message", "photo", "video").order_by("chat_id", "seq")
+        for controller in controllers:
+            hidden = controller.is_deleted or (controller.delete_for_me and controller.author_id == user.id)
+            messages.append(hidden_payload(controller) if hidden else message_payload(controller))
+
+        reads += ChatMember.objects.filter(seq_filter(chunk, current, "read_seq")) \
+            .values("chat_id", "member_id", "last_read_id")
+
+    if reads:
+        # watermarks are controller ids, clients know messages by content id and type
+        targets = MessageController.objects.filter(id__in={read["last_read_id"] for read in reads}) \
+            .select_related("message", "photo", "video").in_bulk()
+        watermarks, reads = reads, []
+        for read in watermarks:
+            if read["last_read_id"] in targets:
+                content, content_type, _, _ = message_content(targets[read["last_read_id"]])
+                reads.append({"chat_id": read["chat_id"], "user_id": read["member_id"],
+                              "message_id": content.id, "type": content_type})
+
+    chat_ids = added + list(changed) + truncated
+    chats = Chat.objects.filter(id__in=chat_ids).with_user_data(user) if chat_ids else []
+
+    return {
+        "cursor": encode_cursor(current),
+        "chats": ChatSerializer(chats, many=True, context={"user": user}).data,
+        "removed_chats": removed,
+        "truncated_chats": truncated,
+        "messages": messages,
+        "reads": reads,
+    }
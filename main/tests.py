@@ -1,3 +1,1481 @@
-from django.test import TestCase
+import hashlib
+import os
+import re
+import tempfile
+from concurrent.futures import Future
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+import msgpack
+from PIL import Image
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from main.api.authentications.cache import TokenCache, authenticate_token, token_cache
+from main.api.genericViews.userVeiw import UserBaseView
+from main.management.commands._bench import BENCH_PASSWORD
+from main.api.serializers.allMessages import AllMessageSerializer, ChatSerializer, PhotoSerializer
+from main.api.serializers.users import AuthUserSerializer
+from main.managers.managers import recent_chat_touches
+from main.consumers import serialize_chats
+from main.events import DatabaseEventLogBackend, MemoryEventLogBackend, get_event_log_backend
+from main.presence import get_presence_backend
+from main.search import get_search_backend
+from main.protocols import PROTOCOLS
+from main.sync import seq_filter
+from main.thumbnails import render_variants, store_when_rendered
+from main.uploads import finalize_upload
+from main.ws_middleware import get_user
+from main.ws_urls import URL_PATTERNS
+from main.models import (Chat, ChatMember, Group, MediaBlob, Message, MessageController, Photo, Profile, SeenUser,
+                         SocketEvent, UploadSession, Video)
+
+
+def create_user(username):
+    return User.objects.create_user(username=username, first_name=username, last_name="test", password="pass")
+
+
+class ChatListQueryCountTest(TestCase):
+    # count, chats, members, inbox rows, seen users
+    list_queries = 5
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_chats(self, count):
+        for i in range(count):
+            friend = create_user(f"friend_{Chat.objects.count()}")
+            chat = Chat.objects.create_private_chat(self.user.id, friend.id)
+            Message.objects.create_message(chat.id, friend, text=f"hello {i}")
+            Message.objects.create_message(chat.id, self.user, text=f"hi {i}")
+
+            group = Group.objects.create_group(f"group_{i}", self.user.id, f"invite_{friend.id}")
+            group.chat.join_chat(friend)
+            Message.objects.create_message(group.chat.id, friend, text=f"welcome {i}")
+
+    def count_list_queries(self, limit):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("get-all-chats"), {"limit": limit})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), limit)
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        self.add_chats(10)
+        small_page = self.count_list_queries(2)
+        full_page = self.count_list_queries(20)
+
+        self.assertEqual(small_page, self.list_queries)
+        self.assertEqual(full_page, self.list_queries)
+
+    def test_list_matches_single_chat_serializer(self):
+        self.add_chats(2)
+        response = self.client.get(reverse("get-all-chats"))
+
+        for item in response.data["results"]:
+            details = self.client.get(reverse("get-chats-details", args=[item["id"]]))
+            self.assertEqual(item, details.data)
+
+
+class ChatInboxTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        self.first = Message.objects.create_message(self.chat.id, self.friend, text="first")
+        self.last = Message.objects.create_message(self.chat.id, self.user, text="last")
+
+    def previews(self):
+        return dict(ChatMember.objects.filter(chat=self.chat).values_list("member_id", "last_message_preview"))
+
+    def test_new_message_updates_every_member(self):
+        self.assertEqual(self.previews(), {self.user.id: "last", self.friend.id: "last"})
+
+    def test_delete_for_me_hides_message_for_author_only(self):
+        self.last.delete_for_me = True
+        self.last.save()
+
+        self.assertEqual(self.previews(), {self.user.id: "first", self.friend.id: "last"})
+
+    def test_delete_for_everyone_falls_back_to_previous_message(self):
+        self.last.mark_delete()
+
+        self.assertEqual(self.previews(), {self.user.id: "first", self.friend.id: "first"})
+
+
+class ReadWatermarkTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        self.messages = [Message.objects.create_message(self.chat.id, self.friend, text=f"text {i}")
+                         for i in range(3)]
+        self.controllers = [message.message_controller for message in self.messages]
+
+    def test_mark_seen_moves_watermark_forward_only(self):
+        MessageController.objects.mark_seen(self.chat.id, self.user.id, self.user.id, self.controllers[1].id)
+        self.assertEqual(self.chat.unread_messages_count(self.user.id), 1)
+
+        MessageController.objects.mark_seen(self.chat.id, self.user.id, self.user.id, self.controllers[0].id)
+        self.assertEqual(self.chat.unread_messages_count(self.user.id), 1)
+
+    def test_seen_by_is_derived_from_watermarks(self):
+        MessageController.objects.mark_seen(self.chat.id, self.user.id, self.user.id, self.controllers[1].id)
+        data = AllMessageSerializer(self.controllers, many=True, context={"user": self.user}).data
+        seen_by = [[user["id"] for user in item.get("seen_by", [])] for item in data]
+
+        self.assertEqual(seen_by, [[self.user.id], [self.user.id], []])
+
+    def test_backfill_from_seen_users(self):
+        SeenUser.objects.create(message=self.controllers[2], user=self.user)
+        call_command("backfill_read_watermarks", stdout=StringIO())
+
+        self.assertEqual(self.chat.unread_messages_count(self.user.id), 0)
+
+
+class LoadTestSeedTest(TestCase):
+    def test_seeded_users_log_in_and_find_their_chats(self):
+        call_command("seed_load_test", users=30, chats=20, burst_groups=1, burst_group_size=25, messages=200,
+                     stdout=StringIO())
+
+        client = APIClient(SERVER_NAME="localhost")
+        response = client.post(reverse("login"), {"username": "load_0", "password": BENCH_PASSWORD}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['token']}")
+        chats = client.get(reverse("get-all-chats"), {"limit": 50}).data["results"]
+        self.assertTrue(chats)
+        self.assertEqual(MessageController.objects.count(), 200)
+        self.assertEqual(Chat.objects.filter(members__isnull=False).annotate(size=Count("members"))
+                         .order_by("-size").values_list("size", flat=True).first(), 25)
+
+
+class DeleteMessageViewTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def delete(self, message, **extra):
+        return self.client.post(reverse("delete-message", args=[self.chat.id]),
+                                {"type": "message", "message_id": message.id, **extra}, format="json")
+
+    def test_delete_for_everyone(self):
+        message = Message.objects.create_message(self.chat.id, self.user, text="hello")
+
+        self.assertEqual(self.delete(message, for_everyone=True).status_code, 204)
+        self.assertTrue(MessageController.objects.get(message=message).is_deleted)
+
+    def test_delete_for_me(self):
+        message = Message.objects.create_message(self.chat.id, self.user, text="hello")
+
+        self.assertEqual(self.delete(message).status_code, 204)
+        controller = MessageController.objects.get(message=message)
+        self.assertEqual((controller.is_deleted, controller.delete_for_me), (False, True))
+
+    def test_only_own_messages(self):
+        message = Message.objects.create_message(self.chat.id, self.friend, text="hello")
+
+        self.assertEqual(self.delete(message, for_everyone=True).status_code, 404)
+
+
+class MessageCursorPaginationTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        for i in range(7):
+            Message.objects.create_message(self.chat.id, self.friend, text=f"text {i}")
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse("get-messages", args=[self.chat.id])
+
+    def test_before_cursor_walks_history_newest_first(self):
+        texts, params = [], {"limit": 3, "before": "", "no_total": 1}
+        while True:
+            data = self.client.get(self.url, params).data
+            texts += [item["text"] for item in data["results"]]
+            if not data["has_more"]:
+                break
+            params["before"] = data["before"]
+
+        self.assertIsNone(data["total"])
+        self.assertEqual(texts, [f"text {i}" for i in reversed(range(7))])
+
+    def test_after_cursor_returns_newer_messages(self):
+        first_page = self.client.get(self.url, {"limit": 2, "before": ""}).data
+        oldest = self.client.get(self.url, {"limit": 2, "before": first_page["before"]}).data
+        newer = self.client.get(self.url, {"limit": 2, "after": oldest["after"]}).data
+
+        self.assertEqual(first_page["total"], 7)
+        self.assertEqual(newer["results"], first_page["results"])
+
+    def test_limit_offset_shape_is_kept(self):
+        data = self.client.get(self.url, {"limit": 2, "offset": 2}).data
+
+        self.assertEqual(set(data), {"total", "offset", "limit", "results"})
+        self.assertEqual(data["total"], 7)
+
+    def test_rank_order_is_rejected_with_cursors(self):
+        response = self.client.get(self.url, {"content": "text", "order": "rank", "before": ""})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.data["details"]), 1)
+        self.assertEqual(self.client.get(self.url, {"content": "text", "order": "rank"}).status_code, 200)
+
+
+class MessageSearchTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        self.other_chat = Chat.objects.create_private_chat(self.user.id, create_user("other").id)
+
+        Message.objects.create_message(self.chat.id, self.friend, text="lunch tomorrow?")
+        Message.objects.create_message(self.chat.id, self.user, text="Sure, see you at lunch")
+        Message.objects.create_message(self.chat.id, self.user, text="bring the invoice")
+        Message.objects.create_message(self.other_chat.id, self.user, text="lunch is cancelled")
+
+    def search(self, text):
+        messages = self.chat.get_messages(self.user, text)
+        return sorted(message.message.text for message in messages)
+
+    def test_index_matches_substrings_inside_one_chat(self):
+        self.assertEqual(self.search("LUNC"), ["Sure, see you at lunch", "lunch tomorrow?"])
+
+    def test_short_queries_fall_back_to_like(self):
+        self.assertEqual(self.search("?"), ["lunch tomorrow?"])
+
+    def test_edited_and_deleted_messages_are_reindexed(self):
+        message = Message.objects.get(text="bring the invoice")
+        message.text = "bring the receipt"
+        message.save()
+        self.assertEqual(self.search("invoice"), [])
+        self.assertEqual(self.search("receipt"), ["bring the receipt"])
+
+        message.mark_delete()
+        self.assertEqual(self.search("receipt"), [])
+
+
+class GlobalSearchTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.chats = [Chat.objects.create_private_chat(self.user.id, create_user(f"friend_{i}").id) for i in range(2)]
+        Message.objects.create_message(self.chats[0].id, self.user, text="the budget is ready")
+        Message.objects.create_message(self.chats[1].id, self.user, text="budget meeting at noon")
+        hidden = Message.objects.create_message(self.chats[1].id, self.user, text="old budget draft")
+        hidden.delete_for_me = True
+        hidden.save()
+
+        stranger_chat = Chat.objects.create_private_chat(create_user("a").id, create_user("b").id)
+        Message.objects.create_message(stranger_chat.id, stranger_chat.members.first().member, text="budget")
+
+    def test_hits_are_grouped_by_chat_with_snippets(self):
+        data = self.client.get(reverse("search-messages"), {"q": "budget"}).data
+
+        self.assertEqual(data["total"], 2)
+        self.assertEqual([group["chat"]["id"] for group in data["results"]], [self.chats[1].id, self.chats[0].id])
+        self.assertIn("<b>budget</b>", data["results"][0]["messages"][0]["snippet"])
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get(reverse("search-messages")).status_code, 400)
+
+
+class ChatTitleSearchTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        self.peer = create_user("margaret")
+        self.private_chat = Chat.objects.create_private_chat(self.user.id, self.peer.id)
+        self.group = Group.objects.create_group("Weekend hiking", self.user.id, "hiking")
+
+    def find(self, title):
+        response = self.client.get(reverse("get-all-chats"), {"title": title})
+        return [chat["id"] for chat in response.data["results"]]
+
+    def test_finds_group_and_peer_names(self):
+        self.assertEqual(self.find("hiking"), [self.group.chat.id])
+        self.assertEqual(self.find("garet"), [self.private_chat.id])
+        self.assertEqual(self.find("owner"), [])
+
+    def test_joining_a_group_writes_only_the_new_title(self):
+        backend = get_search_backend()
+        for i in range(8):
+            self.group.chat.join_chat(create_user(f"member_{i}"))
+
+        with patch.object(backend, "index_chat_titles", wraps=backend.index_chat_titles) as index:
+            self.group.chat.join_chat(create_user("late"))
+
+        self.assertEqual([len(call.args[0]) for call in index.call_args_list], [1])
+        self.assertEqual(ChatMember.objects.filter(chat=self.group.chat, search_title="Weekend hiking").count(), 10)
+
+    def test_titles_follow_renames(self):
+        self.group.name = "Climbing club"
+        self.group.save()
+        self.peer.first_name = "Peggy"
+        self.peer.save()
+
+        self.assertEqual(self.find("hiking"), [])
+        self.assertEqual(self.find("climb"), [self.group.chat.id])
+        self.assertEqual(self.find("peggy"), [self.private_chat.id])
+
+
+class UserSearchTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        for i in range(6):
+            friend = create_user(f"pat_{i}")
+            friend.profile.phone_number = f"91234500{i:02d}"
+            friend.profile.save()
+            friend.profile.block(self.user.id)
+
+    def search(self, query, limit=10):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("get-users-list"), {"q": query, "limit": limit})
+        return response.data, len(ctx.captured_queries)
+
+    def test_matches_names_and_phone_numbers(self):
+        self.assertEqual(self.search("pat_3")[0]["total"], 1)
+        self.assertEqual(self.search("1234500")[0]["total"], 6)
+        self.assertEqual(self.search("pa")[0]["total"], 6)
+        self.assertEqual(self.search("91")[0]["total"], 6)
+
+    def test_short_queries_match_word_prefixes_in_any_case(self):
+        create_user("Alice")
+        create_user("Cal")
+
+        self.assertEqual([user["username"] for user in self.search("aL")[0]["results"]], ["Alice"])
+
+    def test_users_are_found_after_rebuilding_the_index(self):
+        call_command("rebuild_search_index", batch_size=4, stdout=StringIO())
+
+        self.assertEqual(self.search("pat_3")[0]["total"], 1)
+        self.assertEqual(self.search("1234500")[0]["total"], 6)
+
+    def test_block_status_is_batched(self):
+        small, small_queries = self.search("pat", limit=2)
+        full, full_queries = self.search("pat", limit=6)
+
+        self.assertEqual(small_queries, full_queries)
+        self.assertTrue(all(user["is_blocked"] for user in full["results"]))
+
+
+class DeltaSyncTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, cursor=""):
+        response = self.client.get(reverse("sync"), {"cursor": cursor})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def send(self, text, author=None):
+        return Message.objects.create_message(self.chat.id, author or self.friend, text=text)
+
+    def last_seq(self):
+        return Chat.objects.get(id=self.chat.id).last_seq
+
+    def test_seq_grows_on_create_edit_delete_and_seen(self):
+        message = self.send("first")
+        seqs = [message.message_controller.seq]
+
+        message.text = "edited"
+        message.save()
+        seqs.append(MessageController.objects.get(message=message).seq)
+
+        MessageController.objects.mark_seen(self.chat.id, self.friend.id, self.user.id, message.message_controller.id)
+        seqs.append(ChatMember.objects.get(chat=self.chat, member=self.user).read_seq)
+
+        message.mark_delete()
+        seqs.append(MessageController.objects.get(message=message).seq)
+
+        self.assertEqual(seqs, sorted(set(seqs)))
+        self.assertEqual(self.last_seq(), seqs[-1])
+
+    def test_chat_seq_and_controller_change_together(self):
+        message = self.send("first")
+        last_seq = self.last_seq()
+
+        message.text = "edited"
+        with patch.object(ChatMember.objects, "update_inbox", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                message.save()
+
+        self.assertEqual(self.last_seq(), last_seq)
+        self.assertEqual(MessageController.objects.get(message=message).seq, last_seq)
+
+    def test_first_sync_returns_chats_without_history(self):
+        self.send("old")
+        data = self.sync()
+
+        self.assertEqual([chat["id"] for chat in data["chats"]], [self.chat.id])
+        self.assertEqual(data["messages"], [])
+
+    def test_returns_only_changes_after_cursor(self):
+        old = self.send("old")
+        cursor = self.sync()["cursor"]
+
+        new = self.send("new")
+        old.text = "old edited"
+        old.save()
+        MessageController.objects.mark_seen(self.chat.id, self.user.id, self.friend.id, new.message_controller.id)
+        data = self.sync(cursor)
+
+        self.assertEqual([(item["id"], item["text"]) for item in data["messages"]],
+                         [(new.id, "new"), (old.id, "old edited")])
+        self.assertEqual(data["reads"], [{"chat_id": self.chat.id, "user_id": self.friend.id,
+                                          "message_id": new.id, "type": "message"}])
+        self.assertEqual(self.sync(data["cursor"])["messages"], [])
+
+    def test_deleted_messages_carry_no_content(self):
+        message = self.send("secret")
+        cursor = self.sync()["cursor"]
+        message.mark_delete()
+
+        self.assertEqual(self.sync(cursor)["messages"], [
+            {"id": message.id, "type": "message", "chat_id": self.chat.id,
+             "seq": self.last_seq(), "is_deleted": True},
+        ])
+
+    def test_queries_do_not_grow_with_history(self):
+        def sync_one_change(history):
+            for i in range(history):
+                self.send(f"history {i}")
+            cursor = self.sync()["cursor"]
+            self.send("change")
+
+            with CaptureQueriesContext(connection) as ctx:
+                data = self.sync(cursor)
+            self.assertEqual(len(data["messages"]), 1)
+            return len(ctx.captured_queries)
+
+        self.assertEqual(sync_one_change(1), sync_one_change(30))
+
+    @override_settings(SYNC_CHANGE_LIMIT=2)
+    def test_chats_far_behind_are_truncated(self):
+        cursor = self.sync()["cursor"]
+        for i in range(3):
+            self.send(f"burst {i}")
+        data = self.sync(cursor)
+
+        self.assertEqual(data["truncated_chats"], [self.chat.id])
+        self.assertEqual(data["messages"], [])
+
+    def test_left_chats_are_removed(self):
+        group = Group.objects.create_group("group", self.friend.id, "group-link")
+        group.chat.join_chat(self.user)
+        cursor = self.sync()["cursor"]
+        group.chat.leave_chat(self.user)
+
+        self.assertEqual(self.sync(cursor)["removed_chats"], [group.chat.id])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("sync"), {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_is_posted(self):
+        cursor = self.sync()["cursor"]
+        message = self.send("posted")
+
+        response = self.client.post(reverse("sync"), {"cursor": cursor}, format="json")
+        self.assertEqual([item["id"] for item in response.data["messages"]], [message.id])
+
+    @override_settings(SYNC_CURSOR_MAX_SIZE=8)
+    def test_cursor_size_is_capped(self):
+        response = self.client.post(reverse("sync"), {"cursor": "A" * 9}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post(reverse("sync"), {"cursor": 5}, format="json").status_code, 400)
+
+
+class ChunkedUploadTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.parts = os.path.join(directory.name, "parts")
+        settings_override = override_settings(UPLOAD_TEMP_DIR=self.parts,
+                                              MEDIA_ROOT=directory.name, UPLOAD_CHUNK_SIZE=1024)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def init(self, kind, size, **extra):
+        file_name = "image.png" if kind == "photo" else "clip.mp4"
+        response = self.client.post(reverse("upload-init"), {"type": kind, "chat_id": self.chat.id,
+                                                             "file_name": file_name, "size": size, **extra},
+                                    format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.data["id"]
+
+    def append(self, pk, offset, chunk):
+        return self.client.post(f"{reverse('upload-chunk', args=[pk])}?offset={offset}", chunk,
+                                content_type="application/octet-stream")
+
+    def upload(self, kind, content, **extra):
+        pk = self.init(kind, len(content), **extra)
+        for offset in range(0, len(content), 1024):
+            self.assertEqual(self.append(pk, offset, content[offset:offset + 1024]).status_code, 200)
+        return pk
+
+    def test_video_is_assembled_from_chunks(self):
+        content = os.urandom(2500)
+        pk = self.upload("video", content, caption="holiday")
+
+        response = self.client.post(reverse("upload-finalize", args=[pk]))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["caption"], "holiday")
+
+        video = Video.objects.get(id=response.data["id"])
+        with video.video.open("rb") as file:
+            self.assertEqual(file.read(), content)
+        self.assertEqual(video.video_controller.chat_id, self.chat.id)
+        self.assertEqual(os.listdir(self.parts), [])
+
+    def test_resume_after_wrong_offset(self):
+        content = os.urandom(2000)
+        pk = self.init("video", len(content))
+        self.append(pk, 0, content[:1024])
+
+        response = self.append(pk, 0, content[:1024])
+        self.assertEqual((response.status_code, response.data["offset"]), (409, 1024))
+        self.assertEqual(self.client.get(reverse("upload-details", args=[pk])).data["offset"], 1024)
+
+        self.assertEqual(self.append(pk, 1024, content[1024:]).data["offset"], 2000)
+
+    def test_chunks_larger_than_the_limit_are_rejected(self):
+        pk = self.init("video", 4096)
+        self.assertEqual(self.append(pk, 0, os.urandom(2048)).status_code, 400)
+
+    def test_photo_finalize_is_idempotent(self):
+        image = BytesIO()
+        Image.new("RGB", (32, 32), "red").save(image, "PNG")
+        pk = self.upload("photo", image.getvalue())
+
+        first = self.client.post(reverse("upload-finalize", args=[pk]))
+        second = self.client.post(reverse("upload-finalize", args=[pk]))
+
+        self.assertEqual((first.status_code, second.status_code), (201, 200))
+        self.assertEqual(first.data["id"], second.data["id"])
+        self.assertEqual(MessageController.objects.filter(photo_id=first.data["id"]).count(), 1)
+
+    def test_incomplete_upload_is_not_finalized(self):
+        pk = self.init("video", 2000)
+        self.append(pk, 0, os.urandom(1024))
+
+        response = self.client.post(reverse("upload-finalize", args=[pk]))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(MessageController.objects.filter(chat=self.chat).exists())
+
+    def test_only_members_open_sessions(self):
+        stranger = create_user("stranger")
+        self.client.force_authenticate(stranger)
+        response = self.client.post(reverse("upload-init"), {"type": "video", "chat_id": self.chat.id,
+                                                             "file_name": "clip.mp4", "size": 10}, format="json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_reply_is_a_message_of_the_same_chat(self):
+        message = Message.objects.create_message(self.chat.id, self.friend, text="send the clip")
+        other_chat = Chat.objects.create_private_chat(self.user.id, create_user("other").id)
+        elsewhere = Message.objects.create_message(other_chat.id, self.user, text="elsewhere")
+
+        for reply_id in (999999, elsewhere.id):
+            response = self.client.post(reverse("upload-init"), {"type": "video", "chat_id": self.chat.id,
+                                                                 "file_name": "clip.mp4", "size": 10,
+                                                                 "reply_id": reply_id}, format="json")
+            self.assertEqual(response.status_code, 400)
+
+        pk = self.upload("video", os.urandom(10), reply_id=message.id)
+        video = Video.objects.get(id=self.client.post(reverse("upload-finalize", args=[pk])).data["id"])
+        self.assertEqual(video.video_controller.reply_id, message.message_controller.id)
+
+
+def png_image(width, height, exif=None):
+    image = BytesIO()
+    Image.new("RGB", (width, height), "red").save(image, "JPEG" if exif else "PNG", exif=exif or b"")
+    return image.getvalue()
+
+
+class PhotoVariantTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name, THUMBNAIL_WORKERS=0,
+                                              THUMBNAIL_SIZES={"thumb": 32, "medium": 128})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+
+    def test_variants_are_rendered_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            photo = Photo.objects.create_message(self.chat.id, self.user,
+                                                 image=ContentFile(png_image(400, 200), name="wide.png"))
+
+        photo.refresh_from_db()
+        self.assertEqual((photo.width, photo.height), (400, 200))
+        self.assertTrue(photo.placeholder.startswith("data:image/webp;base64,"))
+
+        variants = PhotoSerializer(photo).data["variants"]
+        self.assertEqual(set(variants), {"thumb", "medium"})
+        self.assertEqual(set(variants["thumb"]), {"webp", "jpeg"})
+        self.assertEqual((variants["thumb"]["webp"]["width"], variants["thumb"]["webp"]["height"]), (32, 16))
+        self.assertTrue(photo.image.storage.exists(photo.variants["medium"]["jpeg"]["name"]))
+
+    def test_dimensions_follow_exif_orientation(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        result = render_variants(png_image(40, 20, exif.tobytes()), {"thumb": 10}, ("jpeg",), 80)
+
+        self.assertEqual((result["width"], result["height"]), (20, 40))
+        self.assertEqual(result["variants"]["thumb"]["jpeg"][1:], (5, 10))
+
+    def test_rebuild_renders_missing_variants(self):
+        Photo.objects.create_message(self.chat.id, self.user, image=ContentFile(png_image(64, 64), name="a.png"))
+        call_command("rebuild_thumbnails", stdout=StringIO())
+
+        self.assertFalse(Photo.objects.filter(variants={}).exists())
+
+    def test_failed_render_is_logged_and_keeps_the_original(self):
+        photo = Photo.objects.create_message(self.chat.id, self.user,
+                                             image=ContentFile(png_image(64, 64), name="a.png"))
+        future = Future()
+        future.set_exception(OSError("cannot identify image file"))
+
+        with self.assertLogs("main.thumbnails", "ERROR") as logs:
+            store_when_rendered(photo.id, future)
+
+        self.assertIn(f"photo {photo.id}", logs.output[0])
+        photo.refresh_from_db()
+        self.assertEqual(photo.variants, {})
+        self.assertTrue(photo.image.storage.exists(photo.image.name))
+
+
+class MediaDeduplicationTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name, THUMBNAIL_WORKERS=0,
+                                              THUMBNAIL_SIZES={"thumb": 32},
+                                              UPLOAD_TEMP_DIR=os.path.join(directory.name, "parts"))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        self.content = os.urandom(3000)
+
+    def send_video(self, name="clip.mp4"):
+        return Video.objects.create_message(self.chat.id, self.user, video=ContentFile(self.content, name=name))
+
+    def references(self, name):
+        return MediaBlob.objects.filter(name=name).values_list("references", flat=True).first()
+
+    def test_same_content_is_stored_once(self):
+        first, second = self.send_video("a.mp4"), self.send_video("b.mp4")
+
+        self.assertEqual(first.video.name, second.video.name)
+        self.assertEqual(first.video.name, f"blobs/{hashlib.sha256(self.content).hexdigest()[:2]}/"
+                                           f"{hashlib.sha256(self.content).hexdigest()}.mp4")
+        self.assertEqual(self.references(first.video.name), 2)
+
+    def test_file_goes_with_the_last_reference(self):
+        first, second = self.send_video(), self.send_video()
+        storage = first.video.storage
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(storage.exists(second.video.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(storage.exists(second.video.name))
+        self.assertFalse(MediaBlob.objects.exists())
+
+    def test_duplicate_photo_shares_variants(self):
+        image = png_image(64, 64)
+        with self.captureOnCommitCallbacks(execute=True):
+            first = Photo.objects.create_message(self.chat.id, self.user, image=ContentFile(image, name="a.png"))
+        with self.captureOnCommitCallbacks(execute=True):
+            second = Photo.objects.create_message(self.chat.id, self.user, image=ContentFile(image, name="b.png"))
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.variants, second.variants)
+        self.assertEqual(self.references(second.variants["thumb"]["webp"]["name"]), 2)
+
+    def test_known_content_skips_the_upload(self):
+        stored = self.send_video()
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post(reverse("upload-init"), {
+            "type": "video", "chat_id": self.chat.id, "file_name": "again.mp4", "size": len(self.content),
+            "sha256": hashlib.sha256(self.content).hexdigest(),
+        }, format="json")
+        self.assertEqual(response.data["offset"], len(self.content))
+
+        response = client.post(reverse("upload-finalize", args=[response.data["id"]]))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Video.objects.get(id=response.data["id"]).video.name, stored.video.name)
+        self.assertEqual(self.references(stored.video.name), 2)
+
+    def test_concurrent_finalize_creates_one_message(self):
+        self.send_video()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        pk = client.post(reverse("upload-init"), {
+            "type": "video", "chat_id": self.chat.id, "file_name": "again.mp4", "size": len(self.content),
+            "sha256": hashlib.sha256(self.content).hexdigest(),
+        }, format="json").data["id"]
+
+        # both requests loaded the session before either of them finalized it
+        first, second = UploadSession.objects.get(id=pk), UploadSession.objects.get(id=pk)
+        created, _ = finalize_upload(first, self.user)
+        returned, was_created = finalize_upload(second, self.user)
+
+        self.assertFalse(was_created)
+        self.assertEqual(returned.data["id"], created.data["id"])
+        self.assertEqual(Video.objects.count(), 2)
+        self.assertEqual(self.references(created.instance.video.name), 2)
+
+    def test_digest_with_another_size_is_not_trusted(self):
+        self.send_video()
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post(reverse("upload-init"), {
+            "type": "video", "chat_id": self.chat.id, "file_name": "again.mp4", "size": 10,
+            "sha256": hashlib.sha256(self.content).hexdigest(),
+        }, format="json")
+        self.assertEqual(response.data["offset"], 0)
+
+    def test_content_of_others_is_not_claimed_by_digest(self):
+        self.send_video()
+        client = APIClient()
+        client.force_authenticate(self.friend)
+
+        response = client.post(reverse("upload-init"), {
+            "type": "video", "chat_id": self.chat.id, "file_name": "again.mp4", "size": len(self.content),
+            "sha256": hashlib.sha256(self.content).hexdigest(),
+        }, format="json")
+        self.assertEqual(response.data["offset"], 0)
+
+
+class MediaServingTest(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name, THUMBNAIL_WORKERS=0,
+                                              THUMBNAIL_SIZES={"thumb": 32}, MEDIA_SENDFILE=None)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        self.content = os.urandom(1000)
+        self.video = Video.objects.create_message(self.chat.id, self.user,
+                                                  video=ContentFile(self.content, name="clip.mp4"))
+        self.url = reverse("media", args=["video", self.video.id])
+        self.client = APIClient()
+        self.client.force_authenticate(self.friend)
+
+    def get(self, url=None, **headers):
+        response = self.client.get(url or self.url, headers=headers)
+        body = b"".join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def test_members_get_the_whole_file_with_one_query(self):
+        with self.assertNumQueries(1):
+            response, body = self.get()
+
+        self.assertEqual((response.status_code, body), (200, self.content))
+        self.assertEqual(response["ETag"], f'"{hashlib.sha256(self.content).hexdigest()}"')
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertIn("immutable", response["Cache-Control"])
+
+    def test_byte_ranges(self):
+        response, body = self.get(Range="bytes=10-19")
+        self.assertEqual((response.status_code, body), (206, self.content[10:20]))
+        self.assertEqual(response["Content-Range"], "bytes 10-19/1000")
+
+        response, body = self.get(Range="bytes=-5")
+        self.assertEqual((response.status_code, body), (206, self.content[-5:]))
+
+        response, _ = self.get(Range="bytes=2000-")
+        self.assertEqual((response.status_code, response["Content-Range"]), (416, "bytes */1000"))
+
+    def test_conditional_requests(self):
+        etag = self.get()[0]["ETag"]
+
+        self.assertEqual(self.get(If_None_Match=etag)[0].status_code, 304)
+        response, body = self.get(Range="bytes=0-9", If_Range='"stale"')
+        self.assertEqual((response.status_code, body), (200, self.content))
+
+    def test_other_users_get_nothing(self):
+        self.client.force_authenticate(create_user("stranger"))
+        self.assertEqual(self.get()[0].status_code, 404)
+
+    @override_settings(MEDIA_SENDFILE="x-accel")
+    def test_web_server_sends_the_bytes(self):
+        response, body = self.get(Range="bytes=0-9")
+
+        self.assertEqual((response.status_code, body), (200, b""))
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected-media/{self.video.video.name}")
+
+    def test_photo_variants_are_served(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            photo = Photo.objects.create_message(self.chat.id, self.user,
+                                                 image=ContentFile(png_image(64, 64), name="a.png"))
+        photo.refresh_from_db()
+        url = PhotoSerializer(photo).data["variants"]["thumb"]["jpeg"]["url"]
+
+        response, body = self.get(url)
+        self.assertEqual((response.status_code, response["Content-Type"]), (200, "image/jpeg"))
+        self.assertEqual(Image.open(BytesIO(body)).size, (32, 32))
+
+
+@override_settings(CHAT_ACTIVITY_WINDOW=0)
+class CreateMessageQueryCountTest(TestCase):
+    # content insert, chat sequence and timestamp, controller insert, inbox rows, search index
+    create_queries = 5
+
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        # savepoints of the surrounding TestCase transaction are not statements of the write path
+        return len([query for query in ctx.captured_queries if "SAVEPOINT" not in query["sql"]])
+
+    def test_service_writes_less_than_signal_path(self):
+        signal_path = self.count_queries(lambda: Message.objects.create(chat=self.chat, author=self.user, text="a"))
+        service_path = self.count_queries(lambda: Message.objects.create_message(self.chat.id, self.user, text="b"))
+
+        self.assertEqual(service_path, self.create_queries)
+        self.assertLess(service_path, signal_path)
+
+    def test_created_message_matches_signal_path(self):
+        legacy = Message.objects.create(chat=self.chat, author=self.user, text="legacy")
+        created = Message.objects.create_message(self.chat.id, self.user, text="service")
+
+        fields = ("chat_id", "author_id", "reply_id", "is_deleted", "delete_for_me")
+        legacy_controller = MessageController.objects.get(message=legacy)
+        controller = MessageController.objects.get(message=created)
+        self.assertEqual([getattr(controller, f) for f in fields], [getattr(legacy_controller, f) for f in fields])
+        self.assertEqual(ChatMember.objects.get(chat=self.chat, member=self.friend).last_message_id, controller.id)
+
+    def test_create_message_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(reverse("create-message", args=[self.chat.id]), {"type": "message", "text": "hey"},
+                               format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["text"], "hey")
+        self.assertEqual(response.data["type"], "message")
+        self.assertEqual(response.data["author"]["id"], self.user.id)
+
+
+@override_settings(CHAT_ACTIVITY_WINDOW=60)
+@skipUnless(connection.vendor == "sqlite", "plans are read from SQLite's EXPLAIN QUERY PLAN")
+class QueryPlanTest(TestCase):
+    # without ANALYZE statistics SQLite plans for large tables, small test data still gets production plans
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        Message.objects.create_message(self.chat.id, self.friend, text="hello")
+
+    def assert_plan(self, queryset, *indexes, ordered=False):
+        plan = queryset.explain()
+        scans = [line for line in plan.splitlines() if re.search(r"\bSCAN (?!CONSTANT ROW)\S+$", line)]
+        self.assertEqual(scans, [], f"full table scan:\n{plan}")
+        for index in indexes:
+            self.assertIn(f" {index} ", plan + " ")
+        if ordered:
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_inbox(self):
+        chats = Chat.filtered_objects.filter(members__is_deleted=False, members__member=self.user) \
+            .order_by("-members__inbox_order").with_user_data(self.user)[:20]
+        self.assert_plan(chats, "chat_member_inbox_idx", "message_chat_unread_idx", ordered=True)
+
+    def test_message_history(self):
+        messages = self.chat.get_messages(self.user).order_by("-created_at", "-id")[:50]
+        self.assert_plan(messages, "message_chat_created_idx", ordered=True)
+        self.assert_plan(MessageController.filtered_objects.filter(chat_id=self.chat.id)[:1],
+                         "message_chat_created_idx", ordered=True)
+
+    def test_unread_count(self):
+        unread = self.chat.chat_messagecontrollers.filter(is_deleted=False, id__gt=0) \
+            .exclude(author_id=self.user.id).order_by()
+        self.assert_plan(unread, "message_chat_unread_idx")
+
+    def test_delta_sync(self):
+        changes = MessageController.objects.filter(seq_filter({self.chat.id: 0}, {self.chat.id: 5}, "seq")) \
+            .order_by("chat_id", "seq")
+        self.assert_plan(changes, "message_chat_seq_idx", ordered=True)
+        self.assert_plan(ChatMember.filtered_objects.filter(member=self.user, chat__is_deleted=False),
+                         "chat_member_inbox_idx")
+
+    def test_blocked_users(self):
+        profile = self.user.profile
+        self.assert_plan(profile.block_list(), "blocked_user_by_idx")
+        self.assert_plan(UserBaseView().with_block_status(User.objects.filter(id=self.friend.id), self.user))
+
+    def test_seen_users(self):
+        self.assert_plan(SeenUser.objects.filter(user=self.user, message__chat=self.chat), "seen_user_message_idx")
+
+    def test_user_search(self):
+        backend = get_search_backend()
+        self.assert_plan(backend.filter_users(User.objects.all(), "ow"), "main_user_prefix_search")
+        self.assert_plan(backend.filter_users(User.objects.all(), "owner"), "main_user_search")
+
+    def test_recent_chats(self):
+        self.assert_plan(Chat.filtered_objects.all()[:20], "chat_updated_idx", ordered=True)
+
+
+class ChatActivityTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.group = Group.objects.create_group("burst", self.user.id, "burst")
+        self.chat = self.group.chat
+
+    def test_touch_is_coalesced_within_window(self):
+        Chat.objects.filter(id=self.chat.id).update(updated_at=timezone.now() - timedelta(minutes=5))
+        recent_chat_touches.pop(self.chat.id, None)
+
+        self.assertEqual(Chat.objects.touch(self.chat.id), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(Chat.objects.touch(self.chat.id), 0)
+
+    def test_stored_value_inside_window_is_not_rewritten(self):
+        recent_chat_touches.pop(self.chat.id, None)
+
+        self.assertEqual(Chat.objects.touch(self.chat.id), 0)
+
+
+class ChatGroupFanOutTest(TransactionTestCase):
+    def setUp(self):
+        self.owner = create_user("owner")
+        self.friend = create_user("friend")
+        self.group = Group.objects.create_group("fan out", self.owner.id, "fan-out")
+        self.chat = self.group.chat
+        self.chat.join_chat(self.friend)
+        get_presence_backend().clear()
+
+    async def connect(self, path, user):
+        communicator = WebsocketCommunicator(URLRouter(URL_PATTERNS), path)
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_message(self, communicator):
+        # skips the online status events of sockets opened by the test
+        while True:
+            data = await communicator.receive_json_from()
+            if data["action"] != "online_status":
+                return data
+
+    async def test_one_send_reaches_every_member_socket(self):
+        listener = await self.connect("/ws/chat/", self.friend)
+        sender = await self.connect(f"/ws/chat/{self.chat.id}/", self.owner)
+
+        await sender.send_json_to({"message": "hi", "action": "new_message"})
+
+        self.assertEqual((await self.receive_message(listener))["message"], "hi")
+        self.assertEqual((await self.receive_message(sender))["message"], "hi")
+
+        await sender.disconnect()
+        await listener.disconnect()
+
+    async def test_viewer_fields_are_personalized_per_recipient(self):
+        await database_sync_to_async(Message.objects.create_message)(self.chat.id, self.owner, text="one")
+        await database_sync_to_async(Message.objects.create_message)(self.chat.id, self.owner, text="two")
+
+        listener = await self.connect("/ws/chat/", self.friend)
+        sender = await self.connect(f"/ws/chat/{self.chat.id}/", self.owner)
+        await sender.send_json_to({"message": "ping"})
+
+        received = (await self.receive_message(listener))["updated_chat"]
+        echoed = (await self.receive_message(sender))["updated_chat"]
+
+        self.assertEqual(received["unread_messages"], 2)
+        self.assertFalse(received["last_message"]["sent_by_me"])
+        self.assertEqual(echoed["unread_messages"], 0)
+        self.assertTrue(echoed["last_message"]["sent_by_me"])
+        self.assertEqual(received["title"], echoed["title"])
+
+        await sender.disconnect()
+        await listener.disconnect()
+
+    def test_broadcast_serialization_query_count_is_fixed(self):
+        other = Group.objects.create_group("second", self.owner.id, "second").chat
+        other.join_chat(self.friend)
+        Message.objects.create_message(other.id, self.friend, text="hello")
+
+        with CaptureQueriesContext(connection) as one:
+            async_to_sync(serialize_chats)([self.chat.id], self.owner)
+        with CaptureQueriesContext(connection) as two:
+            chats = async_to_sync(serialize_chats)([self.chat.id, other.id], self.owner)
+
+        self.assertEqual(len(one), len(two))
+        self.assertEqual(set(chats[other.id][1]), {str(self.owner.id), str(self.friend.id)})
+
+    async def test_msgpack_clients_get_compact_binary_frames(self):
+        await database_sync_to_async(Message.objects.create_message)(self.chat.id, self.owner, text="one")
+
+        listener = WebsocketCommunicator(URLRouter(URL_PATTERNS), "/ws/chat/", subprotocols=["msgpack", "json"])
+        listener.scope["user"] = self.friend
+        connected, subprotocol = await listener.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, "msgpack")
+
+        sender = await self.connect(f"/ws/chat/{self.chat.id}/", self.owner)
+        await sender.send_to(bytes_data=msgpack.packb({"m": "ignored"}))
+        await sender.send_json_to({"message": "hi"})
+
+        frame = msgpack.unpackb(await listener.receive_from(), strict_map_key=False)
+        while frame["a"] == "online_status":
+            frame = msgpack.unpackb(await listener.receive_from(), strict_map_key=False)
+        self.assertEqual(frame["m"], "hi")
+        self.assertIsInstance(frame["c"]["l"]["ca"], float)
+        self.assertEqual(frame["c"]["u"], 1)
+
+        echoed = await self.receive_message(sender)
+        self.assertEqual(echoed["message"], "hi")
+        self.assertIsInstance(echoed["updated_chat"]["last_message"]["created_at"], str)
+
+        await sender.disconnect()
+        await listener.disconnect()
+
+    async def test_msgpack_frames_are_decoded(self):
+        listener = await self.connect("/ws/chat/", self.friend)
+        sender = WebsocketCommunicator(URLRouter(URL_PATTERNS), f"/ws/chat/{self.chat.id}/", subprotocols=["msgpack"])
+        sender.scope["user"] = self.owner
+        await sender.connect()
+
+        await sender.send_to(bytes_data=msgpack.packb({"m": "binary", "a": "new_message"}))
+
+        received = await self.receive_message(listener)
+        self.assertEqual((received["message"], received["action"]), ("binary", "new_message"))
+
+        await sender.disconnect()
+        await listener.disconnect()
+
+    async def test_msgpack_relays_client_messages_untouched(self):
+        listener = WebsocketCommunicator(URLRouter(URL_PATTERNS), "/ws/chat/", subprotocols=["msgpack"])
+        listener.scope["user"] = self.friend
+        await listener.connect()
+        sender = WebsocketCommunicator(URLRouter(URL_PATTERNS), f"/ws/chat/{self.chat.id}/", subprotocols=["msgpack"])
+        sender.scope["user"] = self.owner
+        await sender.connect()
+
+        relayed = {"i": 5, "id": 3, "created_at": "hello", "nested": {"time": "later"}}
+        await sender.send_to(bytes_data=msgpack.packb({"a": "typing", "m": relayed}))
+
+        frame = msgpack.unpackb(await listener.receive_from(), strict_map_key=False)
+        while frame["a"] == "online_status":
+            frame = msgpack.unpackb(await listener.receive_from(), strict_map_key=False)
+        self.assertEqual(frame["m"], relayed)
+        self.assertIsInstance(frame["t"], float)
+
+        await sender.disconnect()
+        await listener.disconnect()
+
+    def test_msgpack_keeps_unparseable_timestamps(self):
+        protocol = PROTOCOLS["msgpack"]
+        frame = msgpack.unpackb(protocol.encode({"updated_chat": {"last_message": {"created_at": "hello"}},
+                                                 "time": "2024-01-01T00:00:00+00:00"}))
+
+        self.assertEqual(frame["c"]["l"]["ca"], "hello")
+        self.assertEqual(frame["t"], 1704067200.0)
+
+    async def test_send_message_persists_and_acks(self):
+        listener = await self.connect("/ws/chat/", self.friend)
+        sender = await self.connect(f"/ws/chat/{self.chat.id}/", self.owner)
+
+        await sender.send_json_to({"action": "send_message", "client_id": "c-1", "text": "over the socket"})
+        ack = await self.receive_message(sender)
+
+        self.assertEqual((ack["action"], ack["client_id"], ack["created"]), ("ack", "c-1", True))
+        message = await database_sync_to_async(Message.objects.select_related("message_controller").get)(
+            id=ack["message"]["id"])
+        self.assertEqual((message.text, message.message_controller.client_id), ("over the socket", "c-1"))
+
+        received = await self.receive_message(listener)
+        self.assertEqual(received["action"], "new_message")
+        self.assertEqual(received["message"]["id"], message.id)
+        self.assertEqual(received["updated_chat"]["unread_messages"], 1)
+        self.assertTrue(await sender.receive_nothing())
+
+        await sender.disconnect()
+        await listener.disconnect()
+
+    async def test_repeated_client_id_is_idempotent(self):
+        listener = await self.connect("/ws/chat/", self.friend)
+        sender = await self.connect(f"/ws/chat/{self.chat.id}/", self.owner)
+
+        await sender.send_json_to({"action": "send_message", "client_id": "retry", "text": "once"})
+        first = await self.receive_message(sender)
+        await sender.send_json_to({"action": "send_message", "client_id": "retry", "text": "once"})
+        second = await self.receive_message(sender)
+
+        self.assertFalse(second["created"])
+        self.assertEqual(first["message"]["id"], second["message"]["id"])
+        self.assertEqual(await database_sync_to_async(Message.objects.filter(text="once").count)(), 1)
+
+        self.assertEqual((await self.receive_message(listener))["message"]["id"], first["message"]["id"])
+        self.assertTrue(await listener.receive_nothing())
+
+        await sender.disconnect()
+        await listener.disconnect()
+
+    async def test_send_message_is_validated(self):
+        chat = await database_sync_to_async(Chat.objects.create_private_chat)(self.owner.id, self.friend.id)
+        await database_sync_to_async(self.friend.profile.block)(self.owner.id)
+        sender = await self.connect(f"/ws/chat/{chat.id}/", self.owner)
+
+        await sender.send_json_to({"action": "send_message", "client_id": "blocked", "text": "hello"})
+        error = await self.receive_message(sender)
+        self.assertEqual(error["action"], "error")
+        self.assertEqual(error["details"], ["Can't send message to given user."])
+
+        await sender.send_json_to({"action": "send_message", "text": "hello"})
+        self.assertEqual((await self.receive_message(sender))["details"], ["client_id is required."])
+        self.assertFalse(await database_sync_to_async(Message.objects.filter(text="hello").exists)())
+
+        await sender.disconnect()
+
+    async def test_send_message_reply_and_integrity_errors(self):
+        other_chat = await database_sync_to_async(Chat.objects.create_private_chat)(self.owner.id, self.friend.id)
+        elsewhere = await database_sync_to_async(Message.objects.create_message)(other_chat.id, self.owner,
+                                                                                 text="elsewhere")
+        sender = await self.connect(f"/ws/chat/{self.chat.id}/", self.owner)
+
+        await sender.send_json_to({"action": "send_message", "client_id": "reply", "text": "hi",
+                                   "reply_id": elsewhere.id})
+        self.assertEqual((await self.receive_message(sender))["details"],
+                         ["Can't find message with given id to reply."])
+
+        with patch("main.consumers.create_message", side_effect=IntegrityError):
+            await sender.send_json_to({"action": "send_message", "client_id": "broken", "text": "hi"})
+            self.assertEqual((await self.receive_message(sender))["details"], ["Message could not be saved."])
+
+        await sender.send_json_to({"action": "send_message", "client_id": "broken", "text": "again"})
+        self.assertEqual((await self.receive_message(sender))["action"], "ack")
+        await sender.disconnect()
+
+    async def test_membership_changes_update_live_sockets(self):
+        outsider = await database_sync_to_async(create_user)("outsider")
+        sender = await self.connect(f"/ws/chat/{self.chat.id}/", self.owner)
+        listener = await self.connect("/ws/chat/", outsider)
+
+        await database_sync_to_async(self.chat.join_chat)(outsider)
+        await sender.send_json_to({"message": "welcome"})
+        self.assertEqual((await self.receive_message(listener))["message"], "welcome")
+
+        await database_sync_to_async(self.chat.leave_chat)(outsider)
+        await sender.send_json_to({"message": "bye"})
+        await self.receive_message(sender)
+        await self.receive_message(sender)
+        self.assertTrue(await listener.receive_nothing())
+
+        await sender.disconnect()
+        await listener.disconnect()
+
+    async def test_non_member_cannot_open_chat_socket(self):
+        outsider = await database_sync_to_async(create_user)("outsider")
+        communicator = WebsocketCommunicator(URLRouter(URL_PATTERNS), f"/ws/chat/{self.chat.id}/")
+        communicator.scope["user"] = outsider
+
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class PresenceTest(TransactionTestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Chat.objects.create_private_chat(self.user.id, self.friend.id)
+        self.presence = get_presence_backend()
+        self.presence.clear()
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(URL_PATTERNS), "/ws/chat/")
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_second_tab_keeps_user_online(self):
+        first = await self.connect(self.user)
+        second = await self.connect(self.user)
+
+        await first.disconnect()
+        self.assertTrue(self.presence.is_online(self.user.id))
+
+        await second.disconnect()
+        self.assertFalse(self.presence.is_online(self.user.id))
+
+    async def test_idle_socket_is_closed(self):
+        communicator = await self.connect(self.user)
+        channel_name, = self.presence.expired(timeout=-1)
+
+        await get_channel_layer().send(channel_name, {"type": "presence.expired"})
+
+        self.assertEqual((await communicator.receive_output())["type"], "websocket.close")
+        await communicator.disconnect()
+        self.assertFalse(self.presence.is_online(self.user.id))
+
+    def test_status_changes_are_flushed_in_one_batch(self):
+        users = [create_user(f"user{i}") for i in range(10)]
+        for user in users:
+            self.presence.connect(user.id, f"channel-{user.id}")
+        for user in users[:5]:
+            self.presence.disconnect(user.id, f"channel-{user.id}")
+
+        offline_at = self.presence.last_online(users[0].id)
+        self.assertFalse(Profile.objects.filter(is_online=True).exists())
+        with self.assertNumQueries(2):
+            self.assertEqual(self.presence.flush(), 10)
+
+        profiles = {profile.user_id: profile for profile in Profile.objects.filter(user__in=users)}
+        self.assertEqual({user_id for user_id, profile in profiles.items() if profile.is_online},
+                         {user.id for user in users[5:]})
+        self.assertEqual(profiles[users[0].id].last_online, offline_at)
+        self.assertEqual(self.presence.flush(), 0)
+
+    def test_serializers_read_the_store(self):
+        self.presence.connect(self.friend.id, "channel")
+
+        self.assertTrue(AuthUserSerializer(self.friend).data["is_online"])
+        self.assertTrue(ChatSerializer(self.chat, context={"user": self.user}).data["is_online"])
+        self.assertFalse(Profile.objects.get(user=self.friend).is_online)
+
+
+class ResumableSocketTest(TransactionTestCase):
+    def setUp(self):
+        self.owner = create_user("owner")
+        self.friend = create_user("friend")
+        self.chat = Group.objects.create_group("resume", self.owner.id, "resume").chat
+        self.chat.join_chat(self.friend)
+        get_presence_backend().clear()
+        get_event_log_backend().clear()
+
+    async def connect(self, path, user):
+        communicator = WebsocketCommunicator(URLRouter(URL_PATTERNS), path)
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_message(self, communicator):
+        while True:
+            data = await communicator.receive_json_from()
+            if data["action"] != "online_status":
+                return data
+
+    async def test_missed_events_are_replayed_on_reconnect(self):
+        sender = await self.connect(f"/ws/chat/{self.chat.id}/", self.owner)
+        listener = await self.connect("/ws/chat/", self.friend)
+
+        await sender.send_json_to({"message": "first", "action": "new_message"})
+        last_event_id = (await self.receive_message(listener))["event_id"]
+        await listener.disconnect()
+
+        for text in ("second", "third"):
+            await sender.send_json_to({"message": text, "action": "new_message"})
+            await self.receive_message(sender)
+
+        listener = await self.connect(f"/ws/chat/?last_event_id={last_event_id}", self.friend)
+        replayed = [await self.receive_message(listener) for _ in range(2)]
+
+        self.assertEqual([event["message"] for event in replayed], ["second", "third"])
+        self.assertTrue(last_event_id < replayed[0]["event_id"] < replayed[1]["event_id"])
+        self.assertTrue(await listener.receive_nothing())
+
+        await listener.disconnect()
+        await sender.disconnect()
+
+    async def test_unknown_event_id_requires_resync(self):
+        listener = await self.connect("/ws/chat/?last_event_id=1", self.friend)
+
+        self.assertEqual((await self.receive_message(listener))["action"], "resync_required")
+        await listener.disconnect()
+
+    def test_overflowed_log_requires_resync(self):
+        log = MemoryEventLogBackend(size=2)
+        first = log.append([self.friend.id], {"message": "one"})
+        second = log.append([self.friend.id], {"message": "two"})
+        log.append([self.friend.id], {"message": "three"})
+
+        self.assertIsNone(log.since(self.friend.id, first - 1))
+        self.assertEqual([event["message"] for _, event in log.since(self.friend.id, first)], ["two", "three"])
+        self.assertEqual(len(log.since(self.friend.id, second)), 1)
+        self.assertEqual(log.since(self.owner.id, second), [])
+
+    def test_memory_log_refuses_a_shared_channel_layer(self):
+        with override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels_redis.core.RedisChannelLayer"}}):
+            with self.assertRaises(ImproperlyConfigured):
+                MemoryEventLogBackend()
+
+
+class DatabaseResumableSocketTest(ResumableSocketTest):
+    # the replay tests above against the log every worker shares
+    def setUp(self):
+        settings_override = override_settings(EVENT_LOG_BACKEND="main.events.DatabaseEventLogBackend")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_event_log_backend.cache_clear()
+        self.addCleanup(get_event_log_backend.cache_clear)
+        super().setUp()
+
+    def test_log_keeps_events_per_user_and_sweeps_old_ones(self):
+        log = DatabaseEventLogBackend(size=2)
+        first = log.append([self.friend.id], {"chat_id": self.chat.id, "message": "one"})
+        second = log.append([self.owner.id], {"chat_id": self.chat.id, "message": "two"})
+        log.append([self.friend.id], {"chat_id": self.chat.id, "message": "three"})
+
+        self.assertEqual([event["message"] for _, event in log.since(self.friend.id, first)], ["three"])
+        self.assertEqual(len(log.since(self.friend.id, first - 1)), 2)
+        self.assertIsNone(log.since(self.friend.id, second + 5))
+
+        SocketEvent.objects.filter(id__lte=second).update(created_at=timezone.now() - timedelta(hours=2))
+        log.next_sweep = 0
+        log.append([self.friend.id], {"chat_id": self.chat.id, "message": "four"})
+        # swept events require a resync, so do more than the log keeps for a socket
+        self.assertIsNone(log.since(self.friend.id, first))
+        self.assertEqual(len(log.since(self.friend.id, second)), 2)
+        log.append([self.friend.id], {"chat_id": self.chat.id, "message": "five"})
+        self.assertIsNone(log.since(self.friend.id, second))
+
+
+class TokenCacheTest(TestCase):
+    def setUp(self):
+        self.user = create_user("owner")
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token.key}")
+        token_cache.clear()
+
+    def auth_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("auth-info"))
+        self.assertEqual(response.status_code, 200)
+        return [q["sql"] for q in queries if "authtoken" in q["sql"] or '"auth_user"' in q["sql"]]
+
+    def test_warm_requests_skip_auth_queries(self):
+        self.assertEqual(len(self.auth_queries()), 1)
+        self.assertEqual(self.auth_queries(), [])
+        self.assertEqual(self.client.get(reverse("auth-info")).data["id"], self.user.id)
+
+        stats = token_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+    def test_socket_handshake_shares_the_cache(self):
+        authenticate_token(self.token.key)
+
+        with self.assertNumQueries(0):
+            user = async_to_sync(get_user)(self.token.key)
+        self.assertEqual(user.id, self.user.id)
+        self.assertIsNone(async_to_sync(get_user)("missing"))
+
+    def test_deleted_token_is_rejected(self):
+        self.auth_queries()
+        self.token.delete()
+
+        self.assertEqual(self.client.get(reverse("auth-info")).status_code, 403)
+
+    def test_expiration_change_is_picked_up(self):
+        self.auth_queries()
+        self.token.options.expiration_date = timezone.now() - timedelta(minutes=1)
+        self.token.options.save()
+
+        self.assertEqual(self.client.get(reverse("auth-info")).status_code, 403)
+        self.assertFalse(Token.objects.filter(key=self.token.key).exists())
+
+    def test_user_changes_are_picked_up(self):
+        self.auth_queries()
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertEqual(self.client.get(reverse("auth-info")).status_code, 403)
+
+    def test_cache_is_bounded(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        for key in ("a", "b", "c"):
+            cache.set(key, self.user, None)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+        cache = TokenCache(max_size=2, ttl=-1)
+        cache.set("a", self.user, None)
+        self.assertIsNone(cache.get("a"))
+
+    def test_invalidations_reach_other_workers(self):
+        worker, other_worker = TokenCache(max_size=10, ttl=60), TokenCache(max_size=10, ttl=60)
+        worker.set("a", self.user, None)
+        worker.set("b", self.user, None)
+        self.assertIsNotNone(worker.get("a"))
+
+        other_worker.invalidate("a")
+        self.assertIsNone(worker.get("a"))
+        self.assertIsNotNone(worker.get("b"))
+
+        worker.set("a", self.user, None)
+        other_worker.invalidate_user(self.user.id)
+        self.assertIsNone(worker.get("a"))
+        self.assertIsNone(worker.get("b"))
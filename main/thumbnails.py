@@ -0,0 +1,157 @@
+import base64
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Pillow format and file extension of every variant format
+VARIANT_FORMATS = {"webp": ("WEBP", "webp"), "jpeg": ("JPEG", "jpg")}
+
+PLACEHOLDER_SIZE = 16
+
+# EXIF orientations that swap width and height
+ORIENTATION_TAG = 0x0112
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def encode(image, image_format, quality):
+    buffer = BytesIO()
+    image.save(buffer, VARIANT_FORMATS[image_format][0], quality=quality)
+    return buffer.getvalue()
+
+
+def render_variants(source, sizes, formats, quality):
+    # runs in a worker process, only Pillow and the bytes or path of the original are needed here.
+    # {width, height, placeholder, variants: {name: {format: (bytes, width, height)}}}
+    with Image.open(source if isinstance(source, str) else BytesIO(source)) as original:
+        # stored dimensions are the display orientation of the full image
+        width, height = original.size
+        if original.getexif().get(ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+
+        # JPEGs are decoded at the smallest scale that still covers the largest variant
+        original.draft("RGB", (max(sizes.values()), max(sizes.values())))
+        image = ImageOps.exif_transpose(original).convert("RGB")
+
+    # largest first, every variant is scaled down from the previous one
+    variants = {}
+    for name, edge in sorted(sizes.items(), key=lambda item: -item[1]):
+        image.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+        variants[name] = {
+            image_format: (encode(image, image_format, quality), image.width, image.height)
+            for image_format in formats
+        }
+
+    image.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    placeholder = "data:image/webp;base64," + base64.b64encode(encode(image, "webp", 40)).decode()
+
+    return {"width": width, "height": height, "placeholder": placeholder, "variants": variants}
+
+
+@lru_cache(maxsize=None)
+def get_render_pool():
+    # spawned workers never inherit database connections or locks of the web process
+    return ProcessPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS,
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+@lru_cache(maxsize=None)
+def get_store_pool():
+    # one thread saves finished variants, results are written in order and off the request thread
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnails")
+
+
+def photo_source(photo):
+    # workers open local files by path, remote storages hand over the bytes
+    try:
+        return photo.image.path
+    except NotImplementedError:
+        with photo.image.open("rb") as file:
+            return file.read()
+
+
+def variant_names(variants):
+    return [variant["name"] for formats in variants.values() for variant in formats.values()]
+
+
+def save_variants(photo_id, fields, previous):
+    # fields holds stored variant names, their references replace the ones of the previous variants
+    from main.models import MediaBlob, Photo
+
+    with transaction.atomic():
+        MediaBlob.objects.acquire(variant_names(fields["variants"]))
+        Photo.objects.filter(id=photo_id).update(**fields)
+        MediaBlob.objects.release(variant_names(previous))
+    return fields["variants"]
+
+
+def store_variants(photo_id, result):
+    from main.models import Photo
+
+    photo = Photo.objects.filter(id=photo_id).only("id", "image", "variants").first()
+    if photo is None:
+        return None
+
+    storage = photo.image.storage
+    base = os.path.splitext(photo.image.name)[0]
+    variants = {}
+    for name, encoded in result["variants"].items():
+        variants[name] = {}
+        for image_format, (content, width, height) in encoded.items():
+            path = storage.save(f"{base}_{name}.{VARIANT_FORMATS[image_format][1]}", ContentFile(content))
+            variants[name][image_format] = {"name": path, "width": width, "height": height}
+
+    fields = {"width": result["width"], "height": result["height"], "placeholder": result["placeholder"],
+              "variants": variants}
+    return save_variants(photo_id, fields, photo.variants)
+
+
+def copy_variants(photo):
+    # a photo of content that was rendered before shares those variants, nothing is rendered again
+    from main.models import Photo
+
+    fields = Photo.objects.filter(image=photo.image.name).exclude(id=photo.id).exclude(variants={}) \
+        .values("width", "height", "placeholder", "variants").first()
+    if fields is None:
+        return None
+    return save_variants(photo.id, fields, photo.variants)
+
+
+def generate_variants(photo):
+    # inline in the calling thread, used when THUMBNAIL_WORKERS is 0
+    result = render_variants(photo_source(photo), settings.THUMBNAIL_SIZES, settings.THUMBNAIL_FORMATS,
+                             settings.THUMBNAIL_QUALITY)
+    return store_variants(photo.id, result)
+
+
+def store_when_rendered(photo_id, future):
+    # the original stays as it is, a failed photo is picked up again by rebuild_thumbnails
+    try:
+        store_variants(photo_id, future.result())
+    except Exception:
+        logger.exception("Rendering variants of photo %s failed", photo_id)
+    finally:
+        close_old_connections()
+
+
+def queue_variants(photo):
+    # called once the photo is committed, the request never waits for Pillow
+    variants = copy_variants(photo)
+    if variants is not None:
+        return variants
+
+    if not settings.THUMBNAIL_WORKERS:
+        return generate_variants(photo)
+
+    future = get_render_pool().submit(render_variants, photo_source(photo), settings.THUMBNAIL_SIZES,
+                                      settings.THUMBNAIL_FORMATS, settings.THUMBNAIL_QUALITY)
+    get_store_pool().submit(store_when_rendered, photo.id, future)
@@ -0,0 +1,134 @@
+import os
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from main.api.serializers.allMessages import PhotoSerializer, VideoSerializer
+from main.models import UploadSession
+from main.storage import media_storage
+
+# upload kind -> (serializer, file field)
+UPLOAD_KINDS = {
+    "photo": (PhotoSerializer, "image"),
+    "video": (VideoSerializer, "video"),
+}
+
+# bytes read from the request per write, memory of an upload never grows past it
+UPLOAD_BLOCK_SIZE = 64 * 1024
+
+
+class ChunkedUploadFile(UploadedFile):
+    # the assembled part file, storage moves it into place instead of copying it through memory.
+    # digest is set for content the storage already has, it is not hashed again
+    def __init__(self, path, name, size, digest=None):
+        super().__init__(open(path, "rb"), name=name, size=size)
+        self.path = path
+        self.digest = digest
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def part_path(session):
+    return os.path.join(settings.UPLOAD_TEMP_DIR, f"{session.id}.part")
+
+
+def part_size(session):
+    path = part_path(session)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def append_chunk(session, offset, stream, length):
+    # new offset, None when offset is not where the session stands
+    if offset != session.offset:
+        return None
+
+    os.makedirs(settings.UPLOAD_TEMP_DIR, exist_ok=True)
+    path = part_path(session)
+    remaining = length
+    with open(path, "r+b" if os.path.exists(path) else "wb") as file:
+        file.seek(offset)
+        while remaining:
+            try:
+                block = stream.read(min(UPLOAD_BLOCK_SIZE, remaining))
+            except OSError:
+                block = b""
+            if not block:
+                break
+            file.write(block)
+            remaining -= len(block)
+
+    # what arrived before a dropped connection is kept, the client resumes from the new offset
+    new_offset = offset + length - remaining
+    updated = UploadSession.objects.filter(id=session.id, offset=offset) \
+        .update(offset=new_offset, updated_at=timezone.now())
+    if not updated:
+        return None
+
+    session.offset = new_offset
+    return new_offset
+
+
+def finalize_upload(session, user):
+    # (serializer with the created photo or video, created)
+    serializer_class, file_field = UPLOAD_KINDS[session.kind]
+    if session.message_controller_id:
+        content = getattr(session.message_controller, session.kind)
+        return serializer_class(content, context={"user": user}), False
+
+    if session.blob_id:
+        # same name as the stored blob, storage finds it and neither moves nor copies anything
+        storage = media_storage()
+        upload = ChunkedUploadFile(storage.path(session.blob.name), os.path.basename(session.blob.name),
+                                   session.blob.size, digest=session.blob.digest)
+    elif session.offset == session.size and os.path.exists(part_path(session)):
+        path = part_path(session)
+        with open(path, "r+b") as file:
+            file.truncate(session.size)
+        upload = ChunkedUploadFile(path, session.file_name, session.size)
+    else:
+        # incomplete, or the announced blob went away before finalize and the content has to be uploaded
+        UploadSession.objects.filter(id=session.id).update(offset=min(session.offset, part_size(session)))
+        raise ValidationError({"details": ["Upload is not complete."]})
+
+    data = {
+        file_field: upload,
+        "caption": session.caption,
+        "author_id": user.id,
+        "chat_id": session.chat_id,
+    }
+    if session.reply_id:
+        data["reply_id"] = session.reply_id
+
+    try:
+        serializer = serializer_class(data=data, context={"user": user})
+        serializer.is_valid(raise_exception=True)
+
+        # content row, controller and session are committed together. The conditional update claims the
+        # session, when a concurrent finalize claimed it first this message is rolled back and that one returned
+        with transaction.atomic():
+            instance = serializer.save()
+            claimed = UploadSession.objects.filter(id=session.id, message_controller__isnull=True) \
+                .update(message_controller=getattr(instance, f"{session.kind}_controller"), updated_at=timezone.now())
+            if not claimed:
+                transaction.set_rollback(True)
+    finally:
+        upload.close()
+
+    if not claimed:
+        session.refresh_from_db()
+        return finalize_upload(session, user)
+
+    # content that was already stored leaves the part file behind
+    if os.path.exists(part_path(session)):
+        os.remove(part_path(session))
+    return serializer, True
+
+
+def remove_upload(session):
+    if os.path.exists(part_path(session)):
+        os.remove(part_path(session))
+    session.delete()
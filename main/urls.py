@@ -5,7 +5,9 @@ from main.views import (GetMyInfo, CreateEditMessageView, CreateGroup,
                         ChatCreateView,ChatMessagesView, ChatListView,
                         ChatDetailsView, JoinChatView, LeaveChatView,
                         ChatMembersView, MessageReadView, DeleteMessageView,
-                        GetUsersListView, GetUserDetailsView, BlockUserView, UnblockUserView)
+                        GetUsersListView, GetUserDetailsView, BlockUserView, UnblockUserView,
+                        SearchMessagesView, SyncView, UploadInitView, UploadDetailsView,
+                        UploadChunkView, UploadFinalizeView, MediaView)
 
 urlpatterns = [
     path("auth/info", GetMyInfo.as_view(), name="auth-info"),
@@ -14,6 +16,7 @@ urlpatterns = [
     path("group/create", CreateGroup.as_view(), name="create-group"),
     path("chat/create", ChatCreateView.as_view(), name="create-chat"),
     path("chat/getList", ChatListView.as_view(), name="get-all-chats"),
+    path("chat/sync", SyncView.as_view(), name="sync"),
     path("chat/<int:pk>/", ChatDetailsView.as_view(), name="get-chats-details"),
     path("chat/joinChat", JoinChatView.as_view(), name="join-chat"),
     path("chat/<int:pk>/leaveChat", LeaveChatView.as_view(), name="leave-chat"),
@@ -22,6 +25,12 @@ urlpatterns = [
     path('chat/<int:pk>/createMessage', CreateEditMessageView.as_view(), name='create-message'),
     path('chat/<int:pk>/markRead', MessageReadView.as_view(), name='mark-read-message'),
     path('chat/<int:pk>/deleteMessage', DeleteMessageView.as_view(), name='delete-message'),
+    path('message/search', SearchMessagesView.as_view(), name='search-messages'),
+    path('media/<str:kind>/<int:pk>', MediaView.as_view(), name='media'),
+    path('upload/init', UploadInitView.as_view(), name='upload-init'),
+    path('upload/<int:pk>/', UploadDetailsView.as_view(), name='upload-details'),
+    path('upload/<int:pk>/appendChunk', UploadChunkView.as_view(), name='upload-chunk'),
+    path('upload/<int:pk>/finalize', UploadFinalizeView.as_view(), name='upload-finalize'),
     path('user/getList', GetUsersListView.as_view(), name='get-users-list'),
     path('user/<int:pk>/', GetUserDetailsView.as_view(), name='get-user-details'),
     path('user/<int:pk>/blockUser', BlockUserView.as_view(), name='block-user'),
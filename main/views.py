@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import Http404
 from rest_framework import status
@@ -7,10 +8,18 @@ from rest_framework.response import Response
 from main.api.genericViews.auth import AuthRequiredView
 from main.api.genericViews.chatAndGroup import ChatViewBase, CreateBaseView
 from main.api.genericViews.messagesView import ManageMessageBase
+from main.api.genericViews.uploadView import UploadBaseView
 from main.api.genericViews.userVeiw import UserBaseView
+from main.api.paginations.custom import MessageCursorPagination, CustomPagination
+from main.api.serializers.search import SearchHitSerializer
 from main.api.serializers.chatMembers import ChatMemberSerializer
 from main.api.serializers.users import AuthUserSerializer
-from main.models import Chat, MessageController
+from main.media import serve_media
+from main.models import Chat, MessageController, Photo, Video
+from main.storage import media_storage
+from main.search import get_search_backend
+from main.sync import decode_cursor, collect_changes
+from main.uploads import append_chunk, finalize_upload
 from main.api.serializers.allMessages import (AllMessageSerializer,
                                               ChatSerializer,
                                               GroupSerializer)
@@ -83,6 +92,8 @@ class LeaveChatView(ChatViewBase):
 
 
 class ChatMessagesView(ChatViewBase):
+    cursor_pagination_class = MessageCursorPagination()
+
     def get(self, request, pk):
         chat = self.get_query(request, pk)
         content_query = request.GET.get("content", "")
@@ -90,10 +101,147 @@ class ChatMessagesView(ChatViewBase):
             "from_date": request.GET.get("from_date", None),
             "to_date": request.GET.get("to_date", None),
         }
-        messages = chat.get_messages(request.user, content_query, date_filter)
-        paginated_messages = self.pagination_class.paginate_queryset(messages, request)
+        rank = request.GET.get("order", "") == "rank"
+
+        # before/after cursors select keyset pagination, otherwise keep limit/offset for old clients
+        if self.cursor_pagination_class.is_requested(request):
+            # cursors follow (created_at, id), ranked results can only be paged by offset
+            if rank:
+                return Response({"details": ["order=rank can't be combined with before/after cursors."]},
+                                status=status.HTTP_400_BAD_REQUEST)
+            paginator = self.cursor_pagination_class
+        else:
+            paginator = self.pagination_class
+
+        messages = chat.get_messages(request.user, content_query, date_filter, rank=rank)
+
+        paginated_messages = paginator.paginate_queryset(messages, request)
         serializer = AllMessageSerializer(paginated_messages, many=True, context={'user': request.user})
-        return self.response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class SearchMessagesView(AuthRequiredView):
+    pagination_class = CustomPagination()
+
+    def get(self, request):
+        query = request.GET.get("q", "")
+        if not query:
+            return Response({"details": ["Search query is required."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        date_filter = {
+            "from_date": request.GET.get("from_date", None),
+            "to_date": request.GET.get("to_date", None),
+        }
+        messages = MessageController.objects.search(request.user, query, date_filter) \
+            .select_related("author", "message", "photo", "video").order_by("-created_at", "-id")
+        hits = self.pagination_class.paginate_queryset(messages, request)
+
+        snippets = get_search_backend().snippets(hits, query)
+        chats = Chat.objects.filter(id__in={hit.chat_id for hit in hits}).with_user_data(request.user).in_bulk()
+
+        # hits of the page grouped by chat, in the order the chats first appear
+        groups = {}
+        for hit in hits:
+            if hit.chat_id not in groups:
+                chat_data = ChatSerializer(chats[hit.chat_id], context={'user': request.user}).data
+                groups[hit.chat_id] = {"chat": chat_data, "messages": []}
+            groups[hit.chat_id]["messages"].append(
+                SearchHitSerializer(hit, context={"snippets": snippets}).data
+            )
+
+        return self.pagination_class.get_paginated_response(list(groups.values()))
+
+
+class SyncView(AuthRequiredView):
+    # the cursor holds a position for every chat of the user, clients with many chats post it
+    def get(self, request):
+        return self.sync(request, request.GET.get("cursor", ""))
+
+    def post(self, request):
+        return self.sync(request, request.data.get("cursor", "") if isinstance(request.data, dict) else None)
+
+    def sync(self, request, cursor):
+        # changes since the cursor of the previous sync, an empty cursor returns every chat of the user
+        if not isinstance(cursor, str):
+            return Response({"details": ["Invalid cursor"]}, status=status.HTTP_400_BAD_REQUEST)
+        if len(cursor) > settings.SYNC_CURSOR_MAX_SIZE:
+            return Response({"details": ["Cursor is too large, sync without one."]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            positions = decode_cursor(cursor)
+        except ValueError:
+            return Response({"details": ["Invalid cursor"]}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(collect_changes(request.user, positions))
+
+
+class UploadInitView(UploadBaseView):
+    def post(self, request):
+        serializer = self.serializer_class(data=request.data, context={'user': request.user})
+        if serializer.is_valid():
+            serializer.save()
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class UploadDetailsView(UploadBaseView):
+    def get(self, request, pk):
+        # where a resumed upload continues from
+        return Response(self.serializer_class(self.get_session(request, pk)).data)
+
+
+class UploadChunkView(UploadBaseView):
+    def post(self, request, pk):
+        # raw bytes of the chunk in the body, ?offset= is where they start in the file
+        session = self.get_session(request, pk)
+        offset = request.GET.get("offset", "")
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+
+        if session.message_controller_id:
+            return Response({"details": ["Upload is already finalized."]}, status=status.HTTP_400_BAD_REQUEST)
+        if not offset.isdigit():
+            return Response({"details": ["Chunk offset is required."]}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 < length <= settings.UPLOAD_CHUNK_SIZE or int(offset) + length > session.size:
+            return Response({"details": ["Chunk size is incorrect."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        if append_chunk(session, int(offset), request.stream, length) is None:
+            session.refresh_from_db(fields=["offset"])
+            return Response({"details": ["Chunk offset is incorrect."], "offset": session.offset},
+                            status=status.HTTP_409_CONFLICT)
+
+        return Response(self.serializer_class(session).data)
+
+
+class UploadFinalizeView(UploadBaseView):
+    def post(self, request, pk):
+        serializer, created = finalize_upload(self.get_session(request, pk), request.user)
+        return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+
+class MediaView(AuthRequiredView):
+    media_models = {"photo": Photo, "video": Video}
+
+    def get(self, request, kind, pk):
+        # one membership query, the bytes are sent by the web server or streamed from the file
+        model = self.media_models.get(kind)
+        if not model:
+            raise Http404
+
+        content = model.filtered_objects.filter(id=pk, chat__members__member=request.user,
+                                                chat__members__is_deleted=False).first()
+        if not content:
+            raise Http404
+
+        name = getattr(content, model.media_field).name
+        variant = request.GET.get("variant")
+        if variant:
+            try:
+                name = content.variants[variant][request.GET.get("image_format", "webp")]["name"]
+            except (AttributeError, KeyError):
+                raise Http404
+
+        return serve_media(request, media_storage(), name)
 
 
 class ChatMembersView(ChatViewBase):
@@ -154,7 +302,9 @@ class DeleteMessageView(ManageMessageBase):
         self.decide_model(request)
         if not self.default_model:
             return self.message_type_incorrect()
-        return self.handle_model_response(pk, request, self.default_model.filtered_objects.delete_message,
+
+        self.get_message_id(request.data)
+        return self.handle_model_response(pk, request.data.copy(), self.default_model.filtered_objects.delete_message,
                                           status.HTTP_204_NO_CONTENT)
 
 class GetUsersListView(UserBaseView):
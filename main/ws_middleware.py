@@ -1,25 +1,29 @@
+from urllib.parse import parse_qs
+
 from channels.auth import AuthMiddleware
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from channels.sessions import CookieMiddleware
 from django.contrib.sessions.middleware import SessionMiddleware
-from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from main.api.authentications.cache import authenticate_token
 
 
 @database_sync_to_async
 def get_user(token):
     try:
-        token = Token.objects.get(key=token)
-    except Token.DoesNotExist:
+        user, token = authenticate_token(token)
+    except AuthenticationFailed:
         return None
 
-    return token.user
+    return user
 
 
 class QueryAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
         scope = dict(scope)
-        token = scope.get("query_string", b"token=").decode("utf-8")
-        token = token.replace("token=", "")
+        # other parameters, like last_event_id, are read by the consumers
+        token = parse_qs(scope.get("query_string", b"").decode("utf-8")).get("token", [""])[0]
         scope['user'] = await get_user(token)
         return await super().__call__(scope, receive, send)
\ No newline at end of file